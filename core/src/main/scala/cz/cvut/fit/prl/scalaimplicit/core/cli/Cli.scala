@@ -4,7 +4,11 @@ import java.nio.file.{Paths, Files}
 
 case class CliConfig(root: String = "Nodir",
                      classpath: String = "Nocp",
-                     outdir: String = "./tmp")
+                     outdir: String = "./tmp",
+                     shards: Option[String] = None,
+                     shardSalt: String = "",
+                     json: Boolean = false,
+                     compress: Boolean = false)
 object Cli {
   def apply(args: Array[String]): Option[CliConfig] = {
     val optParser = new scopt.OptionParser[CliConfig]("collector") {
@@ -34,6 +38,18 @@ object Cli {
         )
         .action((x, c) => c.copy(outdir = x))
         .text("The desired place to output the files")
+      opt[String]("shards")
+        .action((x, c) => c.copy(shards = Some(x)))
+        .text("A folder to keep the results of every file between runs")
+      opt[String]("shard-salt")
+        .action((x, c) => c.copy(shardSalt = x))
+        .text("What else the results of the files depend on, e.g. a digest of the classpath")
+      opt[Unit]("json")
+        .action((_, c) => c.copy(json = true))
+        .text("Also write the results as JSON")
+      opt[Unit]("compress")
+        .action((_, c) => c.copy(compress = true))
+        .text("Write the results gzipped (.gz)")
     }
 
     optParser.parse(args, CliConfig())
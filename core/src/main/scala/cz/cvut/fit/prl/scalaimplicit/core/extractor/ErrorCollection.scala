@@ -5,13 +5,15 @@ import java.nio.file.{Files, Paths}
 
 /**
   * Class that buffers logs, and can print them to a file.
-  * It does have state, but the only operation it allows is to add,
-  * and not even toFile modifies the queue.
+  * It does have state, but the only operations it allows are to add,
+  * and to clear it between the jobs of a JobServer.
+  * Not even toFile modifies the queue.
   * @tparam A
   */
 class DebugLogger[A](prettyPrint: A => String) {
   private var _queue: List[(String, A)] = List()
   def report(header: String, e: A) = _queue = (header, e) :: _queue
+  def clear() = _queue = List()
   def toFile(file: String) =
     Files.write(Paths.get(file),
                 _queue
@@ -1,6 +1,7 @@
 package cz.cvut.fit.prl.scalaimplicit.core.extractor.serializers
 
 import java.nio.file.{Files, Path, Paths}
+import java.util.zip.{GZIPInputStream, GZIPOutputStream}
 
 import io.circe.parser._
 import io.circe.syntax._
@@ -10,14 +11,26 @@ import io.circe._
 import cz.cvut.fit.prl.scalaimplicit.core.util.Scala212Backport.Either212
 
 object JSONSerializer {
+  // Gzipped if the file ends in .gz
   def saveJSON[T: Encoder](res: T, file: String): Path = {
     val ser = res.asJson
-    Files.write(Paths.get(file), ser.noSpaces.getBytes)
+    if (file.endsWith(".gz")) {
+      val out = new GZIPOutputStream(Files.newOutputStream(Paths.get(file)), 1 << 16)
+      try out.write(ser.noSpaces.getBytes) finally out.close()
+      Paths.get(file)
+    } else Files.write(Paths.get(file), ser.noSpaces.getBytes)
   }
 
+  private def read(file: String): String =
+    if (file.endsWith(".gz")) {
+      val in = scala.io.Source.fromInputStream(
+        new GZIPInputStream(Files.newInputStream(Paths.get(file)), 1 << 16))
+      try in.mkString finally in.close()
+    } else scala.io.Source.fromFile(file).mkString
+
   def loadJSON[T: Decoder](file: String): T = {
     val res = for {
-      json <- parse(scala.io.Source.fromFile(file).mkString)
+      json <- parse(read(file))
       obj <- json.as[T]
     } yield obj
 
@@ -1,6 +1,7 @@
 package cz.cvut.fit.prl.scalaimplicit.core.extractor.serializers
 
-import java.io.{FileInputStream, FileOutputStream}
+import java.io.{FileInputStream, FileOutputStream, InputStream, OutputStream}
+import java.util.zip.{GZIPInputStream, GZIPOutputStream}
 
 import com.trueaccord.scalapb.{GeneratedMessage, GeneratedMessageCompanion, Message}
 
@@ -9,9 +10,18 @@ import scala.util.Try
 object ProtoSerializer {
   type Msg[A] = GeneratedMessage with Message[A]
 
+  // Files ending in .gz are gzipped
+  private def input(file: String): InputStream =
+    if (file.endsWith(".gz")) new GZIPInputStream(new FileInputStream(file), 1 << 16)
+    else new FileInputStream(file)
+
+  private def output(file: String): OutputStream =
+    if (file.endsWith(".gz")) new GZIPOutputStream(new FileOutputStream(file), 1 << 16)
+    else new FileOutputStream(file)
+
   def load[A <: Msg[A] : GeneratedMessageCompanion](file: String): Try[Seq[A]] = {
     val companion = implicitly[GeneratedMessageCompanion[A]]
-    val tin: Try[FileInputStream] = Try(new FileInputStream(file))
+    val tin: Try[InputStream] = Try(input(file))
 
     try {
       for (in <- tin; xs <- Try(companion.streamFromDelimitedInput(in).toList)) yield xs
@@ -22,7 +32,7 @@ object ProtoSerializer {
 
 
   def save[A <: Msg[A]](messages: Seq[A], file: String): Try[Unit] = {
-    val tout = Try(new FileOutputStream(file))
+    val tout = Try(output(file))
     try {
       for (out <- tout; xs <- Try(messages.foreach(x => x.writeDelimitedTo(out)))) yield xs
     } finally {
@@ -15,9 +15,20 @@ case class ProjectManifest(
     results: String,
     paths: String
 ) {
-  val resultsFile = s"$results/results.json"
-  val callSitesFile = s"$results/results-callsites.json"
-  val definitionsFile = s"$results/results-declarations.json"
+  // Length-delimited records, as split by split_analysis_results
+  val resultsFile = ProjectManifest.artifact(s"$results/results.proto")
+  val callSitesFile =
+    ProjectManifest.artifact(s"$results/results-callsites.proto")
+  val definitionsFile =
+    ProjectManifest.artifact(s"$results/results-declarations.proto")
+}
+
+object ProjectManifest {
+  // The file as stored by the pipeline, plain or gzipped
+  def artifact(path: String): String =
+    if (!Files.exists(Paths.get(path)) && Files.exists(Paths.get(path + ".gz")))
+      path + ".gz"
+    else path
 }
 
 object Manifests extends LazyLogging {
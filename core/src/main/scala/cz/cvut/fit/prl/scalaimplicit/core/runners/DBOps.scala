@@ -15,7 +15,9 @@ object DBOps {
     from.copy(documents = discardMessageDocs(from.documents)).toDb(None)
   }
 
-  def loadDB(filePath: Path): d.Database = {
-    toMetaDB(s.Database.parseFrom(Files.readAllBytes(filePath)))
+  def loadDB(filePath: Path): d.Database = loadDB(Files.readAllBytes(filePath))
+
+  def loadDB(bytes: Array[Byte]): d.Database = {
+    toMetaDB(s.Database.parseFrom(bytes))
   }
 }
@@ -0,0 +1,36 @@
+package cz.cvut.fit.prl.scalaimplicit.core.runners
+
+import com.typesafe.scalalogging.LazyLogging
+
+import scala.io.StdIn
+import scala.util.control.NonFatal
+
+/**
+  * Runs jobs read from the standard input, so that one JVM can process
+  * many projects. A job is a line of tab-separated arguments, as they would
+  * be given to main, and is answered by a line starting with the marker:
+  * "OK", or "ERROR" and the message. Fatal errors, like running out of
+  * memory, are not caught and end the server. It stops at the end of input.
+  */
+object JobServer extends LazyLogging {
+  val Marker = "@@job-server"
+
+  def apply(runJob: Array[String] => Unit): Unit =
+    Iterator
+      .continually(StdIn.readLine())
+      .takeWhile(_ != null)
+      .filter(_.nonEmpty)
+      .foreach { line =>
+        val status =
+          try {
+            runJob(line.split("\t"))
+            "OK"
+          } catch {
+            case NonFatal(e) =>
+              logger.error(s"Job failed: ${line}", e)
+              s"ERROR ${String.valueOf(e.getMessage).replace('\n', ' ')}"
+          }
+        println(s"${Marker} ${status}")
+        Console.out.flush()
+      }
+}
@@ -0,0 +1,51 @@
+package cz.cvut.fit.prl.scalaimplicit.core.runners
+
+import java.nio.charset.StandardCharsets
+import java.nio.file.{Files, Paths, StandardCopyOption}
+
+import scala.util.Try
+
+/**
+  * Where TreeWalker.sharded keeps the result of every semanticdb file,
+  * under a hash of its content, so that a later run only processes the
+  * files that changed.
+  */
+trait ShardStore[A] {
+  def load(key: String): Option[A]
+  def save(key: String, value: A): Unit
+}
+
+/**
+  * One file per shard in a folder. Shards are written to a temporary file
+  * and moved in place, so that an interrupted run leaves no partial shard.
+  */
+abstract class FolderShardStore[A](folder: String) extends ShardStore[A] {
+  def encode(value: A): Array[Byte]
+  def decode(bytes: Array[Byte]): A
+
+  private def path(key: String) = Paths.get(folder, key.take(2), key)
+
+  override def load(key: String): Option[A] = {
+    val file = path(key)
+    if (Files.exists(file)) Try(decode(Files.readAllBytes(file))).toOption
+    else None
+  }
+
+  override def save(key: String, value: A): Unit = {
+    val file = path(key)
+    Files.createDirectories(file.getParent)
+    val tmp = Files.createTempFile(file.getParent, key, ".tmp")
+    Files.write(tmp, encode(value))
+    Files.move(tmp,
+               file,
+               StandardCopyOption.ATOMIC_MOVE,
+               StandardCopyOption.REPLACE_EXISTING)
+  }
+}
+
+case class ShardStats(reused: Int, recomputed: Int) {
+  def toFile(file: String): Unit =
+    Files.write(Paths.get(file),
+                s"reused,recomputed\n${reused},${recomputed}\n".getBytes(
+                  StandardCharsets.UTF_8))
+}
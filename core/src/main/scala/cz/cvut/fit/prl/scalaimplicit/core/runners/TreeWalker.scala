@@ -1,6 +1,8 @@
 package cz.cvut.fit.prl.scalaimplicit.core.runners
 
-import java.nio.file.Files
+import java.nio.file.{Files, Path}
+import java.security.MessageDigest
+import java.util.concurrent.atomic.AtomicInteger
 
 import com.typesafe.scalalogging.LazyLogging
 import org.langmeta.internal.io.PathIO
@@ -17,8 +19,7 @@ trait SemanticDBProcessing[A] {
 }
 
 object TreeWalker extends LazyLogging {
-  def apply[A](rootPath: String, processing: SemanticDBProcessing[A]): A = {
-
+  private def semanticdbFiles(rootPath: String): Seq[Path] = {
     val root = AbsolutePath(rootPath)
     logger.debug(s"Analyzing ${rootPath}")
     import scala.collection.JavaConverters.asScalaIteratorConverter
@@ -33,7 +34,10 @@ object TreeWalker extends LazyLogging {
         PathIO.extension(file) == "semanticdb"
       }
       .toSeq
-      .par
+  }
+
+  def apply[A](rootPath: String, processing: SemanticDBProcessing[A]): A = {
+    semanticdbFiles(rootPath).par
       .map(file => {
         logger.debug(s"Processing ${file}")
         try {
@@ -46,4 +50,49 @@ object TreeWalker extends LazyLogging {
       })
       .fold(processing.createEmpty)(processing.merge)
   }
+
+  private def shardKey(salt: String, bytes: Array[Byte]): String = {
+    val digest = MessageDigest.getInstance("SHA-1")
+    digest.update(salt.getBytes("UTF-8"))
+    digest.update(bytes)
+    digest.digest().map("%02x".format(_)).mkString
+  }
+
+  /**
+    * Same as apply, but the result of every file is looked up in the shards
+    * first, by the hash of the file and the salt (whatever else the result
+    * depends on), and saved there when it has to be computed.
+    * Files that fail are not saved, and are processed again the next time.
+    */
+  def sharded[A](rootPath: String,
+                 processing: SemanticDBProcessing[A],
+                 shards: ShardStore[A],
+                 salt: String = ""): (A, ShardStats) = {
+    val reused = new AtomicInteger()
+    val recomputed = new AtomicInteger()
+    val result = semanticdbFiles(rootPath).par
+      .map(file => {
+        try {
+          val bytes = Files.readAllBytes(file)
+          val key = shardKey(salt, bytes)
+          shards.load(key) match {
+            case Some(value) =>
+              reused.incrementAndGet()
+              value
+            case None =>
+              logger.debug(s"Processing ${file}")
+              val value = processing.processDB(DBOps.loadDB(bytes))
+              shards.save(key, value)
+              recomputed.incrementAndGet()
+              value
+          }
+        } catch {
+          case e =>
+            logger.warn(s"Unable to process ${file}", e)
+            processing.empty()
+        }
+      })
+      .fold(processing.createEmpty)(processing.merge)
+    (result, ShardStats(reused.get, recomputed.get))
+  }
 }
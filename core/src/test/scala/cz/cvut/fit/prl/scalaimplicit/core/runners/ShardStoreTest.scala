@@ -0,0 +1,93 @@
+package cz.cvut.fit.prl.scalaimplicit.core.runners
+
+import java.nio.file.{Files, Path}
+
+import org.langmeta.internal.semanticdb.{schema => s}
+import org.langmeta.semanticdb.Database
+import org.scalatest.{FunSuite, Matchers}
+
+class ShardStoreTest extends FunSuite with Matchers {
+
+  class IntShards(folder: String) extends FolderShardStore[Int](folder) {
+    override def encode(value: Int): Array[Byte] =
+      value.toString.getBytes("UTF-8")
+    override def decode(bytes: Array[Byte]): Int =
+      new String(bytes, "UTF-8").toInt
+  }
+
+  object CountDocuments extends SemanticDBProcessing[Int] {
+    override def processDB(db: Database): Int = db.documents.size
+    override def createEmpty: Int = 0
+    override def merge(one: Int, other: Int): Int = one + other
+    override def empty(): Int = 0
+  }
+
+  private def writeDB(root: Path, name: String, contents: String): Unit = {
+    val db = s.Database(
+      Seq(
+        s.Document(filename = s"$name.scala",
+                   contents = contents,
+                   language = "Scala212")))
+    Files.write(root.resolve(s"$name.semanticdb"), db.toByteArray)
+  }
+
+  test("Shards are saved and loaded by key") {
+    val shards = new IntShards(Files.createTempDirectory("shards").toString)
+    shards.load("abcdef") shouldBe None
+    shards.save("abcdef", 42)
+    shards.load("abcdef") shouldBe Some(42)
+    shards.save("abcdef", 43)
+    shards.load("abcdef") shouldBe Some(43)
+  }
+
+  test("Shards that can not be decoded are not loaded") {
+    val folder = Files.createTempDirectory("shards")
+    val shards = new IntShards(folder.toString)
+    Files.createDirectories(folder.resolve("ab"))
+    Files.write(folder.resolve("ab").resolve("abcdef"), "x".getBytes("UTF-8"))
+    shards.load("abcdef") shouldBe None
+  }
+
+  test("Only the files that changed are processed again") {
+    val root = Files.createTempDirectory("semanticdb")
+    val shards = new IntShards(
+      Files.createTempDirectory("shards").toString)
+    writeDB(root, "A", "object A")
+    writeDB(root, "B", "object B")
+
+    TreeWalker.sharded(root.toString, CountDocuments, shards) shouldBe
+      ((2, ShardStats(0, 2)))
+    TreeWalker.sharded(root.toString, CountDocuments, shards) shouldBe
+      ((2, ShardStats(2, 0)))
+
+    writeDB(root, "B", "object B { val b = 1 }")
+    TreeWalker.sharded(root.toString, CountDocuments, shards) shouldBe
+      ((2, ShardStats(1, 1)))
+  }
+
+  test("Shards are not shared between salts") {
+    val root = Files.createTempDirectory("semanticdb")
+    val shards = new IntShards(
+      Files.createTempDirectory("shards").toString)
+    writeDB(root, "A", "object A")
+
+    TreeWalker.sharded(root.toString, CountDocuments, shards, "one") shouldBe
+      ((1, ShardStats(0, 1)))
+    TreeWalker.sharded(root.toString, CountDocuments, shards, "two") shouldBe
+      ((1, ShardStats(0, 1)))
+    TreeWalker.sharded(root.toString, CountDocuments, shards, "one") shouldBe
+      ((1, ShardStats(1, 0)))
+  }
+
+  test("Files that fail are not saved") {
+    val root = Files.createTempDirectory("semanticdb")
+    val shards = new IntShards(
+      Files.createTempDirectory("shards").toString)
+    Files.write(root.resolve("broken.semanticdb"), Array[Byte](-1, -1, -1))
+
+    TreeWalker.sharded(root.toString, CountDocuments, shards) shouldBe
+      ((0, ShardStats(0, 0)))
+    TreeWalker.sharded(root.toString, CountDocuments, shards) shouldBe
+      ((0, ShardStats(0, 0)))
+  }
+}
@@ -2,7 +2,9 @@ package cz.cvut.fit.prl.scalaimplicit.counter
 
 import java.nio.file.{Paths, Files}
 
-case class CliConfig(root: String = "Nodir", outdir: String = "Nodir")
+case class CliConfig(root: String = "Nodir",
+                     outdir: String = "Nodir",
+                     shards: Option[String] = None)
 object Cli {
   def apply(args: Array[String]): Option[CliConfig] = {
     val optParser = new scopt.OptionParser[CliConfig]("collector") {
@@ -24,6 +26,9 @@ object Cli {
         )
         .action((x, c) => c.copy(outdir = x))
         .text("The desired place to output the files")
+      opt[String]("shards")
+        .action((x, c) => c.copy(shards = Some(x)))
+        .text("A folder to keep the results of every file between runs")
     }
 
     optParser.parse(args, CliConfig())
@@ -4,6 +4,8 @@ import java.nio.file.{Files, Paths}
 
 import com.typesafe.scalalogging.LazyLogging
 import cz.cvut.fit.prl.scalaimplicit.core.runners.{
+  FolderShardStore,
+  JobServer,
   SemanticDBProcessing,
   TreeWalker
 }
@@ -18,17 +20,36 @@ object Main extends LazyLogging {
     s"${header}\n${values}"
   }
 
+  def run(conf: CliConfig): Unit = {
+    logger.debug(s"Root: ${conf.root}")
+    val res = conf.shards match {
+      case Some(folder) =>
+        val (res, stats) =
+          TreeWalker.sharded(conf.root, CountCallSites, new CallSiteShards(folder))
+        stats.toFile(conf.outdir + "/callsite-shards.csv")
+        res
+      case None => TreeWalker(conf.root, CountCallSites)
+    }
+    Files.write(Paths.get(conf.outdir + "/callsite-counts.csv"),
+                toCSV(res).getBytes)
+  }
+
   def main(args: Array[String]): Unit = {
-    val config = Cli(args)
-    config match {
-      case Some(conf) => {
-        logger.debug(s"Root: ${conf.root}")
-        val res = TreeWalker(conf.root, CountCallSites)
-        Files.write(Paths.get(conf.outdir + "/callsite-counts.csv"),
-                    toCSV(res).getBytes)
+    if (args.headOption.contains("--serve")) {
+      JobServer { jobArgs =>
+        Cli(jobArgs) match {
+          case Some(conf) => run(conf)
+          case None =>
+            throw new IllegalArgumentException(
+              s"Invalid arguments: ${jobArgs.mkString(" ")}")
+        }
       }
-      case None => {
-        println("No arguments found. Closing")
+    } else {
+      Cli(args) match {
+        case Some(conf) => run(conf)
+        case None => {
+          println("No arguments found. Closing")
+        }
       }
     }
   }
@@ -38,6 +59,27 @@ case class FileCount(file: String, syntactic: Int, synthetic: Int) {
   val toCSV = s"${file},${syntactic},${synthetic}"
 }
 
+/**
+  * The counts of every semanticdb file, as the lines of callsite-counts.csv.
+  * File names are taken as the part before the last two commas.
+  */
+class CallSiteShards(folder: String)
+    extends FolderShardStore[Seq[FileCount]](folder) {
+  override def encode(value: Seq[FileCount]): Array[Byte] =
+    value.map(_.toCSV).mkString("\n").getBytes("UTF-8")
+
+  override def decode(bytes: Array[Byte]): Seq[FileCount] =
+    new String(bytes, "UTF-8")
+      .split("\n")
+      .toSeq
+      .filter(_.nonEmpty)
+      .map { line =>
+        val Array(synthetic, syntactic, file) =
+          line.reverse.split(",", 3).map(_.reverse)
+        FileCount(file, syntactic.toInt, synthetic.toInt)
+      }
+}
+
 object CountCallSites extends SemanticDBProcessing[Seq[FileCount]] {
   private def hasJVMSignaure(name: ResolvedName): Boolean = {
     name.symbol.syntax.contains("(") && name.symbol.syntax.contains(")")
@@ -0,0 +1,31 @@
+package cz.cvut.fit.prl.scalaimplicit.counter
+
+import java.nio.file.Files
+
+import org.scalatest.{FunSuite, Matchers}
+
+class CallSiteShardsTest extends FunSuite with Matchers {
+  private val shards =
+    new CallSiteShards(Files.createTempDirectory("shards").toString)
+
+  test("Counts are decoded from the lines of callsite-counts.csv") {
+    shards.decode("A.scala,2,1\nB.scala,0,3\n".getBytes("UTF-8")) should contain theSameElementsInOrderAs Seq(
+      FileCount("A.scala", 2, 1),
+      FileCount("B.scala", 0, 3))
+  }
+
+  test("File names are the part before the last two commas") {
+    shards.decode("src/a,b.scala,5,4".getBytes("UTF-8")) should contain only FileCount(
+      "src/a,b.scala",
+      5,
+      4)
+  }
+
+  test("Counts are saved and loaded") {
+    val counts = Seq(FileCount("a,b.scala", 1, 2), FileCount("C.scala", 3, 4))
+    shards.save("abcdef", counts)
+    shards.load("abcdef") shouldBe Some(counts)
+    shards.save("empty", Seq())
+    shards.load("empty") shouldBe Some(Seq())
+  }
+}
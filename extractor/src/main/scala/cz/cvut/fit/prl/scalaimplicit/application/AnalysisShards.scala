@@ -0,0 +1,20 @@
+package cz.cvut.fit.prl.scalaimplicit.application
+
+import cz.cvut.fit.prl.scalaimplicit.core.extractor.ImplicitAnalysisResult
+import cz.cvut.fit.prl.scalaimplicit.core.runners.FolderShardStore
+import cz.cvut.fit.prl.scalaimplicit.schema.AnalysisShard
+
+/**
+  * The call sites and declarations of every semanticdb file, as one
+  * AnalysisShard message per file.
+  */
+class AnalysisShards(folder: String)
+    extends FolderShardStore[ImplicitAnalysisResult](folder) {
+  override def encode(value: ImplicitAnalysisResult): Array[Byte] =
+    AnalysisShard(value.callSites, value.declarations.toSeq).toByteArray
+
+  override def decode(bytes: Array[Byte]): ImplicitAnalysisResult = {
+    val shard = AnalysisShard.parseFrom(bytes)
+    ImplicitAnalysisResult(shard.callSites, shard.declarations.toSet)
+  }
+}
@@ -1,43 +1,79 @@
 package cz.cvut.fit.prl.scalaimplicit.application
 
 import java.io.{File, FileInputStream}
+import java.util.zip.GZIPInputStream
 import java.net.{URL, URLClassLoader}
 
 import com.typesafe.scalalogging.LazyLogging
 
-import cz.cvut.fit.prl.scalaimplicit.core.cli.Cli
+import cz.cvut.fit.prl.scalaimplicit.core.cli.{Cli, CliConfig}
 import cz.cvut.fit.prl.scalaimplicit.core.extractor.{ErrorCollection, OrphanCallSites, ReflectExtract}
 import cz.cvut.fit.prl.scalaimplicit.core.extractor.serializers.{JSONSerializer, ProtoSerializer}
-import cz.cvut.fit.prl.scalaimplicit.core.runners.TreeWalker
+import cz.cvut.fit.prl.scalaimplicit.core.runners.{JobServer, TreeWalker}
+import cz.cvut.fit.prl.scalaimplicit.schema.AnalysisRecord
 import io.circe.generic.auto._
 
 import scala.io.Source
 
 object Main extends LazyLogging {
   def loadClasspath(path: String): String = {
-    val src = Source.fromFile(path)(scala.io.Codec("UTF-8"))
+    val src =
+      if (path.endsWith(".gz"))
+        Source.fromInputStream(new GZIPInputStream(new FileInputStream(path)))(scala.io.Codec("UTF-8"))
+      else Source.fromFile(path)(scala.io.Codec("UTF-8"))
     try src.getLines().mkString(":") finally src.close()
   }
 
-  def main(args: Array[String]): Unit = {
-    val config = Cli(args)
-    config match {
-      case Some(conf) => {
-        logger.debug(s"Root: ${conf.root}")
+  def run(conf: CliConfig): Unit = {
+    logger.debug(s"Root: ${conf.root}")
+    ErrorCollection().clear()
+    OrphanCallSites().clear()
 
-        val classpath = loadClasspath(conf.classpath)
-        val extractFunction = new ExtractImplicitsFromCtx(classpath)
-        val res = TreeWalker(conf.root, extractFunction)
-        val matchedDefs = DefnFiller(res)
+    val classpath = loadClasspath(conf.classpath)
+    val extractFunction = new ExtractImplicitsFromCtx(classpath)
+    val res = conf.shards match {
+      case Some(folder) =>
+        // The results of a file also depend on the classpath it is compiled
+        // against: its entries, and the contents of its jars and class folders
+        // (the salt given by the pipeline)
+        val (res, stats) =
+          TreeWalker.sharded(conf.root,
+                             extractFunction,
+                             new AnalysisShards(folder),
+                             classpath + "\n" + conf.shardSalt)
+        stats.toFile(conf.outdir + "/analyzer-shards.csv")
+        res
+      case None => TreeWalker(conf.root, extractFunction)
+    }
+    val matchedDefs = DefnFiller(res)
 
-        ProtoSerializer.save(matchedDefs.callSites, conf.outdir + "/results-callsites.proto")
-        ProtoSerializer.save(matchedDefs.declarations.toSeq, conf.outdir + "/results-declarations.proto")
+    // A single stream of records, split by kind by the pipeline without decoding them
+    val records =
+      matchedDefs.callSites.view.map(x => AnalysisRecord(AnalysisRecord.Element.CallSite(x))) ++
+        matchedDefs.declarations.toSeq.view.map(x => AnalysisRecord(AnalysisRecord.Element.Declaration(x)))
+    val suffix = if (conf.compress) ".gz" else ""
+    ProtoSerializer.save(records, conf.outdir + "/results.proto" + suffix).get
+    if (conf.json) JSONSerializer.saveJSON(matchedDefs, conf.outdir + "/results.json" + suffix)
 
-        ErrorCollection().toFile(conf.outdir + "/errors.log")
-        OrphanCallSites().toFile(conf.outdir + "/orphan-callsites.log")
+    ErrorCollection().toFile(conf.outdir + "/errors.log")
+    OrphanCallSites().toFile(conf.outdir + "/orphan-callsites.log")
+  }
+
+  def main(args: Array[String]): Unit = {
+    if (args.headOption.contains("--serve")) {
+      JobServer { jobArgs =>
+        Cli(jobArgs) match {
+          case Some(conf) => run(conf)
+          case None =>
+            throw new IllegalArgumentException(s"Invalid arguments: ${jobArgs.mkString(" ")}")
+        }
       }
-      case None => {
-        println("No arguments found. Closing")
+    } else {
+      Cli(args) match {
+        case Some(conf) => run(conf)
+        case None => {
+          println("No arguments found. Closing")
+        }
       }
     }
   }
@@ -1,6 +1,7 @@
 package cz.cvut.fit.prl.scalaimplicit.queries
 
 import cz.cvut.fit.prl.scalaimplicit.core.extractor.ImplicitAnalysisResult
+import cz.cvut.fit.prl.scalaimplicit.core.extractor.serializers.ProtoSerializer
 import cz.cvut.fit.prl.scalaimplicit.core.reports._
 import cz.cvut.fit.prl.scalaimplicit.matcher._
 import cz.cvut.fit.prl.scalaimplicit.queries.OutputHelper.{CallSiteReporter, DeclarationReporter, ProjectReporter}
@@ -15,19 +16,18 @@ object PredefinedQueries extends Matchers with SchemaMatchers {
 
   private case class QueryResult[A](result: Seq[A], metadata: ProjectMetadata)
   private def queryDeclarations(
-      matcher: Matcher[Declaration]): Seq[QueryResult[Declaration]] = ???
-  // TODO Translate to protobuf if needed
-  /*
-  {
+      matcher: Matcher[Declaration]): Seq[QueryResult[Declaration]] = {
     DATASET.projects.par
       .map(
         project =>
           QueryResult(
-            JsonQuery.query(project.definitionsFile, matcher),
+            ProtoSerializer
+              .load[Declaration](project.definitionsFile)
+              .get
+              .filter(matcher.test),
             ProjectMetadata.loadFromCSV(project.metadata, project.paths)))
       .seq
   }
-  */
 
   private def printDeclarations(results: Seq[QueryResult[Declaration]],
                                 destination: String): Unit = {
@@ -43,39 +43,24 @@ object PredefinedQueries extends Matchers with SchemaMatchers {
   }
 
   private def queryCallSites(
-      matcher: Matcher[CallSite]): Seq[QueryResult[CallSite]] = ???
-  // TODO Translate to protobuf if needed
-  /*
-  {
-    DATASET.projects.par
-      .map(
-        project => {
-          println(project)
-          QueryResult(
-            JsonQuery.query(project.callSitesFile, matcher),
-            ProjectMetadata.loadFromCSV(project.metadata, project.paths))
-        }
-      )
-      .seq
-  }
-  */
+      matcher: Matcher[CallSite]): Seq[QueryResult[CallSite]] =
+    queryCallSitesWithMetadata(_ => matcher)
 
   private def queryCallSitesWithMetadata(
       matcher: (ProjectMetadata) => Matcher[CallSite])
-    : Seq[QueryResult[CallSite]] = ???
-  // TODO Translate to protobuf if needed
-   /*
-   {
+    : Seq[QueryResult[CallSite]] = {
     DATASET.projects.par
       .map(project => {
         val metadata =
           ProjectMetadata.loadFromCSV(project.metadata, project.paths)
-        QueryResult(JsonQuery.query(project.callSitesFile, matcher(metadata)),
+        QueryResult(ProtoSerializer
+                      .load[CallSite](project.callSitesFile)
+                      .get
+                      .filter(matcher(metadata).test),
                     metadata)
       })
       .seq
   }
-  */
 
   private def printCallSites(results: Seq[QueryResult[CallSite]],
                              destination: String): Unit = {
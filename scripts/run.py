@@ -1,52 +1,212 @@
 #!/usr/bin/python3
 
 import argparse
+import atexit
+import collections
 import json
 import os
+import re
+import select
+import shlex
 import shutil
+import signal
 import sys
-from fabric.api import task, abort, lcd, get, settings
-from fabric.api import local as fablocal
+import socket
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+import uuid
+from fabric.api import task, abort, get
 from fabric.contrib.console import confirm
 from fabric.contrib import files
 import csv
+import functools
 import subprocess
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from termcolor import colored
 import datetime
+import fcntl
+import gzip
+import hashlib
+import http.client
+import io
+import math
 
 BASE_CONFIG = {
     "debug_info": True,
     "projects_dest": "./projects",
     "default_location_depth": 0,
-    "temporal_git_repo_storage": "_gitrepotmp",
+    # Bare mirrors of the repositories given by url to create_project_info
+    "git_mirrors_folder": "_git_mirrors",
+    # GitHub stars are kept in a store shared by all the projects, and fetched
+    # again once older than github_metadata_ttl seconds (None: never). Offline,
+    # projects missing from the store get gh_stars -1.
+    "github_api_url": "https://api.github.com",
+    "github_metadata_store": "github-metadata.sqlite",
+    "github_metadata_ttl": 30 * 24 * 3600,
+    "github_offline": False,
 
     "force_recompile_on_fail": False,
     "allow_partial_semanticdb_files": False,
     "max_backwards_steps": 5,
+    # "sequential" compiles one tag at a time in the project, "parallel" compiles
+    # several tags at once in separate git worktrees
+    "compile_strategy": "sequential",
+    "compile_parallel_jobs": 2,
 
     "supported_build_systems": [
         "sbt"
     ],
+    # A project uses a build system if it has a file ending with its marker
+    "build_system_markers": [
+        ("maven", "pom.xml"),
+        ("sbt", ".sbt"),
+        ("gradle", "gradle")
+    ],
+    # Not searched for markers: build outputs and VCS metadata
+    "build_scan_excluded_folders": ["target", ".git", "node_modules"],
 
     "tools_dir": "tools",
     "tools_base_url": "https://raw.githubusercontent.com/PRL-PRG/scalafix-rule-workshop/master/scripts/",
     "analyzer_name": "implicit-analyzer.jar",
     "callsite_counter_name": "callsite-counter.jar",
-    "analyzer_jvm_options": "-Xmx2g",
+    # The -Xmx of analyzer_jvm_options is also the memory planned per job by
+    # run_corpus. With jvm_heap_sizing, every project gets a heap of base +
+    # semanticdb_factor * its semanticdb bytes + classpath_entry * its classpath
+    # entries, within min and max. Tools that run out of memory are run once more
+    # with oom_retry_factor times the heap. Timeouts are in seconds, or None.
+    "analyzer_jvm_options": "-Xmx2g -XX:+ExitOnOutOfMemoryError",
+    "callsite_counter_jvm_options": "-Xmx2g -XX:+ExitOnOutOfMemoryError",
+    "jvm_heap_sizing": {
+        "base": "512m",
+        "semanticdb_factor": 8,
+        "classpath_entry": "4m",
+        "min": "512m",
+        "max": "16g",
+        "oom_retry_factor": 2
+    },
+    # Runs the analyzer and the call site counter in long-lived JVMs (one per
+    # tool and corpus job, with the given heap), recycled after max_jobs projects
+    # or above max_rss. Projects that need a larger heap, or on which the JVM
+    # dies, get a JVM of their own. None to start a JVM for every project.
+    "jvm_daemon": None,
+    # "jvm_daemon": {"heap": "2g", "max_jobs": 200, "max_rss": "3g"},
+    "analyzer_timeout": 4 * 3600,
+    "callsite_counter_timeout": 2 * 3600,
+    # Memory each corpus job needs on top of the heap of its tool JVM (sbt, JVM overhead)
+    "corpus_job_memory_overhead": "1g",
+    # Phases run for every project by run_corpus. Their dependencies are run too.
+    "corpus_phases": ["analyze", "extract_paths", "count_callsites", "split_analysis_results"],
+    # Workers of run_worker, on any number of nodes, share the projects through
+    # lease files in this folder, which must be on the filesystem they share.
+    # A lease is renewed every heartbeat seconds, and taken over by another
+    # worker when it was not renewed for ttl seconds (mind the clock skew
+    # between the nodes).
+    "worker_leases": {
+        "folder": "_leases",
+        "heartbeat": 60,
+        "ttl": 600
+    },
 
     "sbt_plugins": ["scalameta-config"],
+    # "batch" boots sbt for every command, "session" keeps one sbt shell per project
+    "sbt_driver": "batch",
+    "sbt_options": ["-Dsbt.log.noformat=true", "-Dsbt.supershell=false"],
+    # Seconds an sbt command may take before sbt is killed, None for no limit
+    "sbt_command_timeout": 2 * 3600,
+    # With the batch driver, get the classpath, source paths and semanticdb from one sbt launch
+    "sbt_combined_run": False,
     "sbt_versions": ["0.13", "1.0"],
 
+    # The lines of the project by language, like cloc --csv. total_loc in
+    # project.csv is the code of all the languages, without the SUM row, which
+    # project.csv files from before the store doubled: create them again
+    # before merging them with newer ones.
     "cloc_report": "sloc.csv",
+    # Lines of every file counted by cloc, by git blob hash, for all the projects
+    "sloc_store": "sloc-store.sqlite",
+    "sloc_excluded_folders": ["target", "node_modules", ".bloop", ".metals", ".idea"],
+    # cloc --processes (needs Parallel::ForkManager), None for one per core
+    "sloc_processes": None,
+    # The analyzer writes its results as length-delimited protobuf records
+    # (results.proto). Also write them as JSON (results.json), split like the
+    # records by split_analysis_results. Needs tools built with --json; the
+    # readers of the results (manifest, queries) read the split records.
+    # Older tools write results.json, or the split records themselves.
+    "results_json": False,
+    # Also write the split JSON results as newline-delimited JSON (one element per line)
+    "split_results_ndjson": False,
+
+    # Results are cached by commit, tool and configuration, evicting the least
+    # recently used entries above max_size. Set the folder to None to disable.
+    "result_cache": {
+        "folder": "_result_cache",
+        "max_size": "20g"
+    },
+    # The analyzer and the call site counter keep the results of every
+    # semanticdb file in this folder, shared by all the projects, by the hash
+    # of the file, and only process the files that changed. It is outside of
+    # the reports, which are removed to run a phase again. Needs tools built
+    # with --shards. None to disable.
+    "result_shards_folder": None,
+    # "result_shards_folder": "_result_shards",
 
     "condensed_report_merged": "condensed-report.all.csv",
     "project_metadata_merged": "project-metadata.all.csv",
     "sloc_merged": "slocs.all.csv",
     "paths_merged": "paths.all.csv",
     "callsite_counts_merged": "callsite-counts.all.csv",
+    "callsites_merged": "results-callsites.all.proto",
+    "declarations_merged": "results-declarations.all.proto",
+    "results_merged_index": "results.all.index.csv",
+    # Typed copy of the merged files for the analyses: None, "parquet" (needs
+    # pyarrow), "sqlite" (into columnar_database), or "auto" for parquet when available
+    "columnar_format": None,
+    "columnar_database": "merged.sqlite",
+    # The call sites and declarations of all the projects, see index_results
+    "results_index": "results.sqlite",
+    "columnar_integer_columns": [
+        "code", "blank", "comment", "files", "total_loc", "scala_loc", "gh_stars", "insource", "synthetic"
+    ],
+    # Where merges remember their inputs, to re-read only the ones that changed
+    "merge_index_folder": "_merge_index",
+    "merge_jobs": 8,
 
     "reports_folder": "_reports",
     "phase_reports_folder": "_phases",
+    # Status, time and duration of every phase, per project (in the phase reports
+    # folder) and for the whole corpus (appended to by every project)
+    "phase_reports_index": "index.json",
+    "corpus_reports_index": "reports-index.jsonl",
+    # Time, CPU, memory and file sizes of every command and phase, appended to
+    # by every project. None to disable it.
+    "trace_file": "trace.jsonl",
+    # The output of long commands (sbt, the JVM tools) goes to logs in the
+    # reports folder of the project, rotated above max_size. Only the last
+    # tail_lines lines are kept in memory, for the command reports.
+    "command_logs": {
+        "folder": "logs",
+        "max_size": "64m",
+        "backups": 1,
+        # Rotated logs are gzipped (<log>.1.gz), the current one stays plain
+        "compress_backups": True,
+        "tail_lines": 500
+    },
+    # The large artifacts are written gzipped, as <name>.gz. Every reader takes
+    # either version. Needs tools built with --compress. None to write them
+    # all plain.
+    "compressed_artifacts": None,
+    # "compressed_artifacts": {
+    #     "level": 1,
+    #     "names": ["results.proto", "results.json",
+    #               "results-callsites.proto", "results-declarations.proto",
+    #               "results-callsites.json", "results-declarations.json",
+    #               "results-callsites.ndjson", "results-declarations.ndjson",
+    #               "classpath.dat", "classpath.json"]
+    # },
     "phase_reports": {
         "compilation_report": "COMPILATION_REPORT.TXT",
         "semanticdb_report": "SEMANTICDB_REPORT.TXT",
@@ -71,25 +231,373 @@ def raw(stdout, stderr):
     sys.stdout.write(stdout + '\n')
     sys.stderr.write(stderr + '\n')
 
+# (project path, HEAD commit) -> build systems
+_build_systems = {}
+
+# The trace record of the phase run by the current thread, see call_phase
+_trace_context = threading.local()
+
+# The process groups of the commands, sbt shells and JVM daemons running in
+# this process. They are killed, and no more reports are written, once a
+# worker lost the lease of the project it runs (see ProjectLease.renew).
+_process_groups = set()
+_process_groups_lock = threading.Lock()
+_lease_lost = threading.Event()
+
+class LeaseLost(Exception):
+    pass
+
+def register_process_group(pid):
+    with _process_groups_lock:
+        _process_groups.add(pid)
+    if _lease_lost.is_set():
+        kill_process_groups()
+
+def unregister_process_group(pid):
+    with _process_groups_lock:
+        _process_groups.discard(pid)
+
+def kill_process_groups():
+    with _process_groups_lock:
+        pids = list(_process_groups)
+    for pid in pids:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+def append_trace(record):
+    # One write of the whole line on a file opened with O_APPEND, so that the
+    # lines of concurrent jobs never interleave, whatever their length
+    if BASE_CONFIG["trace_file"] is not None:
+        fd = os.open(BASE_CONFIG["trace_file"], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(record) + "\n").encode("utf-8"))
+        finally:
+            os.close(fd)
+
+def trace_command(command, directory, start, usage, result, output_bytes):
+    # usage is the rusage of the command alone (from wait4), also added to its
+    # phase. output_bytes are the sizes of the whole stdout and stderr.
+    phase = getattr(_trace_context, "phase", None)
+    if phase is not None:
+        phase["user_cpu"] += usage.ru_utime
+        phase["system_cpu"] += usage.ru_stime
+        phase["max_rss_kb"] = max(phase["max_rss_kb"], usage.ru_maxrss)
+        phase["commands"] += 1
+    append_trace({
+        "kind": "command",
+        "project": phase["project"] if phase is not None else None,
+        "phase": phase["phase"] if phase is not None else None,
+        "command": command,
+        "directory": os.path.abspath(directory),
+        "timestamp": start,
+        "wall": time.time() - start,
+        "user_cpu": usage.ru_utime,
+        "system_cpu": usage.ru_stime,
+        "max_rss_kb": usage.ru_maxrss,
+        "return_code": result.return_code,
+        "stdout_bytes": output_bytes[0],
+        "stderr_bytes": output_bytes[1]
+    })
+
+# The resources of a command, as the fields of rusage that are traced
+ProcessUsage = collections.namedtuple("ProcessUsage", ["ru_utime", "ru_stime", "ru_maxrss"])
+
+def get_process_usage(pid):
+    # CPU seconds of the process and of its children it reaped, and its peak
+    # RSS in KB, from /proc. Zero once it is gone.
+    try:
+        with open("/proc/%d/stat" % pid) as stat_file:
+            stat = stat_file.read()
+        # The fields after the command name, which may have spaces, start at the state (3rd)
+        fields = stat[stat.rindex(")") + 2:].split()
+        ticks = float(os.sysconf("SC_CLK_TCK"))
+        user = (int(fields[11]) + int(fields[13])) / ticks
+        system = (int(fields[12]) + int(fields[14])) / ticks
+        peak_rss = 0
+        with open("/proc/%d/status" % pid) as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    peak_rss = int(line.split()[1])
+        return ProcessUsage(user, system, peak_rss)
+    except (IOError, OSError, ValueError, IndexError):
+        return ProcessUsage(0.0, 0.0, 0)
+
+def trace_process_command(command, directory, pid, start, before, result, output_bytes):
+    # A command run by a long-lived process (sbt session, JVM daemon), which
+    # is never reaped by the command: its usage is what the process used
+    # meanwhile, and the peak RSS of the process so far
+    after = get_process_usage(pid)
+    usage = ProcessUsage(max(0.0, after.ru_utime - before.ru_utime), max(0.0, after.ru_stime - before.ru_stime),
+                         max(after.ru_maxrss, before.ru_maxrss))
+    trace_command(command, directory, start, usage, result, (output_bytes, len(result.stderr)))
+
+def get_files_size(project_path, paths):
+    paths = [find_artifact(os.path.join(project_path, path)) for path in paths]
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+def is_compressed_artifact(path):
+    config = BASE_CONFIG["compressed_artifacts"]
+    return config is not None and os.path.basename(path) in config["names"]
+
+def find_artifact(path):
+    # The artifact as stored, plain or gzipped. The path itself when there is
+    # neither, or when it already names the gzipped version.
+    if not os.path.exists(path) and os.path.exists(path + ".gz"):
+        return path + ".gz"
+    return path
+
+def open_gzip(path, mode, compresslevel=9, **kwargs):
+    # gzip.open without the time in the header, so that the same content is
+    # always the same file (cache keys hash the files)
+    binary = gzip.GzipFile(path, mode.replace('t', ''), compresslevel=compresslevel, mtime=0)
+    return binary if 'b' in mode else io.TextIOWrapper(binary, **kwargs)
+
+def open_artifact(path, mode='r', **kwargs):
+    # Reads the artifact whether it is gzipped or not. Writes it gzipped when
+    # it is one of compressed_artifacts, and removes the other version.
+    if 'r' in mode:
+        path = find_artifact(path)
+        if path.endswith(".gz"):
+            return gzip.open(path, mode if 'b' in mode else mode + 't', **kwargs)
+        return open(path, mode, **kwargs)
+    compressed = is_compressed_artifact(path)
+    stale = path if compressed else path + ".gz"
+    if os.path.exists(stale):
+        os.remove(stale)
+    if compressed:
+        return open_gzip(path + ".gz", mode,
+                         compresslevel=BASE_CONFIG["compressed_artifacts"]["level"], **kwargs)
+    return open(path, mode, **kwargs)
+
+_reports_index_lock = threading.Lock()
+
+def append_corpus_reports(project_path, entries):
+    # One line per entry, written at once so that concurrent jobs do not mix
+    # their lines. No entries means that the reports of the project were removed,
+    # an entry of None that this report was. index_reports rewrites the index
+    # under the same lock.
+    project = os.path.abspath(project_path)
+    if entries is None:
+        lines = [{"project": project, "kind": None}]
+    else:
+        lines = [dict(entry or {"cleared": True}, project=project, kind=kind) for kind, entry in entries]
+    index_path = BASE_CONFIG["corpus_reports_index"]
+    with open(index_path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(index_path, 'a') as index_file:
+            index_file.write("".join(json.dumps(line) + "\n" for line in lines))
+
+class CorpusReportsIndex:
+    # The reports of all the projects, read from the corpus index in one go.
+    # Later lines override earlier ones. Projects the index does not know are
+    # looked up in their folders.
+    def __init__(self, path=BASE_CONFIG["corpus_reports_index"]):
+        self.projects = {}
+        if path is not None and os.path.exists(path):
+            self.read(path)
+
+    def read(self, path, offset=0):
+        # Applies the lines from offset on, returns where they end
+        with open(path) as index_file:
+            index_file.seek(offset)
+            for line in iter(index_file.readline, ""):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Partially written by a job that was killed
+                    continue
+                self.add(entry)
+            return index_file.tell()
+
+    def add(self, entry):
+        reports = self.projects.setdefault(entry["project"], {})
+        if entry["kind"] is None:
+            reports.clear()
+        elif entry.get("cleared"):
+            reports.pop(entry["kind"], None)
+        else:
+            reports[entry["kind"]] = entry
+
+    def write(self, path):
+        # One line per report
+        with open(path, 'w') as index_file:
+            for reports in self.projects.values():
+                for entry in reports.values():
+                    index_file.write(json.dumps(entry) + "\n")
+
+    def read_phase_report(self, project_path, kind):
+        # The index is only trusted while the report file is there: reports
+        # removed by hand, or with the project cloned again, leave no entry
+        # that clears them. The project folder has the word then.
+        P = Pipeline()
+        reports = self.projects.get(os.path.abspath(project_path))
+        if not reports:
+            return P.read_phase_report(project_path, kind)
+        if kind not in reports:
+            return None
+        report_path = os.path.join(P.get_phase_reports_folder(project_path), BASE_CONFIG["phase_reports"][kind])
+        if not os.path.exists(find_artifact(report_path)):
+            return P.read_phase_report(project_path, kind)
+        return reports[kind]["report"]
+
+    def get_entry(self, project_path, kind):
+        return self.projects.get(os.path.abspath(project_path), {}).get(kind)
+
+class CommandResult(str):
+    # Same shape as the result of fabric's local(): the captured stdout,
+    # with the stderr and the exit status as attributes. When the output went to
+    # a log, stdout and stderr are only its last lines.
+    def __new__(cls, stdout, stderr, return_code, timed_out=False, log_path=None):
+        result = str.__new__(cls, stdout)
+        result.stdout = stdout
+        result.stderr = stderr
+        result.return_code = return_code
+        result.timed_out = timed_out
+        result.log_path = log_path
+        result.failed = return_code != 0
+        result.succeeded = not result.failed
+        return result
+
+class RotatingLog:
+    # A log file that is moved to <path>.1 (and <path>.1 to <path>.2, and so
+    # on) when it grows above max_size, and when it is opened again. The
+    # backups are gzipped (<path>.1.gz) if compress_backups.
+    def __init__(self, path):
+        config = BASE_CONFIG["command_logs"]
+        self.path = path
+        self.max_size = parse_memory_size(config["max_size"])
+        self.backups = config["backups"]
+        self.suffix = ".gz" if config.get("compress_backups") else ""
+        self.lock = threading.Lock()
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.rotate()
+
+    def rotate(self):
+        if os.path.exists(self.path):
+            backup = lambda i: "%s.%d%s" % (self.path, i, self.suffix)
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(backup(i)):
+                    os.replace(backup(i), backup(i + 1))
+            if self.backups > 0 and self.suffix:
+                with open(self.path, 'rb') as log, open_gzip(backup(1) + ".tmp", 'wb', compresslevel=1) as compressed:
+                    shutil.copyfileobj(log, compressed, 1 << 20)
+                os.replace(backup(1) + ".tmp", backup(1))
+            elif self.backups > 0:
+                os.replace(self.path, backup(1))
+        self.file = open(self.path, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        with self.lock:
+            if self.size > 0 and self.size + len(data) > self.max_size:
+                self.file.close()
+                self.rotate()
+            self.file.write(data)
+            self.size += len(data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
 class Pipeline():
-    def local(self, command, directory, verbose=False):
-        with lcd(directory):
-            res = fablocal(command, capture=True)
-            if verbose:
-                raw(str(res.stdout), str(res.stderr))
-            return res
+    # Runs the command in `directory` without going through fabric's lcd() and
+    # settings(), which change global state and cannot be used from several threads
+    # After timeout seconds, the command and the processes it started are
+    # killed, as they are when the caller is interrupted. on_line is called
+    # with every line of the output as soon as it is printed. With a log_path,
+    # the output goes to that log and only its tail is kept in the result.
+    # on_start gets the process, which leads its own process group, so that
+    # the caller can cancel it with os.killpg while its returncode is None.
+    def local(self, command, directory, verbose=False, warn_only=False, timeout=None, on_line=None, log_path=None,
+              on_start=None):
+        start = time.time()
+        process = subprocess.Popen(command, shell=True, cwd=directory, executable="/bin/bash",
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   start_new_session=True)
+        register_process_group(process.pid)
+        if on_start is not None:
+            on_start(process)
+        timed_out = threading.Event()
+        def kill():
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        def expire():
+            timed_out.set()
+            kill()
+        timer = threading.Timer(timeout, expire) if timeout is not None else None
+        if timer is not None:
+            timer.daemon = True
+            timer.start()
+        log = RotatingLog(log_path) if log_path is not None else None
+        tail_lines = BASE_CONFIG["command_logs"]["tail_lines"] if log is not None else None
+        tails = {stream: collections.deque(maxlen=tail_lines) for stream in (process.stdout, process.stderr)}
+        sizes = {stream: 0 for stream in (process.stdout, process.stderr)}
+        def read(stream):
+            for line in iter(stream.readline, b""):
+                tails[stream].append(line)
+                sizes[stream] += len(line)
+                if log is not None:
+                    log.write(line)
+                if on_line is not None and stream is process.stdout:
+                    on_line(line.decode("utf-8", "replace"))
+        readers = [threading.Thread(target=read, args=(stream,)) for stream in (process.stdout, process.stderr)]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+        try:
+            for reader in readers:
+                reader.join()
+            # Reaped with wait4 rather than wait, to get the resources used by
+            # this command alone while other threads run commands too
+            _, status, usage = os.wait4(process.pid, 0)
+        except BaseException:
+            kill()
+            process.wait()
+            raise
+        finally:
+            unregister_process_group(process.pid)
+            if timer is not None:
+                timer.cancel()
+            if log is not None:
+                log.close()
+        process.returncode = os.waitstatus_to_exitcode(status)
+        res = CommandResult(
+            b"".join(tails[process.stdout]).decode("utf-8", "replace").strip(),
+            b"".join(tails[process.stderr]).decode("utf-8", "replace").strip(),
+            process.returncode,
+            timed_out.is_set(),
+            log_path)
+        trace_command(command, directory, start, usage, res, (sizes[process.stdout], sizes[process.stderr]))
+        if verbose:
+            raw(res.stdout, res.stderr)
+        if res.timed_out and not warn_only:
+            abort("local() timed out after %ss while executing '%s'" % (timeout, command))
+        if res.failed and not warn_only:
+            abort("local() encountered an error (return code %s) while executing '%s'" % (res.return_code, command))
+        return res
 
     def local_canfail(self, name, command, directory, verbose=False):
-        failed = False
-        with settings(warn_only=True):
-            result = self.local(command, directory, verbose=verbose)
-            if result.failed:
-                with lcd(directory):
-                    with open(os.path.join(directory, name.replace(" ", "_")), 'w') as command_report:
-                        command_report.write(result.stdout)
-                        command_report.write(result.stderr)
-                failed = True
-        return failed
+        result = self.local(command, directory, verbose=verbose, warn_only=True)
+        if result.failed:
+            self.write_command_report(name, directory, result)
+        return result.failed
+
+    def write_command_report(self, name, directory, result):
+        with open(os.path.join(directory, name.replace(" ", "_")), 'w') as command_report:
+            command_report.write(result.stdout)
+            command_report.write(result.stderr)
+            if result.log_path is not None:
+                command_report.write("\n[Last lines only, the whole output is in %s]\n" % result.log_path)
+
+    def get_command_log_path(self, project_path, name):
+        return os.path.join(self.get_base_output_folder(project_path), BASE_CONFIG["command_logs"]["folder"],
+                            name.replace(" ", "_") + ".log")
 
     def get_base_output_folder(self, project_path, reports_folder_name=BASE_CONFIG["reports_folder"], create_if_missing=False):
         output_folder = os.path.join(os.getcwd(), project_path, reports_folder_name)
@@ -104,10 +612,34 @@ class Pipeline():
         return report_folder
 
     def read_phase_report(self, project_path, kind):
+        index = self.read_phase_reports_index(project_path)
+        if index is None:
+            return self.read_legacy_phase_report(project_path, kind)
+        return index[kind]["report"] if kind in index else None
+
+    def read_phase_reports_index(self, project_path):
+        index_path = find_artifact(os.path.join(self.get_phase_reports_folder(project_path), BASE_CONFIG["phase_reports_index"]))
+        if not os.path.exists(index_path):
+            return None
+        with open_artifact(index_path) as index_file:
+            return json.load(index_file)
+
+    def read_legacy_phase_reports(self, project_path):
+        reports = {}
+        for kind in BASE_CONFIG["phase_reports"]:
+            report = self.read_legacy_phase_report(project_path, kind)
+            if report is not None:
+                reports[kind] = {"report": report, "timestamp": None, "duration": None}
+        return reports
+
+    # For projects without an index, look for the report files
+    def read_legacy_phase_report(self, project_path, kind):
         def get_report_in(path, kind):
+            if not os.path.isdir(path):
+                return None
             for f in os.listdir(path):
-                if f == BASE_CONFIG["phase_reports"][kind]:
-                    with open(os.path.join(path, f)) as report:
+                if f in (BASE_CONFIG["phase_reports"][kind], BASE_CONFIG["phase_reports"][kind] + ".gz"):
+                    with open_artifact(os.path.join(path, f)) as report:
                         return report.read()
             return None
 
@@ -118,15 +650,54 @@ class Pipeline():
         if res is None: res = get_report_in(project_path, kind)
         return res if res is None else res.strip()
 
-    def write_phase_report(self, content, project_path, kind):
+    def write_phase_report(self, content, project_path, kind, duration=None):
+        if _lease_lost.is_set():
+            raise LeaseLost("The lease of %s was taken over, not writing its %s" % (project_path, kind))
         report_folder = self.get_phase_reports_folder(project_path, create_if_missing=True)
         report_path = os.path.join(report_folder, BASE_CONFIG["phase_reports"][kind])
-        with open(report_path, 'w') as report:
-            return report.write(content)
-
-    def exclude_non_successful(self, projects, report_kind):
+        with _reports_index_lock:
+            index = self.read_phase_reports_index(project_path)
+            updated = [kind]
+            if index is None:
+                # The index starts with the reports written before it existed
+                index = self.read_legacy_phase_reports(project_path)
+                updated += list(index)
+            index[kind] = {"report": content.strip(), "timestamp": time.time(), "duration": duration}
+
+            with open(report_path, 'w') as report:
+                report.write(content)
+            index_path = os.path.join(report_folder, BASE_CONFIG["phase_reports_index"])
+            with open(index_path + ".tmp", 'w') as index_file:
+                json.dump(index, index_file)
+            os.replace(index_path + ".tmp", index_path)
+            append_corpus_reports(project_path, [(k, index[k]) for k in updated])
+
+    def clear_phase_reports(self, project_path):
+        shutil.rmtree(os.path.join(project_path, BASE_CONFIG["reports_folder"]))
+        append_corpus_reports(project_path, None)
+
+    def clear_phase_report(self, project_path, kind):
+        # Removes the report from both indexes, so that its phase runs again
+        report_folder = self.get_phase_reports_folder(project_path)
+        with _reports_index_lock:
+            index = self.read_phase_reports_index(project_path)
+            if index is not None and kind in index:
+                del index[kind]
+                index_path = os.path.join(report_folder, BASE_CONFIG["phase_reports_index"])
+                with open(index_path + ".tmp", 'w') as index_file:
+                    json.dump(index, index_file)
+                os.replace(index_path + ".tmp", index_path)
+            for path in [report_folder, os.path.join(project_path, BASE_CONFIG["reports_folder"]), project_path]:
+                report_path = os.path.join(path, BASE_CONFIG["phase_reports"][kind])
+                for stale in [report_path, report_path + ".gz"]:
+                    if os.path.exists(stale):
+                        os.remove(stale)
+            append_corpus_reports(project_path, [(kind, None)])
+
+    def exclude_non_successful(self, projects, report_kind, index=None):
+        index = index or CorpusReportsIndex()
         return filter(
-            lambda proj: self.read_phase_report(proj, report_kind) == "SUCCESS",
+            lambda proj: index.read_phase_report(proj, report_kind) == "SUCCESS",
             projects
         )
 
@@ -138,32 +709,400 @@ class Pipeline():
         if BASE_CONFIG["debug_info"]:
             error(msg)
 
-    def has_file_with_ending(self, folder, extension):
-        for root, dirs, files in os.walk(folder):
-            for f in files:
-                if f.endswith(extension):
-                    return True
-
-    def get_build_systems(self, project_path):
-        systems = []
-        if self.has_file_with_ending(project_path, "pom.xml"):
-            systems.append("maven")
-        if self.has_file_with_ending(project_path, ".sbt"):
-            systems.append("sbt")
-        if self.has_file_with_ending(project_path, "gradle"):
-            systems.append("gradle")
-        return systems
+    def find_build_systems(self, project_path):
+        # A single breadth-first pass over the project, which stops as soon as
+        # every marker is found
+        markers = BASE_CONFIG["build_system_markers"]
+        excluded = set(BASE_CONFIG["build_scan_excluded_folders"])
+        found = set()
+        folders = collections.deque([project_path])
+        while folders and len(found) < len(markers):
+            try:
+                entries = os.scandir(folders.popleft())
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in excluded:
+                            folders.append(entry.path)
+                    else:
+                        for system, ending in markers:
+                            if entry.name.endswith(ending):
+                                found.add(system)
+        return [system for system, _ in markers if system in found]
+
+    def find_build_systems_in_commit(self, repo_path, commit):
+        # Same as find_build_systems, from the files of a commit, so that it
+        # works on bare repositories
+        markers = BASE_CONFIG["build_system_markers"]
+        excluded = set(BASE_CONFIG["build_scan_excluded_folders"])
+        found = set()
+        files = self.local("git ls-tree -r -z --name-only %s" % commit, repo_path)
+        for path in files.split("\0"):
+            parts = path.split("/")
+            if excluded.isdisjoint(parts[:-1]):
+                for system, ending in markers:
+                    if parts[-1].endswith(ending):
+                        found.add(system)
+        return [system for system, _ in markers if system in found]
+
+    def get_build_systems(self, project_path, commit=None):
+        # Memoized for every commit of git repositories. With a commit, the
+        # files are read from git instead of the working tree.
+        if commit is None:
+            head = self.local("git rev-parse HEAD", project_path, warn_only=True)
+            if head.failed:
+                return self.find_build_systems(project_path)
+            key = (os.path.abspath(project_path), str(head))
+            if key not in _build_systems:
+                _build_systems[key] = self.find_build_systems(project_path)
+        else:
+            key = (os.path.abspath(project_path), str(commit))
+            if key not in _build_systems:
+                _build_systems[key] = self.find_build_systems_in_commit(project_path, commit)
+        return list(_build_systems[key])
 
     def is_build_system_supported(self, src_path):
         project_build_systems = self.get_build_systems(src_path)
         return any(system in BASE_CONFIG["supported_build_systems"] for system in project_build_systems)
 
+####################
+# sbt drivers
+####################
+
+class SbtDriver:
+    # Runs sbt commands on a project. Like Pipeline.local_canfail, the output
+    # of a failed run is written to a report named after it, and on_line gets
+    # the lines of the output as they come.
+    def run(self, name, commands, project_path, verbose=False, on_line=None):
+        log_path = Pipeline().get_command_log_path(project_path, name)
+        result = self.execute(commands, project_path, on_line, log_path)
+        if verbose:
+            raw(result.stdout, result.stderr)
+        if result.failed:
+            Pipeline().write_command_report(name, project_path, result)
+        return result
+
+    def execute(self, commands, project_path, on_line=None, log_path=None):
+        raise NotImplementedError
+
+    # Called when the project is done with, or when its build changed
+    def close(self, project_path):
+        pass
+
+class BatchSbtDriver(SbtDriver):
+    def execute(self, commands, project_path, on_line=None, log_path=None):
+        command = " ".join(["sbt", "-batch"] + BASE_CONFIG["sbt_options"] + [shlex.quote(c) for c in commands])
+        return Pipeline().local(command, project_path, warn_only=True, on_line=on_line, log_path=log_path,
+                                timeout=BASE_CONFIG["sbt_command_timeout"])
+
+class SbtSession:
+    # An interactive sbt shell fed through stdin. Every command line is
+    # followed by markers printed with `eval`: the first one only runs if the
+    # commands succeeded, the second one ends the output of the command line.
+    # The markers are built by concatenation so that sbt echoing the input
+    # cannot be mistaken for them. The output is read in chunks rather than
+    # lines, as the prompt sbt shows when the build fails to load has no end
+    # of line. The shell leads its own process group, killed on timeout.
+    LOAD_FAILURE_PROMPT = b"(r)etry, (q)uit, (l)ast, or (i)gnore?"
+
+    def __init__(self, project_path):
+        self.project_path = project_path
+        self.process = subprocess.Popen(
+            ["sbt"] + BASE_CONFIG["sbt_options"], cwd=project_path,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            bufsize=0, start_new_session=True)
+        register_process_group(self.process.pid)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.process.wait()
+        unregister_process_group(self.process.pid)
+
+    def write(self, text):
+        try:
+            self.process.stdin.write(text.encode("utf-8"))
+            self.process.stdin.flush()
+        except (IOError, ValueError):
+            # sbt exited, what is left of its output tells why
+            pass
+
+    def execute(self, commands, on_line=None, log_path=None, timeout=None):
+        start, before = time.time(), get_process_usage(self.process.pid)
+        self.output_bytes = 0
+        result = self.run_commands(commands, on_line, log_path, timeout)
+        trace_process_command("sbt " + " ;".join(commands), self.project_path, self.process.pid, start, before,
+                              result, self.output_bytes)
+        return result
+
+    def run_commands(self, commands, on_line, log_path, timeout):
+        marker = uuid.uuid4().hex
+        print_marker = lambda status: 'eval println("@@sbt-session-" + "%s %s")' % (marker, status)
+        timeout = BASE_CONFIG["sbt_command_timeout"] if timeout is None else timeout
+        deadline = None if timeout is None else time.time() + timeout
+        self.write(";%s ;%s\n%s\n" % (" ;".join(commands), print_marker("OK"), print_marker("END")))
+
+        log = RotatingLog(log_path) if log_path is not None else None
+        output = collections.deque(maxlen=BASE_CONFIG["command_logs"]["tail_lines"] if log is not None else None)
+        succeeded = False
+        pending = b""
+        stdout = self.process.stdout.fileno()
+        def result(return_code, stderr="", timed_out=False):
+            return CommandResult("".join(output).strip(), stderr, return_code, timed_out=timed_out, log_path=log_path)
+        try:
+            while True:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and (remaining <= 0 or not select.select([stdout], [], [], remaining)[0]):
+                    self.kill()
+                    return result(1, "sbt command timed out after %ds" % timeout, timed_out=True)
+                chunk = os.read(stdout, 1 << 16)
+                if not chunk:
+                    # sbt exited before finishing the commands
+                    return result(1, "sbt session exited")
+                self.output_bytes += len(chunk)
+                pending += chunk
+                *lines, pending = pending.split(b"\n")
+                for raw_line in lines:
+                    line = raw_line.decode("utf-8", "replace") + "\n"
+                    if "@@sbt-session-%s END" % marker in line:
+                        return result(0 if succeeded else 1)
+                    if "@@sbt-session-%s OK" % marker in line:
+                        succeeded = True
+                        continue
+                    output.append(line)
+                    if log is not None:
+                        log.write(raw_line + b"\n")
+                    if on_line is not None:
+                        on_line(line)
+                if self.LOAD_FAILURE_PROMPT in pending:
+                    # It would take the queued commands for answers: quit, sbt exits
+                    output.append(pending.decode("utf-8", "replace") + "\n")
+                    if log is not None:
+                        log.write(pending + b"\n")
+                    pending = b""
+                    self.write("q\n")
+        finally:
+            if log is not None:
+                log.close()
+
+    def close(self):
+        if self.is_alive():
+            try:
+                self.process.stdin.write(b"exit\n")
+                self.process.stdin.close()
+                self.process.wait(timeout=60)
+            except (IOError, subprocess.TimeoutExpired):
+                self.kill()
+        unregister_process_group(self.process.pid)
+
+class SessionSbtDriver(SbtDriver):
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, project_path):
+        key = os.path.abspath(project_path)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None or not session.is_alive():
+                session = SbtSession(project_path)
+                self.sessions[key] = session
+            return session
+
+    def execute(self, commands, project_path, on_line=None, log_path=None):
+        return self.get_session(project_path).execute(commands, on_line, log_path)
+
+    def close(self, project_path):
+        with self.lock:
+            session = self.sessions.pop(os.path.abspath(project_path), None)
+        if session is not None:
+            session.close()
+
+SBT_DRIVERS = {
+    "batch": BatchSbtDriver,
+    "session": SessionSbtDriver
+}
+
+_sbt_driver = None
+_sbt_driver_lock = threading.Lock()
+
+def get_sbt_driver():
+    global _sbt_driver
+    with _sbt_driver_lock:
+        if _sbt_driver is None:
+            _sbt_driver = SBT_DRIVERS[BASE_CONFIG["sbt_driver"]]()
+        return _sbt_driver
+
+def parse_classpath_entries(line):
+    # Entries of `show test:fullClasspath` look like Attributed(/path/to.jar)
+    return [entry for entry in re.findall(r"Attributed\(([^)]*)\)", line) if entry.startswith("/")]
+
+class ClasspathCollector:
+    # Streaming parser of the output of `show test:fullClasspath`. It keeps the
+    # classpath of every module, and the classpath of the project: the entries
+    # of all the modules that exist, without duplicates, in their first order.
+    # Builds with one module print no module headers.
+    MODULE_HEADER = re.compile(r"^\[info\]\s+(\S+?)\s*/\s*(?:test|Test)\s*[:/]\s*fullClasspath$")
+
+    def __init__(self):
+        self.module = ""
+        self.modules = collections.OrderedDict()
+        self.entries = collections.OrderedDict()
+        self.checked = {}
+        self.duplicates = 0
+
+    def feed(self, line):
+        header = self.MODULE_HEADER.match(line.strip())
+        if header is not None:
+            self.module = header.group(1)
+            return
+        for entry in parse_classpath_entries(line):
+            module = self.modules.setdefault(self.module, collections.OrderedDict())
+            module[entry] = None
+            if entry in self.checked:
+                self.duplicates += 1
+            else:
+                self.checked[entry] = os.path.exists(entry)
+                if self.checked[entry]:
+                    self.entries[entry] = None
+
+    def get_missing(self):
+        return [entry for entry, exists in self.checked.items() if not exists]
+
+    def get_fingerprints(self):
+        # Size and modification time of the jars, for the analyzer results to be
+        # cached until they change. Class folders are built from the commit.
+        fingerprints = collections.OrderedDict()
+        for entry in self.entries:
+            if os.path.isfile(entry):
+                stat = os.stat(entry)
+                fingerprints[entry] = [stat.st_size, int(stat.st_mtime)]
+        return fingerprints
+
+    def write(self, project_path):
+        with open_artifact(os.path.join(project_path, "classpath.dat"), 'w') as classpath_file:
+            for entry in self.entries:
+                classpath_file.write(entry + "\n")
+        with open_artifact(os.path.join(project_path, "classpath.json"), 'w') as modules_file:
+            json.dump(collections.OrderedDict([
+                ("modules", collections.OrderedDict((module, list(entries)) for module, entries in self.modules.items())),
+                ("missing", self.get_missing()),
+                ("fingerprints", self.get_fingerprints())
+            ]), modules_file, indent=2)
+
+    def summary(self):
+        return "%d entries (%d duplicates and %d missing left out) in %d modules" % (
+            len(self.entries), self.duplicates, len(self.get_missing()), len(self.modules))
+
+def parse_source_path(line):
+    # Source paths of `<scope>:scalaSource` look like "[info] /path/src/main/scala"
+    fields = line.split()
+    if len(fields) > 1 and fields[1].startswith("/"):
+        return fields[1]
+    return None
+
+def use_combined_sbt_run():
+    return BASE_CONFIG["sbt_combined_run"] and BASE_CONFIG["sbt_driver"] == "batch"
+
+def run_combined_sbt(project_path):
+    # Runs the sbt commands of classpath, extract_paths and gen_sdb in a
+    # single sbt -batch launch. A marker is printed after every section to
+    # split the output. sbt stops at the first failing command, so the
+    # semanticdb compilation goes last and the sections it never reached are
+    # left unreported, for their phases to run on their own.
+    P = Pipeline()
+    project_name = os.path.split(project_path)[1]
+    reports = ["classpath_report", "paths_extraction_report", "semanticdb_report"]
+    if any(P.read_phase_report(project_path, kind) is not None for kind in reports):
+        return
+
+    sections = [
+        ("classpath", ["show test:fullClasspath"]),
+        ("compile", ["compile:scalaSource"]),
+        ("test", ["test:scalaSource"]),
+        ("semanticdb", ["semanticdb", "compile"])
+    ]
+    marker = lambda section: 'eval println("@@sbt-batch-" + "%s")' % section
+    command = ["sbt", "-batch"] + BASE_CONFIG["sbt_options"]
+    for section, commands in sections:
+        command += commands + [marker(section)]
+
+    P.info("[Combined sbt][%s] Running %s" % (project_name, " ".join(shlex.quote(c) for c in command)))
+    output_folder = P.get_base_output_folder(project_path, create_if_missing=True)
+    # The last lines of every section, for the command reports
+    outputs = dict((section, collections.deque(maxlen=BASE_CONFIG["command_logs"]["tail_lines"]))
+                   for section, _ in sections)
+    completed = []
+    classpath = ClasspathCollector()
+    with open(os.path.join(output_folder, "paths.csv"), 'w') as paths_file:
+        paths_file.write("project, path, kind\n")
+        def on_line(line):
+            if len(completed) == len(sections):
+                return
+            section = sections[len(completed)][0]
+            if "@@sbt-batch-%s" % section in line:
+                completed.append(section)
+                return
+            outputs[section].append(line)
+            if section == "classpath":
+                classpath.feed(line)
+            elif section in ("compile", "test"):
+                path = parse_source_path(line)
+                if path is not None:
+                    paths_file.write("%s, %s, %s\n" % (project_name, path, section))
+        result = P.local(" ".join(shlex.quote(c) for c in command) + " 2>&1", project_path, warn_only=True,
+                         on_line=on_line, log_path=P.get_command_log_path(project_path, "Combined sbt"),
+                         timeout=BASE_CONFIG["sbt_command_timeout"])
+    classpath.write(project_path)
+
+    failed_section = None
+    if result.failed and len(completed) < len(sections):
+        failed_section = sections[len(completed)][0]
+
+    def report(kind, report_sections, title):
+        if all(section in completed for section in report_sections):
+            P.write_phase_report("SUCCESS ", project_path, kind)
+        elif failed_section in report_sections:
+            output = "".join(line for section in report_sections for line in outputs[section])
+            P.write_command_report(title, project_path, CommandResult(output, "", result.return_code, log_path=result.log_path))
+            P.write_phase_report("ERROR ", project_path, kind)
+
+    report("classpath_report", ["classpath"], "Classpath generation")
+    report("paths_extraction_report", ["compile", "test"], "Extract paths")
+    report("semanticdb_report", ["semanticdb"], "Generate semanticdb")
+    P.info("[Combined sbt][%s] Completed sections: %s" % (project_name, ", ".join(completed)))
+
+class PhaseResult:
+    def __init__(self, success, payload='', skipped=False):
+        self.success = success
+        self.payload = payload
+        self.skipped = skipped
+
+    @staticmethod
+    def from_report(report):
+        status, _, payload = report.partition(" ")
+        return PhaseResult(status == "SUCCESS", payload, skipped=True)
+
+# Raised by Phase.succeed and Phase.fail to end the running phase
+class PhaseFinished(Exception):
+    def __init__(self, result):
+        Exception.__init__(self, result.payload)
+        self.result = result
+
 class Phase:
     def __init__(self, project_path, phase_name):
         self.project_path = project_path
         self.project_name = os.path.split(project_path)[1]
         self.phase_name = phase_name
         self.P = Pipeline()
+        self.start = time.time()
 
     def info(self, message):
         self.P.info("[%s][%s] %s" % (self.phase_name, self.project_name, message))
@@ -171,41 +1110,295 @@ class Phase:
     def error(self, message):
         self.P.error("[%s][%s] %s" % (self.phase_name, self.project_name, message))
 
-    def depend_on(self, phase):
-        report = self.P.read_phase_report(self.project_path, phase)
-        if report is None:
-            self.error("Dependency %s is None for project %s" % (phase, self.project_path))
-            sys.exit(1)
-        elif report.startswith("SUCCESS"):
-            self.info("Dependency %s met for project %s" % (phase, self.project_path))
-        else:
-            self.error("Dependency %s unmet for project %s" % (phase, self.project_path))
-            sys.exit(1)
-
-
-    def run_and_resume(self, command, error_title ="runAndResume ERROR"):
-        self.info("Running %s" % command)
-        failed = self.P.local_canfail(error_title, command, os.getcwd())
-        if failed:
-            self.error("Failed command %s on project %s" % (command, self.project_path))
-            sys.exit(1)
-
     def stop_if_already_reported(self, phase):
         report = self.P.read_phase_report(self.project_path, phase)
         if report is not None:
             self.info("Phase report found (%s). Skipping" % (report))
-            sys.exit(0 if report.startswith("SUCCESS") else 1)
+            raise PhaseFinished(PhaseResult.from_report(report))
 
     def succeed(self, phase, payload = ''):
         self.info("SUCCESS")
-        self.P.write_phase_report("SUCCESS %s" % payload, self.project_path, phase)
-        sys.exit(0)
+        self.P.write_phase_report("SUCCESS %s" % payload, self.project_path, phase, time.time() - self.start)
+        raise PhaseFinished(PhaseResult(True, str(payload)))
 
     def fail(self, phase, payload = ''):
         self.error("ERROR")
-        self.P.write_phase_report("ERROR %s" % payload, self.project_path, phase)
-        sys.exit(1)
+        self.P.write_phase_report("ERROR %s" % payload, self.project_path, phase, time.time() - self.start)
+        raise PhaseFinished(PhaseResult(False, str(payload)))
+
+####################
+# Result cache
+####################
+
+# What every cached artifact depends on, besides the commit of the project:
+# the tool that produces it, the configuration entries and the project files
+# it reads. `outputs` are the files stored, relative to the project.
+CACHED_ARTIFACTS = {
+    "analyzer": {
+        "tool": "analyzer_name",
+        "config": ["sbt_plugins", "sbt_versions", "allow_partial_semanticdb_files", "results_json"],
+        # classpath.json has the fingerprints of the jars
+        "inputs": ["classpath.dat", "classpath.json"],
+        "outputs": [os.path.join(BASE_CONFIG["reports_folder"], f) for f in [
+            "results.proto", "results.json", "errors.log", "orphan-callsites.log",
+            "results-callsites.proto", "results-declarations.proto"]]
+    },
+    "paths": {
+        "tool": None,
+        "config": ["sbt_versions"],
+        "inputs": [],
+        "outputs": [os.path.join(BASE_CONFIG["reports_folder"], "paths.csv")]
+    },
+    "callsites": {
+        "tool": "callsite_counter_name",
+        "config": ["sbt_plugins", "sbt_versions"],
+        "inputs": [],
+        "outputs": [os.path.join(BASE_CONFIG["reports_folder"], "callsite-counts.csv")]
+    }
+}
 
+_file_hashes = {}
+
+def hash_file(path):
+    # Memoized on the size and modification time, as tools are hashed for every project
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if memo_key not in _file_hashes:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        _file_hashes[memo_key] = digest.hexdigest()
+    return _file_hashes[memo_key]
+
+class ResultCache:
+    def __init__(self, config=BASE_CONFIG["result_cache"]):
+        self.folder = config["folder"]
+        self.max_size = parse_memory_size(config["max_size"])
+
+    def get_commit(self, project_path):
+        report = Pipeline().read_phase_report(project_path, "compilation_report")
+        if report is None or not report.startswith("SUCCESS"):
+            return None
+        revision = PhaseResult.from_report(report).payload or "HEAD"
+        commit = Pipeline().local("git rev-parse %s^{commit}" % revision, project_path, warn_only=True)
+        return None if commit.failed else str(commit)
+
+    def key(self, project_path, artifact, tools_dir=BASE_CONFIG["tools_dir"]):
+        # None when the artifact cannot be cached (no cache, unknown commit or missing inputs)
+        if self.folder is None:
+            return None
+        spec = CACHED_ARTIFACTS[artifact]
+        commit = self.get_commit(project_path)
+        if commit is None:
+            return None
+        parts = [artifact, os.path.abspath(project_path), commit]
+        files = [find_artifact(os.path.join(project_path, f)) for f in spec["inputs"]]
+        if spec["tool"] is not None:
+            files.append(os.path.join(tools_dir, BASE_CONFIG[spec["tool"]]))
+        for path in files:
+            if not os.path.exists(path):
+                return None
+            parts.append(hash_file(path))
+        parts.append(json.dumps([BASE_CONFIG[entry] for entry in spec["config"]], sort_keys=True))
+        return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+    def entry_folder(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def restore(self, project_path, artifact, key):
+        if key is None or not os.path.isdir(self.entry_folder(key)):
+            return False
+        entry = self.entry_folder(key)
+        for output in CACHED_ARTIFACTS[artifact]["outputs"]:
+            for suffix, stale_suffix in [("", ".gz"), (".gz", "")]:
+                cached = os.path.join(entry, os.path.basename(output) + suffix)
+                if os.path.exists(cached):
+                    destination = os.path.join(project_path, output)
+                    if not os.path.exists(os.path.dirname(destination)):
+                        os.makedirs(os.path.dirname(destination))
+                    shutil.copyfile(cached, destination + suffix)
+                    if os.path.exists(destination + stale_suffix):
+                        os.remove(destination + stale_suffix)
+        # The modification time of an entry is its last use
+        os.utime(entry, None)
+        return True
+
+    def store(self, project_path, artifact, key):
+        if key is None or os.path.isdir(self.entry_folder(key)):
+            return
+        entry = self.entry_folder(key)
+        if not os.path.exists(os.path.dirname(entry)):
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+        # Move a complete entry in place, so that concurrent jobs never see a partial one
+        staging = tempfile.mkdtemp(prefix=".%s-" % key, dir=os.path.dirname(entry))
+        for output in CACHED_ARTIFACTS[artifact]["outputs"]:
+            stored = find_artifact(os.path.join(project_path, output))
+            if os.path.exists(stored):
+                shutil.copyfile(stored, os.path.join(staging, os.path.basename(stored)))
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for shard in os.listdir(self.folder):
+            for key in os.listdir(os.path.join(self.folder, shard)):
+                if key.startswith("."):
+                    continue
+                entry = os.path.join(self.folder, shard, key)
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+####################
+# Phase graph
+####################
+
+class PhaseSpec:
+    # inputs and outputs are files of the project, only used to trace their size
+    def __init__(self, function, report, dependencies, uses_sbt, inputs=[], outputs=[]):
+        self.function = function
+        self.report = report
+        self.dependencies = dependencies
+        self.uses_sbt = uses_sbt
+        self.inputs = inputs
+        self.outputs = outputs
+
+# Phase name -> PhaseSpec, filled in by @phase_task
+PHASES = {}
+
+def phase_task(report, dependencies=[], uses_sbt=False, inputs=[], outputs=[], standalone=False):
+    # Registers the decorated function in the phase graph, and exposes it
+    # as a fab task that runs it after its dependencies, or alone if standalone
+    def decorator(function):
+        name = function.__name__
+        PHASES[name] = PhaseSpec(function, report, dependencies, uses_sbt, inputs, outputs)
+
+        @functools.wraps(function)
+        def entry_point(project_path, **options):
+            phase_options = {name: options}
+            if "tools_dir" in options:
+                phase_options["setup"] = {"tools_dest": options["tools_dir"]}
+            results = run_phases(project_path, [name], phase_options, with_dependencies=not standalone)
+            sys.exit(0 if results[name].success else 1)
+
+        return task(entry_point)
+    return decorator
+
+def call_phase(name, project_path, options):
+    # Runs the phase, and traces it with the resources of its commands
+    spec = PHASES[name]
+    trace = {
+        "kind": "phase",
+        "project": os.path.abspath(project_path),
+        "phase": name,
+        "timestamp": time.time(),
+        "user_cpu": 0.0,
+        "system_cpu": 0.0,
+        "max_rss_kb": 0,
+        "commands": 0,
+        "input_bytes": get_files_size(project_path, spec.inputs)
+    }
+    _trace_context.phase = trace
+    try:
+        result = run_phase_function(name, project_path, options)
+    finally:
+        _trace_context.phase = None
+    trace.update(
+        wall=time.time() - trace["timestamp"],
+        success=result.success,
+        output_bytes=get_files_size(project_path, spec.outputs))
+    append_trace(trace)
+    return result
+
+def run_phase_function(name, project_path, options):
+    try:
+        PHASES[name].function(project_path, **options)
+    except PhaseFinished as finished:
+        return finished.result
+    except SystemExit:
+        # abort() after a failed command
+        return PhaseResult(False, "Aborted")
+    except Exception as e:
+        error("[%s][%s] Unexpected error: %r" % (name, os.path.split(project_path)[1], e))
+        return PhaseResult(False, repr(e))
+    return PhaseResult(True)
+
+def run_phases(project_path, targets, options={}, with_dependencies=True):
+    # Runs the target phases and their dependencies on one project, as soon as
+    # their dependencies are met. Phases that drive sbt are never run
+    # concurrently, as they share the build directory.
+    P = Pipeline()
+    project_name = os.path.split(project_path)[1]
+    results = {}
+    pending = []
+
+    def get_dependencies(name):
+        return PHASES[name].dependencies if with_dependencies else []
+
+    def resolve(name):
+        if name in results or name in pending:
+            return
+        spec = PHASES[name]
+        report = P.read_phase_report(project_path, spec.report) if spec.report else None
+        if report is not None:
+            P.info("[%s][%s] Phase report found (%s). Skipping" % (name, project_name, report))
+            results[name] = PhaseResult.from_report(report)
+            return
+        for dependency in get_dependencies(name):
+            resolve(dependency)
+        pending.append(name)
+
+    for target in targets:
+        resolve(target)
+
+    running = {}
+    def schedule(executor):
+        progress = True
+        while progress:
+            progress = False
+            sbt_busy = any(PHASES[name].uses_sbt for name in running.values())
+            for name in list(pending):
+                spec = PHASES[name]
+                if not all(dep in results for dep in get_dependencies(name)):
+                    continue
+                unmet = [dep for dep in get_dependencies(name) if not results[dep].success]
+                if unmet:
+                    P.error("[%s][%s] Unmet dependencies: %s" % (name, project_name, ", ".join(unmet)))
+                    results[name] = PhaseResult(False, "Unmet dependencies: %s" % ", ".join(unmet))
+                    progress = True
+                elif spec.uses_sbt and sbt_busy:
+                    continue
+                else:
+                    running[executor.submit(call_phase, name, project_path, options.get(name, {}))] = name
+                    sbt_busy = sbt_busy or spec.uses_sbt
+                pending.remove(name)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(pending))) as executor:
+            schedule(executor)
+            while running:
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+                schedule(executor)
+    finally:
+        get_sbt_driver().close(project_path)
+    return results
+
+def setup_phase(project_path, tools_dest=BASE_CONFIG["tools_dir"]):
+    # The tools are shared by all the projects
+    setup(tools_dest)
+
+PHASES["setup"] = PhaseSpec(setup_phase, None, [], False)
 
 
 @task
@@ -224,49 +1417,56 @@ def test_analyze(
 
     P = Pipeline()
     P.info("[TEST][Setup] Cleaning up project %s" % project_path)
-    reports_folder = os.path.join(os.getcwd(), project_path, BASE_CONFIG["reports_folder"])
-    P.local_canfail("Cleanup tests", "rm -rf %s && mkdir %s" % (reports_folder, reports_folder), project_path)
-    P.info("[TEST][Setup] Running analysis on %s..." % project_path)
-    P.local("fab analyze:project_path=%s" % project_path, ".")
-    #P.info("[TEST] Counting callsites on %s..." % project_path)
-    #P.local("fab count_callsites:project_path=%s" % project_path, ".")
-    P.info("[TEST][Setup] Extracting paths on %s..." % project_path)
-    P.local("fab extract_paths:project_path=%s" % project_path, ".")
+    if os.path.exists(os.path.join(project_path, BASE_CONFIG["reports_folder"])):
+        P.clear_phase_reports(project_path)
+    P.get_base_output_folder(project_path, create_if_missing=True)
+    P.info("[TEST][Setup] Running analysis and extracting paths on %s..." % project_path)
+    run_phases(project_path, ["analyze", "extract_paths"])
     P.info("[TEST][Setup] Comparing results...")
     for report in BASE_CONFIG["phase_reports"]:
         test_report(report)
 
-@task
+# Run alone as a fab task, it does not compile the project first
+@phase_task("project_info_report", dependencies=["compile"], outputs=["project.csv", BASE_CONFIG["cloc_report"]],
+            standalone=True)
 def create_project_info(
         project_path,
         url=None,
         last_commit=None,
 ):
-    def count_locs(project_path):
-        cloc_report_name = BASE_CONFIG["cloc_report"]
-        if not os.path.exists(os.path.join(project_path, cloc_report_name)):
-            P.local("cloc --out=%s --csv ." % cloc_report_name, project_path)
-
-        with open(os.path.join(project_path, cloc_report_name)) as csv_file:
+    def count_locs(repo_path, commit):
+        # The report is kept in the project, also when counting the lines of a
+        # mirror, and counted again when the commit changes
+        cloc_report = os.path.join(os.path.abspath(project_path), BASE_CONFIG["cloc_report"])
+        if get_sloc_report_commit(cloc_report) != commit:
+            write_commit_locs(repo_path, commit, cloc_report)
+
+        with open(cloc_report) as csv_file:
             scala_lines = 0
             total_lines = 0
             reader = csv.DictReader(csv_file)
             for line in reader:
+                if line["language"] == "SUM":
+                    continue
                 lines = int(line["code"])
                 total_lines += lines
                 if line["language"] == "Scala":
                     scala_lines += lines
         return {"total": total_lines, "scala": scala_lines}
 
-    def generate_project_metadata(repo_path):
-        repo_url = P.local("git config --get remote.origin.url", repo_path)
-        commit = P.local("git rev-parse HEAD", repo_path)
-        version = P.local("git describe --always", repo_path, verbose=True)
+    def generate_project_metadata(repo_path, revision=None, repo_url=None):
+        # Without a revision, the checkout in repo_path is described. With one,
+        # everything is read with git plumbing, so repo_path may be a bare mirror.
+        if repo_url is None:
+            repo_url = P.local("git config --get remote.origin.url", repo_path)
+        commit = P.local("git rev-parse %s^{commit}" % (revision or "HEAD"), repo_path)
+        version = P.local("git describe --always %s" % (revision or ""), repo_path, verbose=True)
         reponame = repo_url.split('.com/')[1]
-        sloc = count_locs(repo_path)
-        repo_info = json.loads(P.local("curl 'https://api.github.com/repos/%s'" % reponame, repo_path))
-        gh_stars = repo_info["stargazers_count"] if "stargazers_count" in repo_info else (repo_info["watchers_count"] if "watchers_count" in repo_info else -1)
-        build_system = P.get_build_systems(repo_path)
+        sloc = count_locs(repo_path, commit)
+        gh_stars, reason = get_github_stars(reponame)
+        if reason is not None:
+            P.error("[Metadata][%s] No GitHub stars for %s: %s" % (project_name, reponame, reason))
+        build_system = P.get_build_systems(repo_path, None if revision is None else commit)
         project_info = {
             "name": str(project_name),
             "version": version,
@@ -294,7 +1494,6 @@ def create_project_info(
     phase = Phase(project_path, "Metadata")
     project_name = os.path.split(project_path)[1]
 
-    phase.stop_if_already_reported("project_info_report")
     P.info("[Metadata][%s] Creating project info..." % project_name)
 
     project_info = {}
@@ -303,15 +1502,16 @@ def create_project_info(
         P.info("[Metadata][%s] No custom url. Assume this is a git repo" % project_name)
         project_info = generate_project_metadata(project_path)
     else:
-        # We have a custom url, we need to download the repo
-        P.info("[Metadata][%s] Custom url provided. Downloading git repo" % project_name)
+        # We have a custom url. Use the project if it is a git repo with the
+        # commit already, or else a mirror of the url
         url = transform_to_gh_url(url)
-        P.local("git clone --depth 300 %s %s" % (url, BASE_CONFIG["temporal_git_repo_storage"]), project_path)
-        repo_path = os.path.join(project_path, BASE_CONFIG["temporal_git_repo_storage"])
-        if last_commit != None:
-            P.local("git checkout %s" % last_commit, repo_path)
-        project_info = generate_project_metadata(repo_path)
-        shutil.rmtree(repo_path)
+        if last_commit is not None and has_git_commit(project_path, last_commit):
+            P.info("[Metadata][%s] Custom url provided. Commit found in the project" % project_name)
+            repo_path = project_path
+        else:
+            P.info("[Metadata][%s] Custom url provided. Updating git mirror" % project_name)
+            repo_path = get_git_mirror(url, last_commit)
+        project_info = generate_project_metadata(repo_path, last_commit or "HEAD", url)
 
     P.info("[Metadata][%s] Capture project info: %s" % (project_name, project_info))
     with open(os.path.join(project_path, "project.csv"), "w") as csv_file:
@@ -320,16 +1520,124 @@ def create_project_info(
         writer.writerow(project_info.values())
     phase.succeed("project_info_report")
 
-@task
-def compile(project_path, backwards_steps=BASE_CONFIG["max_backwards_steps"], pull=True):
+def has_git_commit(repo_path, commit):
+    return Pipeline().local("git cat-file -e %s^{commit}" % commit, repo_path, warn_only=True).succeeded
+
+def get_git_mirror(url, commit=None):
+    # Bare mirror of the repository, shared by all the projects. It is cloned
+    # once, and fetched again unless it has the commit already. Concurrent jobs
+    # wait for each other on a lock file next to the mirror.
+    P = Pipeline()
+    folder = os.path.abspath(BASE_CONFIG["git_mirrors_folder"])
+    if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    mirror = os.path.join(folder, re.sub(r"[^\w.-]", "_", re.sub(r"^\w+://", "", url)) + ".git")
+    with open(mirror + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(mirror):
+            if os.path.exists(mirror + ".tmp"):
+                shutil.rmtree(mirror + ".tmp")
+            P.local("git clone --mirror --quiet %s %s" % (shlex.quote(url), shlex.quote(mirror + ".tmp")), folder)
+            os.rename(mirror + ".tmp", mirror)
+        elif commit is None or not has_git_commit(mirror, commit):
+            P.local("git fetch --prune --quiet origin", mirror)
+    return mirror
+
+def get_sbt_global_version(version):
+    # sbt versions share the global folder (~/.sbt/<version>) of their series: 0.13 or 1.0
+    match = re.match(r"(\d+)\.(\d+)", version)
+    if match is None:
+        return None
+    major, minor = match.groups()
+    return "0.%s" % minor if major == "0" else "%s.0" % major
+
+def is_tag_buildable(project_path, tag):
+    # Rejects the tags whose build asks for an sbt version we have no plugins for,
+    # without checking them out
+    properties = Pipeline().local("git show %s:project/build.properties" % tag, project_path, warn_only=True)
+    if properties.failed:
+        return True
+    match = re.search(r"^\s*sbt\.version\s*=\s*(\S+)", properties, re.MULTILINE)
+    return match is None or get_sbt_global_version(match.group(1)) in BASE_CONFIG["sbt_versions"]
+
+def compile_tags_in_parallel(project_path, tags, jobs):
+    # Compiles the tags in separate worktrees, and returns the first tag of the
+    # list that compiles. As soon as it is known, the compilations of the
+    # remaining tags are cancelled.
+    P = Pipeline()
+    project_name = os.path.split(project_path)[1]
+    candidates = []
+    for tag in tags:
+        if tag and tag not in candidates:
+            if is_tag_buildable(project_path, tag):
+                candidates.append(tag)
+            else:
+                P.info("[CCompile][%s] Unsupported sbt version in tag %s. Skipping" % (project_name, tag))
+
+    worktrees_dir = tempfile.mkdtemp(prefix="compile-%s-" % project_name)
+    processes = {}
+    cancelled = threading.Event()
+    lock = threading.Lock()
+
+    def compile_tag(tag, worktree):
+        with lock:
+            if cancelled.is_set():
+                return False
+            if P.local_canfail("git worktree %s" % tag, "git worktree add --detach %s %s" % (worktree, tag), project_path):
+                return False
+            P.info("[CCompile][%s] Compiling tag %s" % (project_name, tag))
+
+        def started(process):
+            with lock:
+                processes[tag] = process
+                if cancelled.is_set():
+                    os.killpg(process.pid, signal.SIGTERM)
+
+        name = "Compile tag %s" % tag
+        command = " ".join(shlex.quote(c) for c in ["sbt", "-batch"] + BASE_CONFIG["sbt_options"] + ["compile"]) + " 2>&1"
+        result = P.local(command, worktree, warn_only=True, on_start=started,
+                         log_path=P.get_command_log_path(project_path, name),
+                         timeout=BASE_CONFIG["sbt_command_timeout"])
+        if result.failed and not cancelled.is_set():
+            P.write_command_report(name, project_path, result)
+        return result.succeeded
+
+    def cancel():
+        with lock:
+            cancelled.set()
+            for tag, process in processes.items():
+                # Pipeline.local sets the returncode once it has reaped the process
+                if process.returncode is None:
+                    P.info("[CCompile][%s] Cancelling compilation of tag %s" % (project_name, tag))
+                    try:
+                        os.killpg(process.pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+
+    winner = None
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [(tag, executor.submit(compile_tag, tag, os.path.join(worktrees_dir, str(i))))
+                       for i, tag in enumerate(candidates)]
+            for tag, future in futures:
+                if future.result():
+                    winner = tag
+                    break
+            cancel()
+    finally:
+        shutil.rmtree(worktrees_dir, ignore_errors=True)
+        P.local_canfail("git worktree prune", "git worktree prune", project_path)
+    return winner
+
+@phase_task("compilation_report", dependencies=["setup"], uses_sbt=True)
+def compile(project_path, backwards_steps=BASE_CONFIG["max_backwards_steps"], pull=True,
+            strategy=BASE_CONFIG["compile_strategy"], jobs=BASE_CONFIG["compile_parallel_jobs"]):
     project_name = os.path.split(project_path)[1]
     cwd = os.getcwd()
     P = Pipeline()
     phase = Phase(project_path, "CCompile")
     project_name = os.path.split(project_path)[1]
 
-    phase.stop_if_already_reported("compilation_report")
-
 #    if pull:
 #        P.local("git reset --hard HEAD && git checkout master && git pull", project_path)
 
@@ -338,10 +1646,24 @@ def compile(project_path, backwards_steps=BASE_CONFIG["max_backwards_steps"], pu
     P.local("git fetch --depth %s" % backwards_steps, project_path)
     tag_stream = P.local("git describe --always --abbrev=0 --tags `git rev-list --tags --max-count=%s %s`" % (backwards_steps, current_commit), project_path)
     tags = [current_commit] + tag_stream.split('\n')
+
+    sbt = get_sbt_driver()
+    if strategy == "parallel":
+        tag = compile_tags_in_parallel(project_path, tags, int(jobs))
+        if tag is not None and not P.local_canfail("git checkout %s" % tag, "git checkout %s" % tag, project_path):
+            # The build outputs went away with the worktree: the next phases
+            # need them in the project
+            sbt.close(project_path)
+            if not sbt.run("Compile tag %s" % tag, ["compile"], project_path, verbose=True).failed:
+                phase.succeed("compilation_report", payload = tag)
+        phase.fail("compilation_report", payload = tags)
+
     for tag in tags:
         checkout_failed = P.local_canfail("git checkout %s" % tag, "git checkout %s" % tag, project_path)
         if not checkout_failed:
-            failed = P.local_canfail("Compile tag %s" % tag, "sbt -batch compile", project_path, verbose=True)
+            # The build may have changed with the checkout
+            sbt.close(project_path)
+            failed = sbt.run("Compile tag %s" % tag, ["compile"], project_path, verbose=True).failed
             if not failed:
                 phase.succeed("compilation_report", payload = tag)
         else:
@@ -349,59 +1671,347 @@ def compile(project_path, backwards_steps=BASE_CONFIG["max_backwards_steps"], pu
 
     phase.fail("compilation_report", payload = tags)
 
-@task
+@phase_task("semanticdb_report", dependencies=["compile"], uses_sbt=True)
 def gen_sdb(
         project_path
 ):
     P = Pipeline()
     phase = Phase(project_path, "Semanticdb")
-    phase.depend_on("compilation_report")
-    phase.stop_if_already_reported("semanticdb_report")
 
-    failed = P.local_canfail("Generate semanticdb", "sbt -batch semanticdb compile", project_path, verbose=True)
+    if use_combined_sbt_run():
+        run_combined_sbt(project_path)
+        phase.stop_if_already_reported("semanticdb_report")
+
+    failed = get_sbt_driver().run("Generate semanticdb", ["semanticdb", "compile"], project_path, verbose=True).failed
     if failed:
         phase.fail("semanticdb_report")
     else:
         phase.succeed("semanticdb_report")
 
-@task
+####################
+# JVM tools
+####################
+
+def get_semanticdb_size(project_path):
+    total = 0
+    for root, folders, files in os.walk(project_path):
+        folders[:] = [folder for folder in folders if folder not in (".git", "node_modules")]
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files if name.endswith(".semanticdb"))
+    return total
+
+def set_jvm_heap_size(jvm_options, heap):
+    options = [option for option in jvm_options.split() if not option.startswith("-Xmx")]
+    return " ".join(options + ["-Xmx%dm" % int(math.ceil(heap / float(1024 ** 2)))])
+
+def get_sized_jvm_options(jvm_options, project_path):
+    # Replaces the -Xmx of the options by the heap the project needs
+    sizing = BASE_CONFIG["jvm_heap_sizing"]
+    if sizing is None:
+        return jvm_options
+    classpath_entries = 0
+    classpath_path = find_artifact(os.path.join(project_path, "classpath.dat"))
+    if os.path.exists(classpath_path):
+        with open_artifact(classpath_path) as classpath_file:
+            classpath_entries = sum(1 for line in classpath_file if line.strip())
+    heap = parse_memory_size(sizing["base"]) \
+        + sizing["semanticdb_factor"] * get_semanticdb_size(project_path) \
+        + classpath_entries * parse_memory_size(sizing["classpath_entry"])
+    heap = min(max(heap, parse_memory_size(sizing["min"])), parse_memory_size(sizing["max"]))
+    return set_jvm_heap_size(jvm_options, heap)
+
+def classify_jvm_failure(result):
+    if result.timed_out:
+        return "TIMEOUT"
+    # Killed by the kernel when the node runs out of memory
+    if "java.lang.OutOfMemoryError" in result.stdout or "java.lang.OutOfMemoryError" in result.stderr \
+            or result.return_code in (-signal.SIGKILL, 128 + signal.SIGKILL):
+        return "OOM"
+    return "CRASH"
+
+class JvmDaemon:
+    # A tool started with --serve. It reads jobs, one per line of tab-separated
+    # arguments, and answers each with a line starting with JVM_DAEMON_MARKER.
+    # Everything else it prints is the output of the job being run.
+    def __init__(self, jar_path, jvm_options):
+        self.jar_path = jar_path
+        self.jobs = 0
+        self.process = subprocess.Popen(["java"] + jvm_options.split() + ["-jar", jar_path, "--serve"],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        start_new_session=True)
+        register_process_group(self.process.pid)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def get_rss(self):
+        try:
+            with open("/proc/%d/status" % self.process.pid) as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except (IOError, ValueError):
+            pass
+        return 0
+
+    def exhausted(self):
+        daemon_config = BASE_CONFIG["jvm_daemon"]
+        return self.jobs >= daemon_config["max_jobs"] or self.get_rss() > parse_memory_size(daemon_config["max_rss"])
+
+    def run(self, arguments, timeout, log_path=None, directory="."):
+        # directory is only traced, the daemon runs where it was started
+        start, before = time.time(), get_process_usage(self.process.pid)
+        self.output_bytes = 0
+        result = self.run_job(arguments, timeout, log_path)
+        trace_process_command("java -jar %s %s" % (self.jar_path, " ".join(shlex.quote(a) for a in arguments)),
+                              directory, self.process.pid, start, before, result, self.output_bytes)
+        return result
+
+    def run_job(self, arguments, timeout, log_path):
+        # The job fails with the exit status of the JVM if it died running it
+        timed_out = threading.Event()
+        def kill():
+            timed_out.set()
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, kill) if timeout is not None else None
+        if timer is not None:
+            timer.daemon = True
+            timer.start()
+        self.jobs += 1
+        log = RotatingLog(log_path) if log_path is not None else None
+        output = collections.deque(maxlen=BASE_CONFIG["command_logs"]["tail_lines"] if log is not None else None)
+        status = None
+        try:
+            self.process.stdin.write(("\t".join(arguments) + "\n").encode("utf-8"))
+            self.process.stdin.flush()
+            for line in iter(self.process.stdout.readline, b""):
+                self.output_bytes += len(line)
+                if line.startswith(JVM_DAEMON_MARKER.encode("utf-8")):
+                    status = line.decode("utf-8", "replace")[len(JVM_DAEMON_MARKER):].strip()
+                    break
+                output.append(line.decode("utf-8", "replace").rstrip("\n"))
+                if log is not None:
+                    log.write(line)
+        except (IOError, OSError):
+            pass
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if log is not None:
+                log.close()
+        if status is None:
+            return_code = self.process.wait()
+            return CommandResult("\n".join(output), "", return_code or 1, timed_out.is_set(), log_path)
+        return CommandResult("\n".join(output), status, 0 if status == "OK" else 1, log_path=log_path)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=60)
+        except (IOError, OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        unregister_process_group(self.process.pid)
+
+JVM_DAEMON_MARKER = "@@job-server"
+
+# Jar path -> JvmDaemon, used by one job at a time
+_jvm_daemons = {}
+_jvm_daemon_locks = collections.defaultdict(threading.Lock)
+_jvm_daemons_lock = threading.Lock()
+_jvm_tool_lock = threading.Lock()
+
+def run_in_jvm_daemon(jar_path, jvm_options, arguments, timeout, log_path=None, directory="."):
+    # (result of the job, whether the daemon survived it)
+    with _jvm_daemons_lock:
+        lock = _jvm_daemon_locks[jar_path]
+    with lock:
+        daemon = _jvm_daemons.get(jar_path)
+        if daemon is not None and (not daemon.alive() or daemon.exhausted()):
+            daemon.close()
+            daemon = None
+        if daemon is None:
+            heap = parse_memory_size(BASE_CONFIG["jvm_daemon"]["heap"])
+            daemon = _jvm_daemons[jar_path] = JvmDaemon(jar_path, set_jvm_heap_size(jvm_options, heap))
+        return daemon.run(arguments, timeout, log_path, directory), daemon.alive()
+
+def close_jvm_daemons():
+    with _jvm_daemons_lock:
+        for daemon in _jvm_daemons.values():
+            daemon.close()
+        _jvm_daemons.clear()
+
+atexit.register(close_jvm_daemons)
+
+def get_classpath_salt(project_path):
+    # A digest of what the analysis of a file depends on besides the file:
+    # the jars of the classpath (their fingerprints in classpath.json) and the
+    # contents of its class folders, which other sources of the project compile to
+    digest = hashlib.sha1()
+    classpath_json = find_artifact(os.path.join(project_path, "classpath.json"))
+    if os.path.exists(classpath_json):
+        with open_artifact(classpath_json) as classpath_file:
+            fingerprints = json.load(classpath_file).get("fingerprints", {})
+        digest.update(json.dumps(fingerprints, sort_keys=True).encode("utf-8"))
+    classpath_dat = find_artifact(os.path.join(project_path, "classpath.dat"))
+    if os.path.exists(classpath_dat):
+        with open_artifact(classpath_dat) as classpath_file:
+            folders = [line.strip() for line in classpath_file if os.path.isdir(line.strip())]
+        for folder in folders:
+            for root, _, files in sorted(os.walk(folder)):
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    digest.update(("%s %s\n" % (os.path.relpath(path, folder), hash_file(path))).encode("utf-8"))
+    return digest.hexdigest()
+
+def get_shard_arguments(tool, tool_path, salted_project=None):
+    # The --shards option of the tool, in a folder of its version, with the
+    # classpath salt of the project if its results depend on it. The shards
+    # of other versions are removed, they would never be used again.
+    shards_folder = BASE_CONFIG["result_shards_folder"]
+    if shards_folder is None:
+        return []
+    shards_folder = os.path.abspath(shards_folder)
+    version_folder = "%s-%s" % (tool, hash_file(tool_path)[:12])
+    if os.path.isdir(shards_folder):
+        for folder in os.listdir(shards_folder):
+            if folder.startswith(tool + "-") and folder != version_folder:
+                shutil.rmtree(os.path.join(shards_folder, folder), ignore_errors=True)
+    return ["--shards", os.path.join(shards_folder, version_folder)] + \
+        (["--shard-salt", get_classpath_salt(salted_project)] if salted_project is not None else [])
+
+def remove_reports_files(project_path, names):
+    # Outputs of a previous run, so that a run that writes none does not pass for a successful one
+    for name in names:
+        for path in [name, name + ".gz"]:
+            path = os.path.join(project_path, BASE_CONFIG["reports_folder"], path)
+            if os.path.exists(path):
+                os.remove(path)
+
+def report_shard_stats(phase, project_path, stats_file):
+    # Logs how many shards the tool reused and recomputed, and adds them to the
+    # trace of the phase
+    stats_path = os.path.join(project_path, BASE_CONFIG["reports_folder"], stats_file)
+    reused, recomputed = read_csv_value(stats_path, "reused"), read_csv_value(stats_path, "recomputed")
+    if reused is None or recomputed is None:
+        return
+    phase.info("Shards: %s reused, %s recomputed" % (reused, recomputed))
+    trace = getattr(_trace_context, "phase", None)
+    if trace is not None:
+        trace.update(shards_reused=int(reused), shards_recomputed=int(recomputed))
+
+def run_jvm_tool(name, jar_path, arguments, project_path, jvm_options, timeout):
+    # Runs the jar on the project (the arguments are paths in the project), in
+    # the JVM daemon if its heap is large enough, or else in a JVM of its own,
+    # and once more with a larger heap if that ran out of memory, all within
+    # timeout seconds. Returns None on success, or else why it failed ("OOM",
+    # "TIMEOUT" or "CRASH") and with what heap.
+    P = Pipeline()
+    sizing = BASE_CONFIG["jvm_heap_sizing"]
+    deadline = None if timeout is None else time.time() + timeout
+    daemon_config = BASE_CONFIG["jvm_daemon"]
+    heap = get_jvm_heap_size(jvm_options)
+    if daemon_config is not None and heap is not None and heap <= parse_memory_size(daemon_config["heap"]):
+        absolute_arguments = [argument if argument.startswith("-") else os.path.abspath(os.path.join(project_path, argument))
+                              for argument in arguments]
+        result, survived = run_in_jvm_daemon(jar_path, jvm_options, absolute_arguments, timeout,
+                                             P.get_command_log_path(project_path, name), project_path)
+        if result.succeeded:
+            return None
+        P.write_command_report(name, project_path, result)
+        if survived or result.timed_out:
+            return "%s (daemon)" % classify_jvm_failure(result)
+        P.error("[%s][%s] The JVM daemon died (%s), running in a JVM of its own" % (
+            name, os.path.split(project_path)[1], classify_jvm_failure(result)))
+
+    # One JVM of its own at a time in the job, which is what get_corpus_job_memory budgets for
+    with _jvm_tool_lock:
+        retried = False
+        while True:
+            remaining = None if deadline is None else max(1, deadline - time.time())
+            result = P.local("java %s -jar %s %s" % (jvm_options, jar_path, " ".join(shlex.quote(a) for a in arguments)),
+                             project_path, warn_only=True, timeout=remaining, log_path=P.get_command_log_path(project_path, name))
+            if result.succeeded:
+                return None
+            P.write_command_report(name, project_path, result)
+            failure = classify_jvm_failure(result)
+            heap = get_jvm_heap_size(jvm_options)
+            details = "%s (%s%s)" % (failure, "heap %dm" % (heap // 1024 ** 2) if heap else "default heap",
+                                     ", retried" if retried else "")
+            if failure != "OOM" or retried or sizing is None or heap is None or heap >= parse_memory_size(sizing["max"]):
+                return details
+            larger_heap = min(heap * sizing["oom_retry_factor"], parse_memory_size(sizing["max"]))
+            P.error("[%s][%s] Out of memory with %dm, retrying with %dm" % (
+                name, os.path.split(project_path)[1], heap // 1024 ** 2, larger_heap // 1024 ** 2))
+            jvm_options = set_jvm_heap_size(jvm_options, larger_heap)
+            retried = True
+
+@phase_task("analyzer_report", dependencies=["setup", "create_project_info", "gen_sdb", "classpath"],
+            inputs=CACHED_ARTIFACTS["analyzer"]["inputs"], outputs=CACHED_ARTIFACTS["analyzer"]["outputs"])
 def analyze(
         project_path,
         tools_dir=BASE_CONFIG["tools_dir"]
 ):
     def run_analysis_tool(tool_path, jvm_options):
-        return Pipeline().local_canfail("Extract Implicits", "java -jar %s %s . ./classpath.dat ./%s" % (jvm_options, tool_path, BASE_CONFIG["reports_folder"]), project_path)
+        classpath_path = os.path.relpath(find_artifact(os.path.join(project_path, "classpath.dat")), project_path)
+        arguments = [".", classpath_path, BASE_CONFIG["reports_folder"]] + \
+            get_shard_arguments("analyzer", tool_path, project_path) + \
+            (["--json"] if BASE_CONFIG["results_json"] else []) + \
+            (["--compress"] if is_compressed_artifact("results.proto") else [])
+        return run_jvm_tool("Extract Implicits", tool_path, arguments,
+                            project_path, jvm_options, BASE_CONFIG["analyzer_timeout"])
 
     cwd = os.getcwd()
     phase = Phase(project_path, "ExtractImplicits")
-    jvm_options = BASE_CONFIG["analyzer_jvm_options"]
     analysis_tool_path = os.path.join(cwd, tools_dir, BASE_CONFIG["analyzer_name"])
 
-    phase.stop_if_already_reported("analyzer_report")
+    def has_results():
+        # results.proto, results.json, or the split records of older tools
+        return any(os.path.exists(find_artifact(os.path.join(project_path, BASE_CONFIG["reports_folder"], name)))
+                   for name in ["results.proto", "results.json", "results-callsites.proto"])
 
-    phase.run_and_resume("fab setup:tools_dest=%s" % tools_dir, "Setup")
-    phase.run_and_resume("fab compile:project_path=%s" % project_path, "Clean compilation")
-    phase.run_and_resume("fab create_project_info:project_path=%s" % project_path, "Project info")
-    phase.run_and_resume("fab gen_sdb:project_path=%s" % project_path, "SDB File generation")
-    phase.run_and_resume("fab classpath:project_path=%s" % project_path, "Classpath generation")
+    cache = ResultCache()
+    key = cache.key(project_path, "analyzer", tools_dir)
+    if cache.restore(project_path, "analyzer", key) and has_results():
+        phase.info("Restored results from cache")
+        phase.succeed("analyzer_report")
 
-    failed = run_analysis_tool(analysis_tool_path, jvm_options)
-    if failed:
-        phase.fail("analyzer_report")
+    # The results of a previous run would be split with the new ones when they
+    # are not overwritten (no JSON view, or compressed otherwise)
+    remove_reports_files(project_path, ["results.proto", "results.json", "analyzer-shards.csv",
+                                        "results-callsites.proto", "results-declarations.proto"])
+
+    jvm_options = get_sized_jvm_options(BASE_CONFIG["analyzer_jvm_options"], project_path)
+    failure = run_analysis_tool(analysis_tool_path, jvm_options)
+    if failure:
+        phase.fail("analyzer_report", failure)
+    elif not has_results():
+        # e.g. a tool that does not know the arguments, and exits normally
+        phase.fail("analyzer_report", "No results written")
     else:
+        report_shard_stats(phase, project_path, "analyzer-shards.csv")
+        cache.store(project_path, "analyzer", key)
         phase.succeed("analyzer_report")
 
-@task
+@phase_task("classpath_report", dependencies=["compile"], uses_sbt=True, outputs=["classpath.dat", "classpath.json"])
 def classpath(project_path):
 
     def run_classpath_tool(project_path):
-        return Pipeline().local_canfail("Classpath generation", """sbt -batch "show test:fullClasspath" | sed -n -E 's/Attributed\(([^)]*)\)[,]?/\\n\\1\\n/gp' | grep "^/" > classpath.dat""", project_path)
+        classpath = ClasspathCollector()
+        result = get_sbt_driver().run("Classpath generation", ["show test:fullClasspath"], project_path,
+                                      on_line=classpath.feed)
+        if not result.failed:
+            classpath.write(project_path)
+            phase.info("Classpath: %s" % classpath.summary())
+        return result.failed
 
     phase = Phase(project_path, "Classpath")
 
-    phase.stop_if_already_reported("classpath_report")
-
-    phase.depend_on("compilation_report")
+    if use_combined_sbt_run():
+        run_combined_sbt(project_path)
+        phase.stop_if_already_reported("classpath_report")
 
     failed = run_classpath_tool(project_path)
     if failed:
@@ -487,46 +2097,81 @@ def merge_reports(
             manifest_file.write("]}")
 
     def read_reports(report_kinds, project):
-        return map(lambda kind: str(P.read_phase_report(project, kind)).split('\n')[0], report_kinds)
+        return map(lambda kind: str(index.read_phase_report(project, kind)).split('\n')[0], report_kinds)
 
     cwd = os.getcwd()
     P = Pipeline()
     P.info("[Reports] Generating analysis report into %s" % BASE_CONFIG["condensed_report_merged"])
+    index = CorpusReportsIndex()
 
-    reports_summaries = { report: (0, 0) for report in BASE_CONFIG["phase_reports"]}
-    long = create_csv(reports_summaries.keys())
+    report_kinds = list(BASE_CONFIG["phase_reports"])
     projects = get_project_list(projects_path, int(float(project_depth)))
-    project_names = [os.path.split(p)[1] for p in projects]
-
-    reports = [read_reports(reports_summaries.keys(), project) for project in projects]
-
-    long_csv = long
-    for report in reports: long_csv = add_row(long_csv, report)
-    long_csv = extend_csv(long_csv, "project", project_names)
 
     with open(BASE_CONFIG["condensed_report_merged"], 'w') as long_summary:
-        long_summary.write(print_csv(long_csv))
+        writer = CSVWriter(long_summary)
+        writer.write_headers(report_kinds + ["project"])
+        for project in projects:
+            writer.write_row(list(read_reports(report_kinds, project)) + [os.path.split(project)[1]])
 
     manifestables = P.exclude_non_successful(
         P.exclude_non_successful(
             projects,
-            "analyzer_report"),
-        "paths_extraction_report")
+            "analyzer_report", index),
+        "paths_extraction_report", index)
 
+    # The files as stored, gzipped or not
     manifest = [(
-        "%s/project.csv" % os.path.join(cwd, proj),
+        find_artifact("%s/project.csv" % os.path.join(cwd, proj)),
         "%s/%s/" % (os.path.join(cwd, proj), BASE_CONFIG["reports_folder"]),
-        "%s/%s/paths.csv" % (os.path.join(cwd, proj), BASE_CONFIG["reports_folder"])
+        find_artifact("%s/%s/paths.csv" % (os.path.join(cwd, proj), BASE_CONFIG["reports_folder"]))
         ) for proj in manifestables]
     write_manifest(manifest)
 
+@task
+def index_reports(
+        project_depth=BASE_CONFIG["default_location_depth"],
+        projects_path=BASE_CONFIG["projects_dest"]
+):
+    # Rebuilds the corpus index from the project folders, e.g. for projects
+    # processed before it existed, with one line per report: the index only
+    # grows otherwise. Reports written while it runs are kept.
+    P = Pipeline()
+    index_path = BASE_CONFIG["corpus_reports_index"]
+    projects = get_project_list(projects_path, int(float(project_depth)))
+    P.info("[Reports] Indexing the reports of %d projects into %s" % (len(projects), index_path))
+    with open(index_path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        offset = os.path.getsize(index_path) if os.path.exists(index_path) else 0
+    index = CorpusReportsIndex(None)
+    for project in projects:
+        reports = P.read_phase_reports_index(project)
+        if reports is None:
+            reports = P.read_legacy_phase_reports(project)
+        for kind, entry in reports.items():
+            index.add(dict(entry, project=os.path.abspath(project), kind=kind))
+    with open(index_path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(index_path):
+            index.read(index_path, offset)
+        index.write(index_path + ".tmp")
+        os.replace(index_path + ".tmp", index_path)
+
+@task
+def clear_phase_report(project_path, kind):
+    # Makes the phase of the report run again for the project
+    P = Pipeline()
+    if kind not in BASE_CONFIG["phase_reports"]:
+        abort("Unknown report %s, one of: %s" % (kind, ", ".join(sorted(BASE_CONFIG["phase_reports"]))))
+    P.info("[Reports][%s] Removing the %s" % (project_path, kind))
+    P.clear_phase_report(project_path, kind)
+
 @task
 def cleanup_reports(project_path):
     P = Pipeline()
     report_path = os.path.join(project_path, BASE_CONFIG["reports_folder"])
     if os.path.exists(report_path):
         P.info("[Cleanup][%s] Removing reports folder" % project_path)
-        shutil.rmtree(report_path)
+        P.clear_phase_reports(project_path)
         sys.exit(0)
     else:
         P.info("[Cleanup][%s] Report folder not found" % project_path)
@@ -543,26 +2188,28 @@ def merge_metadata(
     depth = int(float(project_depth))
     projects = get_project_list(projects_path, depth)
     if exclude_unfinished:
-        projects = P.exclude_non_successful(projects, "analyzer_report")
+        projects = list(P.exclude_non_successful(projects, "analyzer_report"))
     project_metadata_report = BASE_CONFIG["project_metadata_merged"]
     P.info(" Merging metadata into %s" % project_metadata_report)
-    metadata_files = load_many([proj + "/project.csv" for proj in projects])
-    projects_info = merge_all(metadata_files)
-    with open(project_metadata_report, 'w') as metadata:
-        metadata.write(print_csv(projects_info))
-
-    sloc_report_name = BASE_CONFIG["cloc_report"]
-    sloc_files = [proj+"/"+sloc_report_name for proj in projects]
-    sloc_csvs = load_many(sloc_files)
-    headers_clean = [(drop_header(csvf, 5) if len(csvf["headers"]) == 6 else csvf) for csvf in sloc_csvs] # Drop the annoying cloc timestamp
-    with_project = [extend_csv(headers_clean[i], "project", get_data(metadata_files[i], 0, "reponame")) for i in range(0, len(headers_clean))]
-    all_in_one = merge_all(with_project)
-    with open(sloc_report_name, 'w') as slocs_file:
-        slocs_file.write(print_csv(all_in_one))
+    merge_csv_files(project_metadata_report, ((os.path.join(proj, "project.csv"), []) for proj in projects))
+
+    # The project.csv files were just merged, their index has their first row
+    metadata_index = MergeIndex(project_metadata_report)
+    def sloc_sources():
+        for proj in projects:
+            reponame = metadata_index.read_csv_value(os.path.join(proj, "project.csv"), "reponame")
+            yield os.path.join(proj, BASE_CONFIG["cloc_report"]), [("project", reponame)]
+
+    # Drop the annoying cloc timestamp
+    drop_timestamp = lambda headers: headers[:5] if len(headers) == 6 else headers
+    P.info(" Merging slocs into %s" % BASE_CONFIG["sloc_merged"])
+    merge_csv_files(BASE_CONFIG["sloc_merged"], sloc_sources(), drop_timestamp)
 
 # Run sbt to extract test and compile source paths
 # Store them in _reports/paths.csv
-@task
+# Run alone as a fab task, it leaves the compilation to sbt
+@phase_task("paths_extraction_report", dependencies=["compile"], uses_sbt=True,
+            outputs=CACHED_ARTIFACTS["paths"]["outputs"], standalone=True)
 def extract_paths(
         project_path,
 ):
@@ -570,40 +2217,42 @@ def extract_paths(
     phase = Phase(project_path, "Paths")
     project_name = os.path.split(project_path)[1]
 
-    phase.stop_if_already_reported("paths_extraction_report")
-
-    def gen_paths_command(project, scope):
-        # Generates an AWK script that matches all lines that look like paths,
-        # And outputs them in nice CSV format.
-        def gen_processor_script(project, scope):
-            return ("$2 ~ /^\// { path = $2; print \"%s, \" path \", %s\";}" %
-                    (project, scope))
-        return ("sbt -batch -Dsbt.log.noformat=true %s:scalaSource | awk '%s' >> %s/paths.csv" %
-                (scope, gen_processor_script(project_name, scope), BASE_CONFIG["reports_folder"]))
-
+    def extract_scope_paths(paths_file, scope):
+        # Keeps the lines that look like paths and outputs them in nice CSV format.
+        def on_line(line):
+            path = parse_source_path(line)
+            if path is not None:
+                paths_file.write("%s, %s, %s\n" % (project_name, path, scope))
+        result = get_sbt_driver().run("Extract %s paths" % scope, ["%s:scalaSource" % scope], project_path,
+                                      on_line=on_line)
+        return result.failed
+
+    cache = ResultCache()
+    key = cache.key(project_path, "paths")
+    if cache.restore(project_path, "paths", key):
+        phase.info("Restored paths from cache")
+        phase.succeed("paths_extraction_report")
+
+    if use_combined_sbt_run():
+        run_combined_sbt(project_path)
+        if P.read_phase_report(project_path, "paths_extraction_report") == "SUCCESS":
+            cache.store(project_path, "paths", key)
+        phase.stop_if_already_reported("paths_extraction_report")
 
     P.info("[Paths][%s] Cleaning up previous paths" % project_name)
-    P.local(
-        "echo 'project, path, kind' > %s/paths.csv" % BASE_CONFIG["reports_folder"],
-        project_path
-    )
+    output_folder = P.get_base_output_folder(project_path, create_if_missing=True)
+    with open(os.path.join(output_folder, "paths.csv"), 'w') as paths_file:
+        paths_file.write("project, path, kind\n")
 
-    P.info("[Paths][%s] Extracting Compile path" % project_name)
-    failed = P.local(
-        gen_paths_command(project_name, "compile"),
-        project_path,
-    )
-    if failed:
-        phase.fail("paths_extraction_report")
+        P.info("[Paths][%s] Extracting Compile path" % project_name)
+        if extract_scope_paths(paths_file, "compile"):
+            phase.fail("paths_extraction_report")
 
-    P.info("[Paths][%s] Extracting Test path" % project_name)
-    failed = P.local(
-        gen_paths_command(project_name, "test"),
-        project_path
-    )
-    if failed:
-        phase.fail("paths_extraction_report")
+        P.info("[Paths][%s] Extracting Test path" % project_name)
+        if extract_scope_paths(paths_file, "test"):
+            phase.fail("paths_extraction_report")
 
+    cache.store(project_path, "paths", key)
     phase.succeed("paths_extraction_report")
 
 @task
@@ -617,30 +2266,43 @@ def merge_paths(
     projects = get_project_list(projects_path, int(float(project_depth)))
     if exclude_unfinished:
         projects = P.exclude_non_successful(projects, "analyzer_report")
-    P.info(" Merging paths into %s" % "paths.all.csv")
-    paths_files = load_many([os.path.join(p, reports_folder, "paths.csv") for p in projects])
-    merged = merge_all(paths_files)
+    P.info(" Merging paths into %s" % BASE_CONFIG["paths_merged"])
+    merge_csv_files(BASE_CONFIG["paths_merged"], ((os.path.join(p, reports_folder, "paths.csv"), []) for p in projects))
 
-    with open(BASE_CONFIG["paths_merged"], 'w') as pathsfile:
-        pathsfile.write(print_csv(merged))
-
-@task
-def count_callsites(project_path):
+@phase_task("callsite_count_report", dependencies=["setup", "gen_sdb"],
+            outputs=CACHED_ARTIFACTS["callsites"]["outputs"])
+def count_callsites(
+        project_path,
+        tools_dir=BASE_CONFIG["tools_dir"]
+):
     def run_count_command(project_path, tool_path):
-        return Pipeline().local_canfail("Count Call Sites", "java -jar %s . ./%s" % (tool_path, BASE_CONFIG["reports_folder"]), project_path)
+        jvm_options = get_sized_jvm_options(BASE_CONFIG["callsite_counter_jvm_options"], project_path)
+        arguments = [".", BASE_CONFIG["reports_folder"]] + \
+            get_shard_arguments("callsite-counter", tool_path)
+        return run_jvm_tool("Count Call Sites", tool_path, arguments,
+                            project_path, jvm_options, BASE_CONFIG["callsite_counter_timeout"])
 
     phase = Phase(project_path, "CallSites")
     cwd = os.getcwd()
-    counter_tool_path = os.path.join(cwd, BASE_CONFIG["tools_dir"], BASE_CONFIG["callsite_counter_name"])
-
-    phase.stop_if_already_reported("callsite_count_report")
-    phase.depend_on("semanticdb_report")
-
-    failed = run_count_command(project_path, counter_tool_path)
-    if failed:
-        phase.fail("callsite_counter_name")
+    counter_tool_path = os.path.join(cwd, tools_dir, BASE_CONFIG["callsite_counter_name"])
+
+    counts_path = os.path.join(project_path, BASE_CONFIG["reports_folder"], "callsite-counts.csv")
+    cache = ResultCache()
+    key = cache.key(project_path, "callsites", tools_dir)
+    if cache.restore(project_path, "callsites", key) and os.path.exists(counts_path):
+        phase.info("Restored call site counts from cache")
+        phase.succeed("callsite_count_report")
+
+    remove_reports_files(project_path, ["callsite-counts.csv", "callsite-shards.csv"])
+    failure = run_count_command(project_path, counter_tool_path)
+    if failure:
+        phase.fail("callsite_count_report", failure)
+    elif not os.path.exists(counts_path):
+        phase.fail("callsite_count_report", "No call site counts written")
     else:
-        phase.succeed("callsite_couner_name")
+        report_shard_stats(phase, project_path, "callsite-shards.csv")
+        cache.store(project_path, "callsites", key)
+        phase.succeed("callsite_count_report")
 
 @task
 def merge_callsite_counts(
@@ -653,127 +2315,1392 @@ def merge_callsite_counts(
     projects = get_project_list(projects_path, int(float(project_depth)))
     if exclude_unfinished:
         projects = P.exclude_non_successful(projects, "callsite_count_report")
-    P.info(" Merging call site counts into %s" % "callsite-counts.all.csv")
-    files = load_many([os.path.join(p, reports_folder, "callsite-counts.csv") for p in projects])
-    with_project = map(lambda i: extend_csv(files[i], "project", os.path.split(projects[i])[1]), range(0, len(files)))
-    merged = merge_all(with_project)
+    P.info(" Merging call site counts into %s" % BASE_CONFIG["callsite_counts_merged"])
+    merge_csv_files(BASE_CONFIG["callsite_counts_merged"], (
+        (os.path.join(p, reports_folder, "callsite-counts.csv"), [("project", os.path.split(p)[1])])
+        for p in projects))
+
+class JSONStream:
+    # Reads a JSON document a chunk at a time, decoding one value at a time,
+    # so that only the value being decoded is ever in memory
+    def __init__(self, json_file, chunk_size=1 << 20):
+        self.file = json_file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        # False at the end of the file
+        if self.pos > self.chunk_size:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        chunk = self.file.read(self.chunk_size)
+        self.buffer += chunk
+        return len(chunk) > 0
+
+    def peek(self):
+        # The next character that is not whitespace, None at the end of the file
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return None
+
+    def expect(self, chars):
+        char = self.peek()
+        if char is None or char not in chars:
+            raise ValueError("Expected one of '%s', got %r" % (chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # The value may continue in the next chunk
+                if not self.fill():
+                    raise
+                continue
+            # So may a number that ends the buffer, like "-2." in "-2.5e10"
+            if all(c in "0123456789.eE+-" for c in self.buffer[end:]) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def array(self):
+        # Yields the elements of the array that starts at the current position
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+    def keys(self):
+        # Yields the keys of the object that starts at the current position.
+        # The value of every key must be read before asking for the next one.
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
 
-    with open(BASE_CONFIG["callsite_counts_merged"], 'w') as pathsfile:
-        pathsfile.write(print_csv(merged))
+####################
+# Protobuf records
+####################
 
-@task
+# The results are streams of length-delimited protobuf messages: the length
+# of every message as a varint, then the message. They are split and merged
+# a record at a time without decoding the messages, so no protobuf library
+# is needed.
+
+def decode_varint(data, pos=0):
+    # The value of the varint at pos and the position after it
+    value = shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("Truncated varint")
+        byte = data[pos]
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def read_varint(stream):
+    # None at the end of the stream
+    value = shift = 0
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            if shift > 0:
+                raise ValueError("Truncated varint")
+            return None
+        value |= (byte[0] & 0x7f) << shift
+        if not byte[0] & 0x80:
+            return value
+        shift += 7
+
+def iter_delimited_records(stream):
+    # Yields the messages of a length-delimited stream
+    while True:
+        length = read_varint(stream)
+        if length is None:
+            return
+        record = stream.read(length)
+        if len(record) != length:
+            raise ValueError("Truncated record")
+        yield record
+
+def split_record_fields(record):
+    # The field number of a message with a single field of a message type
+    # (AnalysisRecord, a oneof) and that field as a length-delimited message
+    tag, pos = decode_varint(record)
+    if tag & 0x7 != 2:
+        raise ValueError("Unexpected wire type %d" % (tag & 0x7))
+    length, end = decode_varint(record, pos)
+    if end + length != len(record):
+        raise ValueError("Unexpected record length")
+    return tag >> 3, record[pos:]
+
+@phase_task("split_results_report", dependencies=["analyze"],
+            inputs=[os.path.join(BASE_CONFIG["reports_folder"], f) for f in ["results.proto", "results.json"]],
+            outputs=[os.path.join(BASE_CONFIG["reports_folder"], f) for f in [
+                "results-callsites.proto", "results-declarations.proto",
+                "results-callsites.json", "results-declarations.json"]])
 def split_analysis_results(
-        project_path
+        project_path,
+        ndjson=BASE_CONFIG["split_results_ndjson"]
 ):
     P = Pipeline()
     phase = Phase(project_path, "Split Results")
-    phase.depend_on("analyzer_report")
-    phase.stop_if_already_reported("split_results_report")
 
-    results_path = P.get_base_output_folder(project_path)
-    data = json.load(open(os.path.join(results_path, "results.json")))
-    with open(os.path.join(results_path, "results-callsites.json"), 'w') as outfile:
-        json.dump(data["callSites"], outfile)
-    with open(os.path.join(results_path, "results-declarations.json"), 'w') as outfile:
-        json.dump(data["declarations"], outfile)
+    def split_records():
+        # By the field of AnalysisRecord: 1 for call sites, 2 for declarations
+        files = {
+            1: open_artifact(os.path.join(results_path, "results-callsites.proto"), 'wb'),
+            2: open_artifact(os.path.join(results_path, "results-declarations.proto"), 'wb')
+        }
+        try:
+            with open_artifact(proto_path, 'rb') as results_file:
+                for record in iter_delimited_records(results_file):
+                    field, element = split_record_fields(record)
+                    if field not in files:
+                        raise ValueError("Unexpected field %d" % field)
+                    files[field].write(element)
+        finally:
+            for f in files.values():
+                f.close()
+
+    def write_array(elements, name):
+        # The same output as json.dump on the whole array, plus one element
+        # per line in the .ndjson file if asked to
+        json_file = open_artifact(os.path.join(results_path, "%s.json" % name), 'w')
+        ndjson_file = open_artifact(os.path.join(results_path, "%s.ndjson" % name), 'w') if ndjson else None
+        try:
+            json_file.write("[")
+            for i, element in enumerate(elements):
+                encoded = json.dumps(element)
+                json_file.write(", " + encoded if i > 0 else encoded)
+                if ndjson_file is not None:
+                    ndjson_file.write(encoded + "\n")
+            json_file.write("]")
+        finally:
+            json_file.close()
+            if ndjson_file is not None:
+                ndjson_file.close()
+
+    def split_json():
+        outputs = {
+            "callSites": "results-callsites",
+            "declarations": "results-declarations"
+        }
+        split = set()
+        with open_artifact(json_path) as results_file:
+            stream = JSONStream(results_file)
+            for key in stream.keys():
+                if key in outputs:
+                    write_array(stream.array(), outputs[key])
+                    split.add(key)
+                else:
+                    stream.value()
+        return set(outputs) - split
 
+    results_path = P.get_base_output_folder(project_path)
+    proto_path = find_artifact(os.path.join(results_path, "results.proto"))
+    json_path = find_artifact(os.path.join(results_path, "results.json"))
+    ndjson = ndjson not in (False, "False", "false")
+    if not os.path.exists(proto_path) and not os.path.exists(json_path):
+        # Older analyzers write the split records themselves
+        split_paths = [find_artifact(os.path.join(results_path, name))
+                       for name in ["results-callsites.proto", "results-declarations.proto"]]
+        if all(os.path.exists(path) for path in split_paths):
+            phase.succeed("split_results_report")
+        phase.fail("split_results_report", payload = "Missing results")
+
+    if os.path.exists(proto_path):
+        try:
+            split_records()
+        except ValueError as e:
+            phase.fail("split_results_report", payload = "Corrupt results.proto: %s" % e)
+
+    # The JSON view, only there if asked for (or from an analyzer without records)
+    if os.path.exists(json_path):
+        missing = split_json()
+        if missing:
+            phase.fail("split_results_report", payload = "Missing %s" % ", ".join(sorted(missing)))
     phase.succeed("split_results_report")
 
 @task
-def merge(
+def merge_results(
         project_depth=BASE_CONFIG["default_location_depth"],
         projects_path=BASE_CONFIG["projects_dest"],
         exclude_unfinished=True
+):
+    # Concatenates the split records of the projects, which is a valid stream
+    # of records, without decoding them. The index has the bytes of every
+    # project in the merged files (uncompressed).
+    P = Pipeline()
+    reports_folder = BASE_CONFIG["reports_folder"]
+    projects = get_project_list(projects_path, int(float(project_depth)))
+    if exclude_unfinished:
+        projects = P.exclude_non_successful(projects, "split_results_report")
+    merged = {
+        "results-callsites.proto": BASE_CONFIG["callsites_merged"],
+        "results-declarations.proto": BASE_CONFIG["declarations_merged"]
+    }
+    P.info(" Merging results into %s" % ", ".join(sorted(merged.values())))
+    outputs = dict((name, open(path, 'wb')) for name, path in merged.items())
+    try:
+        with open(BASE_CONFIG["results_merged_index"], 'w') as index_file:
+            writer = CSVWriter(index_file)
+            writer.write_headers(["project", "file", "offset", "length"])
+            for project in projects:
+                for name, output in sorted(outputs.items()):
+                    path = find_artifact(os.path.join(project, reports_folder, name))
+                    if not os.path.exists(path):
+                        continue
+                    offset = output.tell()
+                    with open_artifact(path, 'rb') as results_file:
+                        shutil.copyfileobj(results_file, output, 1 << 20)
+                    writer.write_row([os.path.split(project)[1], merged[name], str(offset), str(output.tell() - offset)])
+    finally:
+        for output in outputs.values():
+            output.close()
+
+####################
+# Results index
+####################
+
+# The split results of all the projects in one SQLite database, one row per
+# call site and per declaration, with the fields the queries group by. Read
+# a record at a time from the .proto files, or from the JSON ones when there
+# are none.
+
+# The fields of schema.proto that are indexed: number -> (name, type, repeated).
+# Messages that are only counted have no type.
+RESULT_FIELDS = {
+    "CallSite": {1: ("name", "string", False), 2: ("code", "string", False), 3: ("location", "Location", False),
+                 4: ("isSynthetic", "bool", False), 5: ("declaration", "Declaration", False),
+                 6: ("typeArguments", None, True), 7: ("implicitArguments", None, True)},
+    "Declaration": {1: ("name", "string", False), 2: ("kind", "string", False), 3: ("location", "Location", False),
+                    4: ("isImplicit", "bool", False), 5: ("signature", "Signature", False),
+                    6: ("parents", None, True)},
+    "Location": {1: ("file", "string", False), 2: ("line", "int", False), 3: ("col", "int", False)},
+    "Signature": {2: ("parameterLists", "ParameterList", True)},
+    "ParameterList": {1: ("isImplicit", "bool", False)}
+}
+
+RESULT_TABLES = {
+    "callsites": ["project", "name", "code", "file", "line", "col", "synthetic", "declaration",
+                  "kind", "implicit_declaration", "type_arguments", "implicit_arguments"],
+    "declarations": ["project", "name", "kind", "file", "line", "col", "implicit", "parents",
+                     "implicit_parameter_lists"]
+}
+
+RESULT_INDEXES = {
+    "callsites": ["name", "kind", "declaration", "project"],
+    "declarations": ["name", "kind", "project"]
+}
+
+def decode_result(data, message):
+    # The indexed fields of the message as a dict, shaped like its JSON
+    fields = RESULT_FIELDS[message]
+    value = {}
+    pos = 0
+    while pos < len(data):
+        tag, pos = decode_varint(data, pos)
+        wire_type = tag & 0x7
+        if wire_type == 0:
+            raw, pos = decode_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = decode_varint(data, pos)
+            raw, pos = data[pos:pos + length], pos + length
+        elif wire_type in (1, 5):
+            size = 8 if wire_type == 1 else 4
+            raw, pos = data[pos:pos + size], pos + size
+        else:
+            raise ValueError("Unexpected wire type %d" % wire_type)
+        if tag >> 3 not in fields:
+            continue
+        name, kind, repeated = fields[tag >> 3]
+        if kind == "string":
+            decoded = raw.decode("utf-8")
+        elif kind == "bool":
+            decoded = raw != 0
+        elif kind == "int":
+            # Negative int32 are sign-extended to 64 bits
+            decoded = raw - (1 << 64) if raw >= 1 << 63 else raw
+        elif kind is None:
+            decoded = None
+        else:
+            decoded = decode_result(raw, kind)
+        if repeated:
+            value.setdefault(name, []).append(decoded)
+        else:
+            value[name] = decoded
+    return value
+
+def iter_split_results(results_path, name, message):
+    # The elements of results-<name>, from the records or else from the JSON
+    proto_path = find_artifact(os.path.join(results_path, "results-%s.proto" % name))
+    json_path = find_artifact(os.path.join(results_path, "results-%s.json" % name))
+    if os.path.exists(proto_path):
+        with open_artifact(proto_path, 'rb') as results_file:
+            for record in iter_delimited_records(results_file):
+                yield decode_result(record, message)
+    elif os.path.exists(json_path):
+        with open_artifact(json_path) as results_file:
+            for element in JSONStream(results_file).array():
+                yield element
+
+def get_callsite_row(project, callsite):
+    location = callsite.get("location") or {}
+    declaration = callsite.get("declaration") or {}
+    return (project, callsite.get("name"), callsite.get("code"),
+            location.get("file"), location.get("line"), location.get("col"),
+            int(bool(callsite.get("isSynthetic"))), declaration.get("name"), declaration.get("kind"),
+            int(bool(declaration.get("isImplicit"))),
+            len(callsite.get("typeArguments") or []), len(callsite.get("implicitArguments") or []))
+
+def get_declaration_row(project, declaration):
+    location = declaration.get("location") or {}
+    parameter_lists = (declaration.get("signature") or {}).get("parameterLists") or []
+    return (project, declaration.get("name"), declaration.get("kind"),
+            location.get("file"), location.get("line"), location.get("col"),
+            int(bool(declaration.get("isImplicit"))), len(declaration.get("parents") or []),
+            sum(1 for parameter_list in parameter_lists if parameter_list.get("isImplicit")))
+
+def get_split_results_fingerprint(results_path):
+    # Size and modification time of the split results, to skip the projects
+    # indexed since they last changed
+    parts = []
+    for name in ["callsites", "declarations"]:
+        for extension in ["proto", "json"]:
+            path = find_artifact(os.path.join(results_path, "results-%s.%s" % (name, extension)))
+            if os.path.exists(path):
+                stat = os.stat(path)
+                parts.append("%s:%d:%d" % (os.path.basename(path), stat.st_size, int(stat.st_mtime)))
+    return ",".join(parts)
+
+@task
+def index_results(
+        project_depth=BASE_CONFIG["default_location_depth"],
+        projects_path=BASE_CONFIG["projects_dest"],
+        exclude_unfinished=True,
+        database=BASE_CONFIG["results_index"]
+):
+    # Projects are indexed again only when their split results changed, and
+    # removed when they are no longer in the corpus
+    import sqlite3
+    P = Pipeline()
+    reports_folder = BASE_CONFIG["reports_folder"]
+    projects = get_project_list(projects_path, int(float(project_depth)))
+    if exclude_unfinished not in (False, "False", "false"):
+        projects = list(P.exclude_non_successful(projects, "split_results_report"))
+
+    connection = sqlite3.connect(database)
+    try:
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS projects (project TEXT PRIMARY KEY, fingerprint TEXT)")
+            for table, columns in RESULT_TABLES.items():
+                connection.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (table, ", ".join(columns)))
+        indexed = dict(connection.execute("SELECT project, fingerprint FROM projects"))
+        names = set()
+        updated = 0
+        for project in projects:
+            name = os.path.split(project)[1]
+            names.add(name)
+            results_path = os.path.join(project, reports_folder)
+            fingerprint = get_split_results_fingerprint(results_path)
+            if indexed.get(name) == fingerprint:
+                continue
+            try:
+                # One transaction per project: an interrupted run leaves no partial project
+                with connection:
+                    for table in RESULT_TABLES:
+                        connection.execute("DELETE FROM %s WHERE project = ?" % table, (name,))
+                    connection.executemany(
+                        "INSERT INTO callsites VALUES (%s)" % ", ".join("?" * len(RESULT_TABLES["callsites"])),
+                        (get_callsite_row(name, callsite)
+                         for callsite in iter_split_results(results_path, "callsites", "CallSite")))
+                    connection.executemany(
+                        "INSERT INTO declarations VALUES (%s)" % ", ".join("?" * len(RESULT_TABLES["declarations"])),
+                        (get_declaration_row(name, declaration)
+                         for declaration in iter_split_results(results_path, "declarations", "Declaration")))
+                    connection.execute("INSERT OR REPLACE INTO projects VALUES (?, ?)", (name, fingerprint))
+                updated += 1
+            except ValueError as e:
+                P.error("[Index][%s] Unreadable results: %s" % (name, e))
+
+        removed = set(indexed) - names
+        with connection:
+            for name in removed:
+                for table in list(RESULT_TABLES) + ["projects"]:
+                    connection.execute("DELETE FROM %s WHERE project = ?" % table, (name,))
+            # Created after the first load, cheaper than updating them row by row
+            for table, columns in RESULT_INDEXES.items():
+                for column in columns:
+                    connection.execute("CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)" % (table, column, table, column))
+        connection.execute("ANALYZE")
+        P.info("[Index] %d projects indexed, %d unchanged, %d removed in %s" % (
+            updated, len(names) - updated, len(removed), database))
+    finally:
+        connection.close()
+
+@task
+def query(
+        sql=None,
+        table="callsites",
+        group_by=None,
+        aggregate="count(*)",
+        where=None,
+        order_by=None,
+        limit=50,
+        output=None,
+        database=BASE_CONFIG["results_index"]
+):
+    # An SQL query over the index of index_results, or an aggregate of a table
+    # grouped by semicolon-separated columns, e.g.
+    #   fab query:group_by="kind;project",where="synthetic = 1"
+    # fab splits the arguments on commas, so commas in sql, where or aggregate
+    # are written \, e.g. fab query:sql="SELECT kind\, count(*) FROM callsites GROUP BY kind"
+    # The rows are printed, or written to the output CSV file.
+    import sqlite3
+    if sql is None:
+        columns = [column.strip() for column in group_by.split(";")] if group_by else []
+        sql = "SELECT %s FROM %s" % (", ".join(columns + ["%s AS value" % aggregate]), table)
+        if where:
+            sql += " WHERE %s" % where
+        if columns:
+            sql += " GROUP BY %s" % ", ".join(columns)
+        sql += " ORDER BY %s" % (order_by or "value DESC")
+        if limit is not None and int(limit) > 0:
+            sql += " LIMIT %d" % int(limit)
+
+    connection = sqlite3.connect(database)
+    connection.execute("PRAGMA mmap_size = %d" % (1 << 34))
+    try:
+        start = time.time()
+        cursor = connection.execute(sql)
+        headers = [description[0] for description in cursor.description]
+        if output is not None:
+            with open(output, 'w', newline='') as output_file:
+                writer = csv.writer(output_file)
+                writer.writerow(headers)
+                writer.writerows(cursor)
+            Pipeline().info("[Query] Written to %s in %.3fs" % (output, time.time() - start))
+        else:
+            print("\t".join(headers))
+            for row in cursor:
+                print("\t".join("" if value is None else str(value) for value in row))
+    finally:
+        connection.close()
+
+@task
+def merge(
+        project_depth=BASE_CONFIG["default_location_depth"],
+        projects_path=BASE_CONFIG["projects_dest"],
+        exclude_unfinished=True,
+        columnar=BASE_CONFIG["columnar_format"]
 ):
     merge_callsite_counts(project_depth, projects_path, exclude_unfinished)
     merge_paths(project_depth, projects_path, exclude_unfinished)
     merge_metadata(project_depth, projects_path, exclude_unfinished)
+    merge_results(project_depth, projects_path, exclude_unfinished)
     merge_reports(project_depth, projects_path)
+    if columnar:
+        for merged in ["callsite_counts_merged", "paths_merged", "project_metadata_merged", "sloc_merged"]:
+            export_columnar(BASE_CONFIG[merged], columnar)
+
+def parse_memory_size(size):
+    # JVM-style sizes: "512m", "2g", or plain bytes
+    units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+    size = size.strip().lower()
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def get_jvm_heap_size(jvm_options):
+    for option in jvm_options.split():
+        if option.startswith("-Xmx"):
+            return parse_memory_size(option[len("-Xmx"):])
+    return None
+
+def get_total_memory():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def get_corpus_job_memory():
+    # A job runs one tool JVM at a time (run_jvm_tool), with the typical heap
+    # of the tools: the sizing gives more only to the few large projects.
+    # The JVM daemons stay resident next to it.
+    daemon_config = BASE_CONFIG["jvm_daemon"]
+    tools_jvm_options = [BASE_CONFIG["analyzer_jvm_options"], BASE_CONFIG["callsite_counter_jvm_options"]]
+    memory = parse_memory_size(BASE_CONFIG["corpus_job_memory_overhead"])
+    memory += max(get_jvm_heap_size(jvm_options) or 0 for jvm_options in tools_jvm_options)
+    if daemon_config is not None:
+        memory += len(tools_jvm_options) * parse_memory_size(daemon_config["max_rss"])
+    return memory
+
+def get_corpus_job_limit(requested_jobs):
+    # Cap the number of jobs to what fits in physical memory
+    budget = get_corpus_job_memory()
+    total = get_total_memory()
+    if total is None:
+        return requested_jobs, budget
+    return max(1, min(requested_jobs, total // budget)), budget
+
+def get_tools_phase_options(tools_dir):
+    # The options of the phases that use the tools, to run them all from tools_dir
+    return {
+        "setup": {"tools_dest": tools_dir},
+        "analyze": {"tools_dir": tools_dir},
+        "count_callsites": {"tools_dir": tools_dir}
+    }
+
+def run_project_phases(project_path, tools_dir=BASE_CONFIG["tools_dir"]):
+    start = time.time()
+    results = run_phases(project_path, BASE_CONFIG["corpus_phases"], get_tools_phase_options(tools_dir))
+    failed_phases = [name for name, result in results.items() if not result.success]
+    return project_path, failed_phases, time.time() - start
+
+@task
+def run_corpus(
+        project_depth=BASE_CONFIG["default_location_depth"],
+        projects_path=BASE_CONFIG["projects_dest"],
+        jobs=multiprocessing.cpu_count(),
+        tools_dir=BASE_CONFIG["tools_dir"]
+):
+    P = Pipeline()
+    projects = get_project_list(projects_path, int(float(project_depth)))
+    jobs, budget = get_corpus_job_limit(int(jobs))
+    P.info("[Corpus] Running %d projects on %d jobs (%d MB per job)" % (len(projects), jobs, budget // 1024 ** 2))
+
+    # Download the tools once, so that the jobs do not race for them
+    setup(tools_dir)
+
+    start = time.time()
+    failures = 0
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.imap_unordered(functools.partial(run_project_phases, tools_dir=tools_dir), projects)
+        for done, (project_path, failed_phases, duration) in enumerate(results, 1):
+            if failed_phases:
+                failures += 1
+                P.error("[Corpus][%s] Failed phases: %s" % (project_path, ", ".join(failed_phases)))
+            throughput = done / (time.time() - start) * 3600
+            P.info("[Corpus] (%d/%d) %s finished in %.1fs, %.1f projects/hour" %
+                   (done, len(projects), project_path, duration, throughput))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    elapsed = time.time() - start
+    P.info("[Corpus] Done: %d projects, %d with failures, in %.1fs (%.1f projects/hour)" %
+           (len(projects), failures, elapsed, len(projects) / elapsed * 3600 if elapsed > 0 else 0))
 
 ####################
-# CSVManip
+# Distributed workers
 ####################
 
-import csv
+# Workers claim a project by creating its lease file, which stays theirs as
+# long as they touch it, and run the corpus phases on it. A project is done
+# when all the corpus phases have a report, so that a project left by a
+# crashed worker is resumed from its missing phases.
 
-# CSVFile: {
-#   header: List[Str],
-#   data: List[List[Str]]
-#}
+def get_lease_path(project_path, folder=BASE_CONFIG["worker_leases"]["folder"]):
+    return os.path.join(folder, hashlib.sha1(os.path.abspath(project_path).encode("utf-8")).hexdigest() + ".lease")
 
-def load_csv(path):
-    data = []
-    headers = []
-    with open(path, 'rb') as csvFile:
-        reader = csv.reader(csvFile)
-        headers = reader.next()
-        for line in reader:
-            data.append(line)
+def is_project_done(project_path):
+    # No corpus phase can still run: each has a report, or depends on a
+    # phase that failed (run_phases does not report those)
+    P = Pipeline()
+    status = {}
+    def failed(name):
+        # True or False once settled, None while it can still run
+        if name not in status:
+            spec = PHASES[name]
+            report = P.read_phase_report(project_path, spec.report) if spec.report else None
+            if report is not None:
+                status[name] = not PhaseResult.from_report(report).success
+            elif spec.report is None and not spec.dependencies:
+                # Always succeeds, like setup
+                status[name] = False
+            else:
+                status[name] = True if any(failed(dependency) for dependency in spec.dependencies) else None
+        return status[name]
+    return all(failed(name) is not None for name in BASE_CONFIG["corpus_phases"])
+
+class ProjectLease:
+    # Created with os.link, which is atomic on NFS too: only one worker
+    # creates the lease, whatever the number of workers trying to
+    def __init__(self, project_path, worker, config=BASE_CONFIG["worker_leases"]):
+        self.project_path = project_path
+        self.worker = worker
+        self.config = config
+        self.path = get_lease_path(project_path, config["folder"])
+        self.stopped = threading.Event()
+        self.heartbeat = None
+
+    def read(self):
+        # The content of the lease and its age, None when there is no lease
+        try:
+            with open(self.path) as lease_file:
+                content = json.load(lease_file)
+            return content, time.time() - os.path.getmtime(self.path)
+        except (OSError, ValueError):
+            return None
 
-    return {
-        "headers": headers,
-        "data": data
-    }
+    def create(self):
+        temporary = "%s.%s.tmp" % (self.path, uuid.uuid4().hex)
+        with open(temporary, 'w') as lease_file:
+            json.dump({"project": os.path.abspath(self.project_path), "worker": self.worker,
+                       "acquired": time.time()}, lease_file)
+        try:
+            os.link(temporary, self.path)
+            return True
+        except OSError:
+            return False
+        finally:
+            os.remove(temporary)
+
+    def steal(self):
+        # Moves an expired lease aside. Only one worker can move it; the
+        # one that moved a lease that was renewed meanwhile puts it back.
+        lease = self.read()
+        if lease is None or lease[1] < self.config["ttl"]:
+            return False
+        aside = "%s.%s.expired" % (self.path, uuid.uuid4().hex)
+        try:
+            os.rename(self.path, aside)
+        except OSError:
+            return False
+        try:
+            with open(aside) as lease_file:
+                content = json.load(lease_file)
+        except ValueError:
+            content = None
+        if content != lease[0] or time.time() - os.path.getmtime(aside) < self.config["ttl"]:
+            try:
+                os.link(aside, self.path)
+            except OSError:
+                pass
+            os.remove(aside)
+            return False
+        os.remove(aside)
+        Pipeline().error("[Worker][%s] Took over the expired lease of %s (%s, %.0fs old)" % (
+            self.worker, os.path.split(self.project_path)[1], lease[0].get("worker"), lease[1]))
+        return True
+
+    def claim(self):
+        if not self.create() and not (self.steal() and self.create()):
+            return False
+        self.heartbeat = threading.Thread(target=self.renew)
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
+        return True
+
+    def renew(self):
+        # Stops the project when another worker took the lease over: its
+        # commands are killed and its reports are no longer written
+        while not self.stopped.wait(self.config["heartbeat"]):
+            lease = self.read()
+            if lease is None or lease[0].get("worker") != self.worker:
+                Pipeline().error("[Worker][%s] Lost the lease of %s, stopping it" % (
+                    self.worker, os.path.split(self.project_path)[1]))
+                _lease_lost.set()
+                kill_process_groups()
+                return
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                # Moved aside by steal() meanwhile: the next heartbeat tells
+                # whether it was put back
+                pass
+
+    def release(self):
+        self.stopped.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+        lease = self.read()
+        if lease is not None and lease[0].get("worker") == self.worker:
+            os.remove(self.path)
+
+def run_worker_projects(projects, worker, tools_dir=BASE_CONFIG["tools_dir"]):
+    # Claims and runs the projects that are not done until they all are,
+    # waiting for the leases of other workers to be released or to expire.
+    # A worker runs a project at most once: one that is still not done after
+    # that (e.g. a phase crashed without a report) is left to other workers.
+    # Returns the number of projects run.
+    P = Pipeline()
+    # Every worker goes through the projects in its own order, to compete less for the same ones
+    projects = sorted(projects, key=lambda project: hashlib.sha1((worker + project).encode("utf-8")).hexdigest())
+    attempted = set()
+    run = 0
+    while True:
+        pending = [project for project in projects if project not in attempted and not is_project_done(project)]
+        if not pending:
+            return run
+        claimed = False
+        for project in pending:
+            lease = ProjectLease(project, worker)
+            if not lease.claim():
+                continue
+            claimed = True
+            try:
+                # Finished by another worker since it was listed
+                if is_project_done(project):
+                    continue
+                attempted.add(project)
+                project_path, failed_phases, duration = run_project_phases(project, tools_dir)
+                run += 1
+                if failed_phases:
+                    P.error("[Worker][%s][%s] Failed phases: %s" % (worker, project_path, ", ".join(failed_phases)))
+                P.info("[Worker][%s] %s finished in %.1fs" % (worker, project_path, duration))
+            finally:
+                lease.release()
+                _lease_lost.clear()
+        if not claimed:
+            # The rest is leased by other workers
+            time.sleep(BASE_CONFIG["worker_leases"]["heartbeat"])
+
+def run_worker_process(arguments):
+    projects, worker, tools_dir = arguments
+    return run_worker_projects(projects, worker, tools_dir)
 
-def load_many(paths):
-    return map(load_csv, paths)
+@task
+def run_worker(
+        project_depth=BASE_CONFIG["default_location_depth"],
+        projects_path=BASE_CONFIG["projects_dest"],
+        jobs=1,
+        tools_dir=BASE_CONFIG["tools_dir"]
+):
+    # Runs the corpus phases with the other workers started on this and other
+    # nodes against the same projects and lease folder, until all the projects
+    # are done. Start as many as needed, whenever.
+    P = Pipeline()
+    projects = get_project_list(projects_path, int(float(project_depth)))
+    jobs, budget = get_corpus_job_limit(int(jobs))
+    leases_folder = BASE_CONFIG["worker_leases"]["folder"]
+    if not os.path.exists(leases_folder):
+        os.makedirs(leases_folder, exist_ok=True)
+    worker = "%s:%d" % (socket.gethostname(), os.getpid())
+    P.info("[Worker][%s] Running %d projects on %d jobs (%d MB per job), leases in %s" % (
+        worker, len(projects), jobs, budget // 1024 ** 2, leases_folder))
+
+    setup(tools_dir)
+
+    start = time.time()
+    pool = multiprocessing.Pool(jobs)
+    try:
+        run = sum(pool.imap_unordered(run_worker_process,
+                                      [(projects, "%s/%d" % (worker, job), tools_dir) for job in range(jobs)]))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    P.info("[Worker][%s] Done: ran %d projects in %.1fs" % (worker, run, time.time() - start))
 
-def print_csv(csvf):
-    headers = ",".join(csvf["headers"]) + '\n'
-    data = '\n'.join(map(lambda line: ", ".join(line), csvf["data"]))
-    return "%s%s" % (headers, data)
+@task
+def worker_status(
+        project_depth=BASE_CONFIG["default_location_depth"],
+        projects_path=BASE_CONFIG["projects_dest"]
+):
+    # How many projects are done, leased (and by whom), expired and left
+    P = Pipeline()
+    projects = get_project_list(projects_path, int(float(project_depth)))
+    counts = collections.Counter()
+    workers = collections.Counter()
+    for project in projects:
+        if is_project_done(project):
+            counts["done"] += 1
+            continue
+        lease = ProjectLease(project, None).read()
+        if lease is None:
+            counts["pending"] += 1
+        elif lease[1] >= BASE_CONFIG["worker_leases"]["ttl"]:
+            counts["expired"] += 1
+        else:
+            counts["leased"] += 1
+            workers[lease[0].get("worker")] += 1
+    P.info("[Worker] %d projects: %d done, %d leased, %d expired, %d pending" % (
+        len(projects), counts["done"], counts["leased"], counts["expired"], counts["pending"]))
+    for worker, count in workers.most_common():
+        P.info("[Worker]   %s: %d" % (worker, count))
 
-def merge_csvs(one, other):
-    assert(one["headers"] != None)
-    assert(other["headers"] != None)
-    assert(one["headers"] == other["headers"])
-    #assert(((len(one["data"]) == 0) or (len(other["data"]) == 0)) or
-    #        (len(one["data"][1]) == len(other["data"][1])))
-    return {
-        "headers": one["headers"],
-        "data": one["data"] + other["data"]
-    }
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile
+    return sorted_values[max(0, int(math.ceil(fraction * len(sorted_values))) - 1)]
 
-def merge_all(csvs):
-    return reduce(lambda f1, f2: merge_csvs(f1, f2), csvs)
+@task
+def profile_corpus(trace=BASE_CONFIG["trace_file"], top=10):
+    # Where the time goes: percentiles of the traced phases, and the projects
+    # that took longest
+    P = Pipeline()
+    phases = collections.defaultdict(list)
+    projects = collections.defaultdict(list)
+    with open(trace) as trace_file:
+        for line in trace_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Partially written by a job that was killed
+                continue
+            if record["kind"] == "phase":
+                phases[record["phase"]].append(record)
+                projects[record["project"]].append(record)
+    total_wall = sum(record["wall"] for records in phases.values() for record in records)
+
+    P.info("[Profile] %d phases of %d projects, %.0fs in total" %
+           (sum(len(records) for records in phases.values()), len(projects), total_wall))
+    P.info("[Profile] %-24s %6s %6s %7s | wall p50/p90/p99/max (s) | cpu p50/p90/max (s) | rss p50/max (MB) | out p50/max (MB)" %
+           ("phase", "runs", "failed", "share"))
+    for name, records in sorted(phases.items(), key=lambda item: -sum(record["wall"] for record in item[1])):
+        wall = sorted(record["wall"] for record in records)
+        cpu = sorted(record["user_cpu"] + record["system_cpu"] for record in records)
+        rss = sorted(record["max_rss_kb"] / 1024.0 for record in records)
+        output = sorted(record["output_bytes"] / float(1 << 20) for record in records)
+        P.info("[Profile] %-24s %6d %6d %6.1f%% | %.1f/%.1f/%.1f/%.1f | %.1f/%.1f/%.1f | %.0f/%.0f | %.1f/%.1f" % (
+            name, len(records), sum(1 for record in records if not record["success"]),
+            100.0 * sum(wall) / total_wall if total_wall > 0 else 0,
+            percentile(wall, 0.5), percentile(wall, 0.9), percentile(wall, 0.99), wall[-1],
+            percentile(cpu, 0.5), percentile(cpu, 0.9), cpu[-1],
+            percentile(rss, 0.5), rss[-1],
+            percentile(output, 0.5), output[-1]))
+        reused = sum(record.get("shards_reused", 0) for record in records)
+        recomputed = sum(record.get("shards_recomputed", 0) for record in records)
+        if reused + recomputed > 0:
+            P.info("[Profile] %-24s shards: %d reused, %d recomputed (%.1f%% reused)" % (
+                "", reused, recomputed, 100.0 * reused / (reused + recomputed)))
+
+    P.info("[Profile] Slowest projects:")
+    slowest = sorted(projects.items(), key=lambda item: -sum(record["wall"] for record in item[1]))
+    for project, records in slowest[:int(top)]:
+        slowest_phase = max(records, key=lambda record: record["wall"])
+        P.info("[Profile] %8.0fs %s (%s: %.0fs)" % (
+            sum(record["wall"] for record in records), project, slowest_phase["phase"], slowest_phase["wall"]))
 
-def extend_csv(csvf, colname, coldata):
-    if (isinstance(coldata, list)):
-        assert(len(coldata) == len(csvf["data"]))
-        return {
-            "headers": csvf["headers"] + [colname],
-            "data": [csvf["data"][i] + [coldata[i]] for i in range(0, len(csvf["data"]))]
-        }
-    else:
+####################
+# CSVManip
+####################
+
+# The CSV files are streamed: only one row is in memory at a time, whatever
+# the number of files merged.
+
+def iter_csv(path):
+    # The first row is the headers. The file may be gzipped.
+    with open_artifact(path, newline='') as csv_file:
+        for row in csv.reader(csv_file):
+            yield row
+
+def read_csv_value(path, colname):
+    # The value of the column in the first data row, None if there is none
+    if not os.path.exists(find_artifact(path)):
+        return None
+    rows = iter_csv(path)
+    headers = next(rows, None)
+    row = next(rows, None)
+    rows.close()
+    if headers is None or row is None or colname not in headers:
+        return None
+    return row[headers.index(colname)]
+
+class CSVWriter:
+    # Writes comma-separated headers, and rows with their values separated by ", "
+    def __init__(self, output):
+        self.output = output
+        self.headers = None
+        self.rows = 0
+
+    def write_headers(self, headers):
+        self.headers = headers
+        self.output.write(",".join(headers) + "\n")
+
+    def write_row(self, row):
+        self.output.write(", ".join(row) + "\n")
+        self.rows += 1
+
+class MergeIndex:
+    # Remembers every source of a merged file: its size, modification time,
+    # hash, headers and extra columns, and keeps its rows, extra columns
+    # included, in a segment file. Sources that did not change are not read
+    # again: the merged file is rebuilt by concatenating the segments.
+    def __init__(self, output_path):
+        self.folder = os.path.join(BASE_CONFIG["merge_index_folder"], os.path.basename(output_path))
+        self.index_path = os.path.join(self.folder, "index.json")
+        self.entries = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index_file:
+                self.entries = json.load(index_file)
+
+    def segment_path(self, path):
+        return os.path.join(self.folder, hashlib.sha1(path.encode("utf-8")).hexdigest() + ".csv")
+
+    def is_fresh(self, path, values):
+        entry = self.entries.get(path)
+        if entry is None or entry["values"] != values or not os.path.exists(self.segment_path(path)):
+            return False
+        stat = os.stat(path)
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return True
+        # Touched, but maybe not changed
+        if entry["size"] == stat.st_size and entry["hash"] == hash_file(path):
+            entry["mtime"] = stat.st_mtime
+            return True
+        return False
+
+    def update(self, path, values, transform_headers):
+        # Returns the new entry, None if the source cannot be merged
+        rows = iter_csv(path)
+        headers = next(rows, None)
+        if headers is None:
+            return None
+        segment_path = self.segment_path(path)
+        first_row = None
+        with open(segment_path + ".tmp", 'w') as segment:
+            writer = CSVWriter(segment)
+            for row in rows:
+                if first_row is None:
+                    first_row = row
+                writer.write_row(row + values)
+        os.replace(segment_path + ".tmp", segment_path)
+        stat = os.stat(path)
         return {
-            "headers": csvf["headers"] + [colname],
-            "data": [row + [coldata] for row in csvf["data"]]
+            "headers": transform_headers(headers),
+            "values": values,
+            "rows": writer.rows,
+            "first_row": first_row,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "hash": hash_file(path)
         }
 
-def drop_header(csvf, index):
-    assert(len(csvf["headers"]) > len(csvf["data"][0]))
-    headers = csvf["headers"]
-    return {
-        "headers": headers[:index] + headers[index + 1:],
-        "data": csvf["data"]
-    }
+    def read_csv_value(self, path, colname):
+        # Same as read_csv_value, from the first row kept in the entry of the
+        # source while it did not change
+        path = os.path.abspath(find_artifact(path))
+        entry = self.entries.get(path)
+        if entry is None or "first_row" not in entry or not os.path.exists(path) \
+                or not self.is_fresh(path, entry["values"]):
+            return read_csv_value(path, colname)
+        if entry["first_row"] is None or colname not in entry["headers"]:
+            return None
+        return entry["first_row"][entry["headers"].index(colname)]
+
+    def save(self, paths):
+        # Forgets the sources that are no longer merged
+        for path in set(self.entries) - set(paths):
+            del self.entries[path]
+            if os.path.exists(self.segment_path(path)):
+                os.remove(self.segment_path(path))
+        with open(self.index_path + ".tmp", 'w') as index_file:
+            json.dump(self.entries, index_file)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+def merge_csv_files(output_path, sources, transform_headers=lambda headers: headers):
+    # Appends the rows of every source to the output. The sources are
+    # (path, extra columns) pairs, where the extra columns are (name, value)
+    # pairs appended to every row of the file. Files with headers that do not
+    # match the first file are skipped. Only the sources that changed since
+    # the last merge are read, on a thread pool.
+    P = Pipeline()
+    index = MergeIndex(output_path)
+    if not os.path.exists(index.folder):
+        os.makedirs(index.folder)
+
+    sources = [(os.path.abspath(find_artifact(path)), [name for name, _ in extra], [value for _, value in extra])
+               for path, extra in sources]
+    stale = []
+    skipped = set()
+    for path, _, values in sources:
+        if not os.path.exists(path):
+            P.error("[CSV] %s not found. Skipping" % path)
+            skipped.add(path)
+        elif not index.is_fresh(path, values):
+            stale.append((path, values))
+    P.info("[CSV] %s: reading %d changed files out of %d" % (output_path, len(stale), len(sources)))
+
+    with ThreadPoolExecutor(max_workers=BASE_CONFIG["merge_jobs"]) as executor:
+        updates = executor.map(lambda source: index.update(source[0], source[1], transform_headers), stale)
+        for (path, _), entry in zip(stale, updates):
+            if entry is None:
+                P.error("[CSV] %s is empty. Skipping" % path)
+                skipped.add(path)
+            else:
+                index.entries[path] = entry
+
+    with open(output_path, 'w') as output:
+        writer = CSVWriter(output)
+        for path, names, _ in sources:
+            if path in skipped:
+                continue
+            entry = index.entries[path]
+            headers = entry["headers"] + names
+            if writer.headers is None:
+                writer.write_headers(headers)
+            elif [h.strip() for h in headers] != [h.strip() for h in writer.headers]:
+                P.error("[CSV] Headers of %s (%s) do not match %s. Skipping" % (path, headers, writer.headers))
+                continue
+            with open(index.segment_path(path)) as segment:
+                shutil.copyfileobj(segment, output)
+            writer.rows += entry["rows"]
+    index.save([path for path, _, _ in sources if path not in skipped])
+    return writer.rows
 
-def create_csv(headers):
-    return {
-        "headers": headers,
-        "data": []
-    }
+####################
+# Columnar exports
+####################
 
-def add_row(csvf, row):
-    return {
-        "headers": csvf["headers"],
-        "data": csvf["data"] + [row]
-    }
+# Typed copies of the merged CSV files, so that the analyses do not have to
+# parse and trim large text files. Parquet files and the SQLite database can
+# both be memory-mapped when read back (see load_columnar).
+
+def iter_merged_csv(path):
+    # Headers and rows of a merged file, without the spaces after the separators
+    rows = iter_csv(path)
+    headers = [header.strip() for header in next(rows, [])]
+    def values():
+        for row in rows:
+            row = [value.strip() for value in row[:len(headers)]]
+            yield row + [None] * (len(headers) - len(row))
+    return headers, values()
+
+def to_integer(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def get_columnar_format(columnar_format):
+    if columnar_format != "auto":
+        return columnar_format
+    try:
+        import pyarrow
+        return "parquet"
+    except ImportError:
+        return "sqlite"
+
+def get_columnar_table_name(csv_path):
+    # paths.all.csv -> paths
+    return re.sub(r"\W", "_", os.path.basename(csv_path).split(".")[0])
+
+def export_columnar(csv_path, columnar_format=BASE_CONFIG["columnar_format"], batch_size=65536):
+    P = Pipeline()
+    if not os.path.exists(csv_path):
+        P.error("[Columnar] %s not found. Skipping" % csv_path)
+        return
+    columnar_format = get_columnar_format(columnar_format)
+    headers, rows = iter_merged_csv(csv_path)
+    integers = [header in BASE_CONFIG["columnar_integer_columns"] for header in headers]
+    typed_rows = ([to_integer(value) if integer else value for value, integer in zip(row, integers)] for row in rows)
+
+    if columnar_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        output_path = os.path.splitext(csv_path)[0] + ".parquet"
+        schema = pa.schema([(header, pa.int64() if integer else pa.string()) for header, integer in zip(headers, integers)])
+        with pq.ParquetWriter(output_path + ".tmp", schema, compression="zstd") as writer:
+            while True:
+                batch = [row for _, row in zip(range(batch_size), typed_rows)]
+                if not batch:
+                    break
+                columns = [pa.array(column, type=field.type) for column, field in zip(zip(*batch), schema)]
+                writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+        os.replace(output_path + ".tmp", output_path)
+    elif columnar_format == "sqlite":
+        import sqlite3
+        output_path = BASE_CONFIG["columnar_database"]
+        table = get_columnar_table_name(csv_path)
+        columns = ", ".join('"%s" %s' % (header, "INTEGER" if integer else "TEXT") for header, integer in zip(headers, integers))
+        connection = sqlite3.connect(output_path)
+        try:
+            with connection:
+                connection.execute('DROP TABLE IF EXISTS "%s"' % table)
+                connection.execute('CREATE TABLE "%s" (%s)' % (table, columns))
+                connection.executemany(
+                    'INSERT INTO "%s" VALUES (%s)' % (table, ", ".join("?" * len(headers))),
+                    typed_rows)
+        finally:
+            connection.close()
+    else:
+        P.error("[Columnar] Unknown format %s" % columnar_format)
+        return
+    P.info("[Columnar] Exported %s to %s" % (csv_path, output_path))
+
+def load_columnar(csv_path, columnar_format=BASE_CONFIG["columnar_format"]):
+    # Memory-mapped view of an exported file: a pyarrow Table for parquet,
+    # a sqlite3 connection (to query the table named after the file) for sqlite
+    columnar_format = get_columnar_format(columnar_format)
+    if columnar_format == "parquet":
+        import pyarrow.parquet as pq
+        return pq.read_table(os.path.splitext(csv_path)[0] + ".parquet", memory_map=True)
+    import sqlite3
+    connection = sqlite3.connect(BASE_CONFIG["columnar_database"])
+    connection.execute("PRAGMA mmap_size = %d" % (1 << 34))
+    return connection
 
-def get_data(csvf, row, colname):
-    colindex = csvf["headers"].index(colname)
-    return csvf["data"][row][colindex]
+####################
+# GitHub metadata
+####################
 
-        
+# One SQLite database for all the projects, so that concurrent corpus jobs can
+# share it. Failed lookups are kept with their reason, but fetched again,
+# except for repositories that were not found: those are kept like stars.
+GITHUB_NOT_FOUND = "HTTP 404"
+
+class GitHubMetadataStore:
+    def __init__(self, path=BASE_CONFIG["github_metadata_store"]):
+        import sqlite3
+        self.connection = sqlite3.connect(path, timeout=60)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS repos "
+                "(reponame TEXT PRIMARY KEY, stars INTEGER, fetched REAL, reason TEXT)")
+
+    def get(self, reponame):
+        # (stars, time fetched, reason it failed) or None
+        return self.connection.execute(
+            "SELECT stars, fetched, reason FROM repos WHERE reponame = ?", (reponame,)).fetchone()
+
+    def put_many(self, entries):
+        # entries: (reponame, stars, time fetched, reason it failed)
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO repos VALUES (?, ?, ?, ?)", entries)
+
+    def put(self, reponame, stars, reason=None):
+        self.put_many([(reponame, stars, time.time(), reason)])
+
+    def close(self):
+        self.connection.close()
+
+def fetch_github_stars(reponame):
+    # (stars, None), or (-1, reason) when they could not be fetched
+    request = urllib.request.Request(
+        "%s/repos/%s" % (BASE_CONFIG["github_api_url"].rstrip("/"), reponame),
+        headers={"Accept": "application/vnd.github.v3+json", "User-Agent": "scala-implicit-pipeline"})
+    if "GITHUB_TOKEN" in os.environ:
+        request.add_header("Authorization", "token %s" % os.environ["GITHUB_TOKEN"])
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            repo_info = json.loads(response.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        if e.headers.get("X-RateLimit-Remaining") == "0":
+            return -1, "rate limited until %s" % e.headers.get("X-RateLimit-Reset")
+        return -1, "HTTP %d" % e.code
+    # Also a connection dropped while reading the response
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        return -1, "unavailable (%s)" % e
+    return repo_info.get("stargazers_count", repo_info.get("watchers_count", -1)), None
+
+def get_github_stars(reponame):
+    # (stars, None), or (-1, reason) when they are neither in the store nor fetched.
+    # An expired entry is still used when fetching fails.
+    store = GitHubMetadataStore()
+    try:
+        entry = store.get(reponame)
+        ttl = BASE_CONFIG["github_metadata_ttl"]
+        if entry is not None and entry[2] in (None, GITHUB_NOT_FOUND):
+            stars, fetched, reason = entry
+            if ttl is None or time.time() - fetched < ttl or BASE_CONFIG["github_offline"]:
+                return stars, reason
+        if BASE_CONFIG["github_offline"]:
+            return -1, "offline" if entry is None else "offline, last lookup failed: %s" % entry[2]
+        stars, reason = fetch_github_stars(reponame)
+        if reason is None or reason == GITHUB_NOT_FOUND:
+            # A missing repository will not get stars either
+            store.put(reponame, stars, reason)
+            return stars, reason
+        if entry is not None and entry[2] is None:
+            return entry[0], None
+        store.put(reponame, stars, reason)
+        return stars, reason
+    finally:
+        store.close()
 
+@task
+def prefill_github_metadata(dump, store=BASE_CONFIG["github_metadata_store"]):
+    # Loads a JSON lines dump, e.g. from the GitHub API or GHTorrent, with one
+    # {"full_name": "scala/scala", "stargazers_count": 12000} per line ("reponame"
+    # and "stars" are accepted too, and "fetched" for the time of the dump)
+    P = Pipeline()
+    entries = []
+    with open(dump) as dump_file:
+        for line in dump_file:
+            if not line.strip():
+                continue
+            repo_info = json.loads(line)
+            reponame = repo_info.get("full_name", repo_info.get("reponame"))
+            stars = repo_info.get("stargazers_count", repo_info.get("stars", repo_info.get("watchers_count")))
+            if reponame is None or stars is None:
+                P.error("[Metadata] Skipping incomplete entry: %s" % line.strip())
+                continue
+            entries.append((reponame, int(stars), float(repo_info.get("fetched", time.time())), None))
+    metadata_store = GitHubMetadataStore(store)
+    try:
+        metadata_store.put_many(entries)
+    finally:
+        metadata_store.close()
+    P.info("[Metadata] Stored the stars of %d repositories in %s" % (len(entries), store))
+
+####################
+# Lines of code
+####################
 
+# cloc runs once per file content: the lines of every file are stored by git
+# blob hash, and counting a commit only runs cloc on the files that were not
+# in any commit counted before, in this project or another.
+
+class SlocStore:
+    def __init__(self, path=BASE_CONFIG["sloc_store"]):
+        import sqlite3
+        self.connection = sqlite3.connect(path, timeout=60)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS blobs "
+                "(blob TEXT PRIMARY KEY, language TEXT, blank INTEGER, comment INTEGER, code INTEGER)")
+
+    def get_many(self, blobs, chunk_size=500):
+        # blob -> (language, blank, comment, code), the language is None for
+        # files that cloc does not count
+        counts = {}
+        blobs = list(blobs)
+        for start in range(0, len(blobs), chunk_size):
+            chunk = blobs[start:start + chunk_size]
+            rows = self.connection.execute(
+                "SELECT * FROM blobs WHERE blob IN (%s)" % ", ".join("?" * len(chunk)), chunk)
+            counts.update((row[0], tuple(row[1:])) for row in rows)
+        return counts
+
+    def put_many(self, counts):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?)",
+                ((blob,) + tuple(count) for blob, count in counts.items()))
+
+    def close(self):
+        self.connection.close()
+
+def get_sloc_report_commit(report_path):
+    # The commit is written where cloc puts its version and timestamp
+    if not os.path.exists(report_path):
+        return None
+    headers = next(iter_csv(report_path), [])
+    if len(headers) == 6 and headers[5].startswith("commit "):
+        return headers[5][len("commit "):]
+    return None
+
+def list_commit_files(repo_path, commit):
+    # (path, blob) of the files of the commit, outside of the excluded folders
+    excluded = set(BASE_CONFIG["sloc_excluded_folders"])
+    tree = Pipeline().local("git ls-tree -r -z %s" % commit, repo_path)
+    for entry in tree.split("\0"):
+        if not entry:
+            continue
+        info, path = entry.split("\t", 1)
+        mode, kind, blob = info.split()
+        # Symbolic links and submodules are not counted
+        if kind == "blob" and mode != "120000" and excluded.isdisjoint(path.split("/")[:-1]):
+            yield path, blob
+
+def count_blob_locs(repo_path, files):
+    # Runs cloc on the (path, blob) files, read from git into a temporary folder.
+    # Blobs git does not have (e.g. in a partial clone) are left out of the counts.
+    P = Pipeline()
+    counts = {}
+    folder = tempfile.mkdtemp(prefix="sloc-")
+    try:
+        blobs = {}
+        with open(os.path.join(folder, "blobs"), "w") as blob_list:
+            blob_list.write("".join(blob + "\n" for _, blob in files))
+        with open(os.path.join(folder, "blobs")) as blob_list:
+            process = subprocess.Popen(["git", "cat-file", "--batch"], cwd=repo_path,
+                                       stdin=blob_list, stdout=subprocess.PIPE)
+            for path, blob in files:
+                # "<blob> blob <size>", or "<blob> missing" with no content
+                header = process.stdout.readline().split()
+                if len(header) < 3:
+                    P.error("[Metadata] %s (%s) not found in %s" % (blob, path, repo_path))
+                    continue
+                counts[blob] = (None, 0, 0, 0)
+                remaining = int(header[2])
+                file_path = os.path.join(folder, "files", path)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, "wb") as output:
+                    while remaining > 0:
+                        chunk = process.stdout.read(min(remaining, 1 << 20))
+                        output.write(chunk)
+                        remaining -= len(chunk)
+                process.stdout.read(1)
+                blobs[os.path.normpath(path)] = blob
+            process.stdout.close()
+            if process.wait() != 0:
+                abort("git cat-file failed in %s" % repo_path)
+
+        processes = BASE_CONFIG["sloc_processes"]
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        by_file = os.path.join(folder, "by-file.csv")
+        P.local("cloc --by-file --csv --quiet %s--out=%s ." % (
+            "--processes=%d " % processes if processes > 1 else "", by_file), os.path.join(folder, "files"))
+        if os.path.exists(by_file):
+            with open(by_file) as csv_file:
+                for line in csv.DictReader(csv_file):
+                    blob = blobs.get(os.path.normpath(line["filename"]))
+                    if line["language"] != "SUM" and blob is not None:
+                        counts[blob] = (line["language"], int(line["blank"]), int(line["comment"]), int(line["code"]))
+    finally:
+        shutil.rmtree(folder)
+    return counts
+
+def write_commit_locs(repo_path, commit, report_path):
+    # Writes a report like cloc --csv for the files of the commit. Like cloc,
+    # files with the same content are only counted once.
+    files = list(list_commit_files(repo_path, commit))
+    store = SlocStore()
+    try:
+        counts = store.get_many(set(blob for _, blob in files))
+        missing = {}
+        for path, blob in files:
+            if blob not in counts:
+                missing.setdefault(blob, path)
+        if missing:
+            Pipeline().info("[Metadata] Counting the lines of %d of %d files" % (len(missing), len(files)))
+            new_counts = count_blob_locs(repo_path, [(path, blob) for blob, path in missing.items()])
+            store.put_many(new_counts)
+            counts.update(new_counts)
+    finally:
+        store.close()
+
+    languages = {}
+    for blob in set(blob for _, blob in files):
+        # Counted as empty when git does not have it, and not stored
+        language, blank, comment, code = counts.get(blob, (None, 0, 0, 0))
+        if language is not None:
+            totals = languages.setdefault(language, [0, 0, 0, 0])
+            for i, value in enumerate((1, blank, comment, code)):
+                totals[i] += value
+    rows = sorted(languages.items(), key=lambda item: (-item[1][3], item[0]))
+    with open(report_path + ".tmp", "w") as report:
+        writer = csv.writer(report, lineterminator="\n")
+        writer.writerow(["files", "language", "blank", "comment", "code", "commit %s" % commit])
+        for language, (file_count, blank, comment, code) in rows:
+            writer.writerow([file_count, language, blank, comment, code])
+        file_count, blank, comment, code = [sum(totals[i] for _, totals in rows) for i in range(4)]
+        writer.writerow([file_count, "SUM", blank, comment, code])
+    os.replace(report_path + ".tmp", report_path)
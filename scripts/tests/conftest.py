@@ -0,0 +1,5 @@
+import os
+import sys
+
+# run.py is a fabfile, not a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
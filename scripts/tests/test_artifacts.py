@@ -0,0 +1,70 @@
+import gzip
+import os
+import time
+
+import pytest
+
+pytest.importorskip("fabric")
+import run
+
+
+@pytest.fixture
+def compressed(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(run.BASE_CONFIG, "compressed_artifacts", {"names": ["results.json"], "level": 6})
+
+
+def read(path, mode='r'):
+    with run.open_artifact(path, mode) as f:
+        return f.read()
+
+
+def write(path, content, mode='w'):
+    with run.open_artifact(path, mode) as f:
+        f.write(content)
+
+
+def test_compressed_artifacts_are_gzipped(compressed):
+    write("results.json", '{"callSites": []}')
+    assert not os.path.exists("results.json")
+    with gzip.open("results.json.gz", 'rt') as f:
+        assert f.read() == '{"callSites": []}'
+    assert run.find_artifact("results.json") == "results.json.gz"
+    assert read("results.json") == '{"callSites": []}'
+    assert read("results.json", 'rb') == b'{"callSites": []}'
+
+
+def test_other_artifacts_are_plain(compressed):
+    write("paths.csv", "a,b\n")
+    assert run.find_artifact("paths.csv") == "paths.csv"
+    assert not os.path.exists("paths.csv.gz")
+    assert read("paths.csv") == "a,b\n"
+
+
+def test_the_other_version_is_removed(compressed, monkeypatch):
+    with open("results.json", 'w') as f:
+        f.write("old")
+    write("results.json", "new")
+    assert os.listdir(".") == ["results.json.gz"]
+
+    monkeypatch.setitem(run.BASE_CONFIG, "compressed_artifacts", None)
+    write("results.json", "plain")
+    assert os.listdir(".") == ["results.json"]
+    assert read("results.json") == "plain"
+
+
+def test_gzipped_artifacts_do_not_depend_on_the_time(compressed):
+    write("results.json", "same content")
+    with open("results.json.gz", 'rb') as f:
+        first = f.read()
+    time.sleep(1.1)
+    write("results.json", "same content")
+    with open("results.json.gz", 'rb') as f:
+        assert f.read() == first
+
+
+def test_missing_artifacts(compressed):
+    assert run.find_artifact("results.json") == "results.json"
+    assert run.find_artifact("results.json.gz") == "results.json.gz"
+    with pytest.raises(OSError):
+        read("results.json")
@@ -0,0 +1,104 @@
+import http.server
+import json
+import socket
+import struct
+import threading
+
+import pytest
+
+pytest.importorskip("fabric")
+import run
+
+
+class GitHubStub(http.server.BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        GitHubStub.requests.append(self.path)
+        if self.path == "/repos/scala/scala":
+            body = json.dumps({"stargazers_count": 42}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/repos/rate/limited":
+            self.send_response(403)
+            self.send_header("X-RateLimit-Remaining", "0")
+            self.send_header("X-RateLimit-Reset", "1234")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path == "/repos/connection/reset":
+            # Half of the response, then a reset instead of the rest
+            self.send_response(200)
+            self.send_header("Content-Length", "1000")
+            self.end_headers()
+            self.wfile.write(b'{"stargazers')
+            self.wfile.flush()
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            self.connection.close()
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def github(monkeypatch, tmp_path):
+    server = http.server.HTTPServer(("127.0.0.1", 0), GitHubStub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    GitHubStub.requests = []
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(run.BASE_CONFIG, "github_api_url", "http://127.0.0.1:%d" % server.server_port)
+    monkeypatch.setitem(run.BASE_CONFIG, "github_offline", False)
+    monkeypatch.delenv("GITHUB_TOKEN", raising=False)
+    yield GitHubStub.requests
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_stars(github):
+    assert run.fetch_github_stars("scala/scala") == (42, None)
+
+
+def test_fetch_missing_repository(github):
+    assert run.fetch_github_stars("no/such") == (-1, run.GITHUB_NOT_FOUND)
+
+
+def test_fetch_rate_limited(github):
+    assert run.fetch_github_stars("rate/limited") == (-1, "rate limited until 1234")
+
+
+def test_fetch_connection_reset(github):
+    stars, reason = run.fetch_github_stars("connection/reset")
+    assert stars == -1
+    assert reason.startswith("unavailable")
+
+
+def test_stars_are_stored(github):
+    assert run.get_github_stars("scala/scala") == (42, None)
+    assert run.get_github_stars("scala/scala") == (42, None)
+    assert github == ["/repos/scala/scala"]
+
+
+def test_missing_repositories_are_stored_as_not_found(github):
+    assert run.get_github_stars("no/such") == (-1, run.GITHUB_NOT_FOUND)
+    assert run.get_github_stars("no/such") == (-1, run.GITHUB_NOT_FOUND)
+    assert github == ["/repos/no/such"]
+
+
+def test_failed_lookups_are_fetched_again(github):
+    assert run.get_github_stars("rate/limited")[0] == -1
+    assert run.get_github_stars("rate/limited")[0] == -1
+    assert github == ["/repos/rate/limited", "/repos/rate/limited"]
+
+
+def test_expired_stars_are_kept_when_fetching_fails(github):
+    store = run.GitHubMetadataStore()
+    store.put_many([("rate/limited", 7, 0.0, None)])
+    store.close()
+    assert run.get_github_stars("rate/limited") == (7, None)
+    assert github == ["/repos/rate/limited"]
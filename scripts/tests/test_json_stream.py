@@ -0,0 +1,73 @@
+import io
+import json
+
+import pytest
+
+pytest.importorskip("fabric")
+import run
+
+DOCUMENT = {
+    "callSites": [{"name": "map", "line": 12, "ratio": -2.5e10}, {"name": "flatMap", "tags": []}],
+    "empty": {},
+    "numbers": [1, -20, 3.25, 400000, 5e-3],
+    "text": "a \"quoted\", [bracketed] {braced} string",
+    "declarations": []
+}
+
+
+def read_document(stream):
+    # The document rebuilt from its keys and values, read one at a time
+    document = {}
+    for key in stream.keys():
+        if isinstance(DOCUMENT[key], list):
+            document[key] = list(stream.array())
+        else:
+            document[key] = stream.value()
+    return document
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1 << 20])
+def test_read_by_chunks(chunk_size):
+    stream = run.JSONStream(io.StringIO(json.dumps(DOCUMENT)), chunk_size)
+    assert read_document(stream) == DOCUMENT
+    assert stream.peek() is None
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 1 << 20])
+def test_read_indented(chunk_size):
+    stream = run.JSONStream(io.StringIO(json.dumps(DOCUMENT, indent=2)), chunk_size)
+    assert read_document(stream) == DOCUMENT
+
+
+def test_numbers_at_the_end_of_a_chunk():
+    # "-2." is a complete number until the rest of the chunk is read
+    stream = run.JSONStream(io.StringIO("[-2.5e10, 12345]"), 3)
+    assert list(stream.array()) == [-2.5e10, 12345]
+
+
+def test_empty_containers():
+    assert list(run.JSONStream(io.StringIO("  [ ] ")).array()) == []
+    assert list(run.JSONStream(io.StringIO("{}")).keys()) == []
+
+
+def test_array_elements_are_read_lazily():
+    stream = run.JSONStream(io.StringIO("[1, 2, oops]"), 1)
+    elements = stream.array()
+    assert next(elements) == 1
+    assert next(elements) == 2
+    with pytest.raises(ValueError):
+        next(elements)
+
+
+@pytest.mark.parametrize("text", ["", "[1, 2", "[1 2]", "[1,]"])
+def test_malformed_arrays(text):
+    with pytest.raises(ValueError):
+        list(run.JSONStream(io.StringIO(text), 2).array())
+
+
+@pytest.mark.parametrize("text", ["{\"a\" 1}", "{\"a\": 1", "{\"a\": 1 \"b\": 2}"])
+def test_malformed_objects(text):
+    stream = run.JSONStream(io.StringIO(text), 2)
+    with pytest.raises(ValueError):
+        for _ in stream.keys():
+            stream.value()
@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("fabric")
+import run
+
+
+@pytest.fixture
+def config(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(run, "_lease_lost", threading.Event())
+    monkeypatch.setattr(run, "_process_groups", set())
+    os.mkdir("leases")
+    # No heartbeat during the tests unless they ask for one
+    return {"folder": "leases", "heartbeat": 3600, "ttl": 60}
+
+
+def expire(lease, config):
+    old = time.time() - config["ttl"] - 1
+    os.utime(lease.path, (old, old))
+
+
+def test_claim_and_release(config):
+    lease = run.ProjectLease("projects/a", "worker-1", config)
+    assert lease.claim()
+    content, age = lease.read()
+    assert content["worker"] == "worker-1"
+    assert content["project"] == os.path.abspath("projects/a")
+    assert age < config["ttl"]
+
+    lease.release()
+    assert lease.read() is None
+    assert os.listdir("leases") == []
+
+
+def test_one_lease_per_project(config):
+    first = run.ProjectLease("projects/a", "worker-1", config)
+    assert first.claim()
+    assert not run.ProjectLease("projects/a", "worker-2", config).claim()
+    assert run.ProjectLease("projects/b", "worker-2", config).claim()
+    first.release()
+    assert run.ProjectLease("projects/a", "worker-2", config).claim()
+
+
+def test_concurrent_claims(config):
+    leases = [run.ProjectLease("projects/a", "worker-%d" % i, config) for i in range(16)]
+    barrier = threading.Barrier(len(leases))
+    claimed = []
+
+    def claim(lease):
+        barrier.wait()
+        if lease.create():
+            claimed.append(lease.worker)
+
+    threads = [threading.Thread(target=claim, args=(lease,)) for lease in leases]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(claimed) == 1
+    assert run.ProjectLease("projects/a", "reader", config).read()[0]["worker"] == claimed[0]
+
+
+def test_expired_leases_are_taken_over(config):
+    first = run.ProjectLease("projects/a", "worker-1", config)
+    assert first.create()
+    second = run.ProjectLease("projects/a", "worker-2", config)
+    assert not second.steal()
+
+    expire(first, config)
+    assert second.claim()
+    assert second.read()[0]["worker"] == "worker-2"
+    # The first worker no longer removes the lease it lost
+    first.release()
+    assert second.read()[0]["worker"] == "worker-2"
+    second.release()
+    assert os.listdir("leases") == []
+
+
+def test_renewed_leases_are_not_taken_over(config):
+    first = run.ProjectLease("projects/a", "worker-1", config)
+    assert first.create()
+    expire(first, config)
+    second = run.ProjectLease("projects/a", "worker-2", config)
+    read = second.read
+
+    def renewed_meanwhile():
+        # The lease is renewed between the read and the move of steal()
+        lease = read()
+        os.utime(first.path, None)
+        return lease
+
+    second.read = renewed_meanwhile
+    assert not second.steal()
+    second.read = read
+    assert second.read()[0]["worker"] == "worker-1"
+    assert os.listdir("leases") == [os.path.basename(first.path)]
+
+
+def test_heartbeat_renews_the_lease(config):
+    config["heartbeat"] = 0.01
+    lease = run.ProjectLease("projects/a", "worker-1", config)
+    assert lease.claim()
+    expire(lease, config)
+    time.sleep(0.2)
+    assert lease.read()[1] < config["ttl"]
+    lease.release()
+    assert not lease.heartbeat.is_alive()
+
+
+def test_lost_leases_stop_the_project(config):
+    config["heartbeat"] = 0.01
+    lease = run.ProjectLease("projects/a", "worker-1", config)
+    assert lease.claim()
+    # Taken over by another worker, as steal() does once the lease expired
+    other = run.ProjectLease("projects/a", "worker-2", dict(config, heartbeat=3600))
+    os.remove(lease.path)
+    assert other.claim()
+    lease.heartbeat.join(5)
+    assert not lease.heartbeat.is_alive()
+    assert run._lease_lost.is_set()
+    lease.release()
+    assert other.read()[0]["worker"] == "worker-2"
+    other.release()
@@ -0,0 +1,133 @@
+import os
+
+import pytest
+
+pytest.importorskip("fabric")
+import run
+
+
+@pytest.fixture
+def updates(monkeypatch, tmp_path):
+    # The sources read by every merge
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(run.BASE_CONFIG, "trace_file", None)
+    updated = []
+    update = run.MergeIndex.update
+
+    def spy(self, path, values, transform_headers):
+        updated.append(os.path.basename(path))
+        return update(self, path, values, transform_headers)
+
+    monkeypatch.setattr(run.MergeIndex, "update", spy)
+    return updated
+
+
+def write_csv(name, content):
+    with open(name, 'w') as f:
+        f.write(content)
+    return name
+
+
+def read_lines(path):
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+def merge(sources):
+    return run.merge_csv_files("merged.csv", [(path, [("project", project)]) for path, project in sources])
+
+
+def test_first_merge_reads_every_source(updates):
+    write_csv("a.csv", "name,count\nmap,1\nflatMap,2\n")
+    write_csv("b.csv", "name,count\nfilter,3\n")
+
+    assert merge([("a.csv", "a"), ("b.csv", "b")]) == 3
+    assert sorted(updates) == ["a.csv", "b.csv"]
+    assert read_lines("merged.csv") == ["name,count,project", "map, 1, a", "flatMap, 2, a", "filter, 3, b"]
+
+
+def test_unchanged_sources_are_not_read_again(updates):
+    write_csv("a.csv", "name,count\nmap,1\n")
+    write_csv("b.csv", "name,count\nfilter,3\n")
+    merge([("a.csv", "a"), ("b.csv", "b")])
+    first = read_lines("merged.csv")
+    del updates[:]
+
+    assert merge([("a.csv", "a"), ("b.csv", "b")]) == 2
+    assert updates == []
+    assert read_lines("merged.csv") == first
+
+
+def test_changed_sources_are_read_again(updates):
+    write_csv("a.csv", "name,count\nmap,1\n")
+    write_csv("b.csv", "name,count\nfilter,3\n")
+    merge([("a.csv", "a"), ("b.csv", "b")])
+    del updates[:]
+
+    write_csv("b.csv", "name,count\nfilter,3\nfold,4\n")
+    assert merge([("a.csv", "a"), ("b.csv", "b")]) == 3
+    assert updates == ["b.csv"]
+    assert read_lines("merged.csv")[1:] == ["map, 1, a", "filter, 3, b", "fold, 4, b"]
+
+
+def test_touched_sources_are_not_read_again(updates):
+    write_csv("a.csv", "name,count\nmap,1\n")
+    merge([("a.csv", "a")])
+    del updates[:]
+
+    stat = os.stat("a.csv")
+    os.utime("a.csv", (stat.st_atime + 10, stat.st_mtime + 10))
+    merge([("a.csv", "a")])
+    assert updates == []
+    assert run.MergeIndex("merged.csv").entries[os.path.abspath("a.csv")]["mtime"] == stat.st_mtime + 10
+
+
+def test_sources_with_other_extra_columns_are_read_again(updates):
+    write_csv("a.csv", "name,count\nmap,1\n")
+    merge([("a.csv", "a")])
+    del updates[:]
+
+    merge([("a.csv", "renamed")])
+    assert updates == ["a.csv"]
+    assert read_lines("merged.csv")[1:] == ["map, 1, renamed"]
+
+
+def test_removed_sources_are_forgotten(updates):
+    write_csv("a.csv", "name,count\nmap,1\n")
+    write_csv("b.csv", "name,count\nfilter,3\n")
+    merge([("a.csv", "a"), ("b.csv", "b")])
+    index = run.MergeIndex("merged.csv")
+    segment = index.segment_path(os.path.abspath("b.csv"))
+    assert os.path.exists(segment)
+
+    merge([("a.csv", "a")])
+    assert not os.path.exists(segment)
+    assert list(run.MergeIndex("merged.csv").entries) == [os.path.abspath("a.csv")]
+    assert read_lines("merged.csv")[1:] == ["map, 1, a"]
+
+
+def test_skipped_sources(updates):
+    write_csv("a.csv", "name,count\nmap,1\n")
+    write_csv("b.csv", "other,headers\nx,y\n")
+    write_csv("empty.csv", "")
+
+    assert merge([("a.csv", "a"), ("b.csv", "b"), ("empty.csv", "e"), ("missing.csv", "m")]) == 1
+    assert read_lines("merged.csv") == ["name,count,project", "map, 1, a"]
+
+
+def test_read_csv_value_from_the_index(updates, monkeypatch):
+    write_csv("a.csv", "name,count\nmap,1\nflatMap,2\n")
+    merge([("a.csv", "a")])
+    index = run.MergeIndex("merged.csv")
+    read = []
+    read_csv_value = run.read_csv_value
+    monkeypatch.setattr(run, "read_csv_value", lambda path, colname: read.append(path) or read_csv_value(path, colname))
+
+    assert index.read_csv_value("a.csv", "count") == "1"
+    assert index.read_csv_value("a.csv", "missing") is None
+    assert read == []
+
+    write_csv("a.csv", "name,count\nfold,12\n")
+    assert index.read_csv_value("a.csv", "count") == "12"
+    assert read == [os.path.abspath("a.csv")]
+    assert index.read_csv_value("b.csv", "count") is None
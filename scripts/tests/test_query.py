@@ -0,0 +1,114 @@
+import csv
+import json
+import os
+import sqlite3
+
+import pytest
+
+pytest.importorskip("fabric")
+import run
+
+
+def encode_varint(value):
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def field(number, value):
+    # A string, message or bool field of a protobuf message
+    if isinstance(value, bool):
+        return encode_varint(number << 3) + encode_varint(int(value))
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return encode_varint(number << 3 | 2) + encode_varint(len(value)) + value
+
+
+def delimited(message):
+    return encode_varint(len(message)) + message
+
+
+@pytest.fixture
+def database(monkeypatch, tmp_path):
+    # Two projects, one with records and one with the JSON view only
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(run.BASE_CONFIG, "trace_file", None)
+    reports_folder = run.BASE_CONFIG["reports_folder"]
+    os.makedirs(os.path.join("projects", "records", reports_folder))
+    os.makedirs(os.path.join("projects", "json", reports_folder))
+
+    implicit_def = field(2, "def") + field(4, True)
+    with open(os.path.join("projects", "records", reports_folder, "results-callsites.proto"), 'wb') as f:
+        f.write(delimited(field(1, "map") + field(3, field(1, "A.scala")) + field(5, field(2, "def"))))
+        f.write(delimited(field(1, "conv") + field(4, True) + field(5, implicit_def)))
+        f.write(delimited(field(1, "conv") + field(4, True) + field(5, implicit_def)))
+    with open(os.path.join("projects", "records", reports_folder, "results-declarations.proto"), 'wb') as f:
+        f.write(delimited(field(1, "conv") + field(2, "def") + field(4, True)))
+
+    with open(os.path.join("projects", "json", reports_folder, "results-callsites.json"), 'w') as f:
+        json.dump([{"name": "apply", "isSynthetic": True, "declaration": {"kind": "object"}},
+                   {"name": "map", "declaration": {"kind": "def"}}], f)
+    with open(os.path.join("projects", "json", reports_folder, "results-declarations.json"), 'w') as f:
+        json.dump([], f)
+
+    run.index_results(projects_path="projects", exclude_unfinished=False, database="results.db")
+    return "results.db"
+
+
+def query(database, **arguments):
+    run.query(database=database, output="query.csv", **arguments)
+    with open("query.csv", newline='') as f:
+        return list(csv.reader(f))
+
+
+def test_index(database):
+    connection = sqlite3.connect(database)
+    rows = sorted(connection.execute("SELECT project, name, file, synthetic, kind, implicit_declaration FROM callsites"))
+    connection.close()
+    assert rows == [("json", "apply", None, 1, "object", 0), ("json", "map", None, 0, "def", 0),
+                    ("records", "conv", None, 1, "def", 1), ("records", "conv", None, 1, "def", 1),
+                    ("records", "map", "A.scala", 0, "def", 0)]
+
+
+def test_count(database):
+    assert query(database) == [["value"], ["5"]]
+
+
+def test_group_by_one_column(database):
+    assert query(database, group_by="kind") == [["kind", "value"], ["def", "4"], ["object", "1"]]
+
+
+def test_group_by_several_columns(database):
+    rows = query(database, group_by=" project ;kind", order_by="project, kind")
+    assert rows == [["project", "kind", "value"], ["json", "def", "1"], ["json", "object", "1"],
+                    ["records", "def", "3"]]
+
+
+def test_group_by_with_where_aggregate_and_limit(database):
+    rows = query(database, group_by="name", aggregate="count(distinct project)", where="kind = 'def'", limit=1)
+    assert rows == [["name", "value"], ["map", "2"]]
+
+
+def test_other_tables(database):
+    assert query(database, table="declarations", group_by="project;implicit") == \
+        [["project", "implicit", "value"], ["records", "1", "1"]]
+
+
+def test_sql(database):
+    rows = query(database, sql="SELECT name FROM callsites WHERE synthetic = 1 ORDER BY name, project")
+    assert rows == [["name"], ["apply"], ["conv"], ["conv"]]
+
+
+def test_unchanged_projects_are_not_indexed_again(database, monkeypatch):
+    indexed = []
+    monkeypatch.setattr(run, "get_callsite_row", lambda project, callsite: indexed.append(project))
+    run.index_results(projects_path="projects", exclude_unfinished=False, database=database)
+    assert indexed == []
+    assert query(database, group_by="project", order_by="project") == \
+        [["project", "value"], ["json", "2"], ["records", "3"]]
@@ -0,0 +1,161 @@
+import io
+import os
+
+import pytest
+
+pytest.importorskip("fabric")
+import run
+
+
+def encode_varint(value):
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def delimited(message):
+    return encode_varint(len(message)) + message
+
+
+def analysis_record(field, element):
+    # An AnalysisRecord with its oneof set to the length-delimited element
+    return encode_varint(field << 3 | 2) + delimited(element)
+
+
+@pytest.fixture
+def project(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    path = os.path.join("projects", "project")
+    os.makedirs(os.path.join(path, run.BASE_CONFIG["reports_folder"]))
+    return path
+
+
+def reports_path(project, name):
+    return os.path.join(project, run.BASE_CONFIG["reports_folder"], name)
+
+
+def write_report(project, name, content):
+    with open(reports_path(project, name), 'wb') as f:
+        f.write(content)
+
+
+def read_report(project, name):
+    with open(reports_path(project, name), 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("value", [0, 1, 127, 128, 300, 1 << 32, (1 << 64) - 1])
+def test_decode_varint(value):
+    data = b"\xff" + encode_varint(value) + b"\x01"
+    assert run.decode_varint(data, 1) == (value, len(data) - 1)
+
+
+def test_decode_truncated_varint():
+    with pytest.raises(ValueError):
+        run.decode_varint(b"\x96")
+    with pytest.raises(ValueError):
+        run.decode_varint(b"", 0)
+
+
+def test_read_varint():
+    stream = io.BytesIO(encode_varint(300) + encode_varint(1))
+    assert run.read_varint(stream) == 300
+    assert run.read_varint(stream) == 1
+    assert run.read_varint(stream) is None
+
+
+def test_read_truncated_varint():
+    with pytest.raises(ValueError):
+        run.read_varint(io.BytesIO(b"\xac"))
+
+
+def test_iter_delimited_records():
+    records = [b"", b"a", b"x" * 300]
+    stream = io.BytesIO(b"".join(delimited(record) for record in records))
+    assert list(run.iter_delimited_records(stream)) == records
+
+
+def test_iter_truncated_record():
+    stream = io.BytesIO(delimited(b"abc") + delimited(b"defgh")[:-2])
+    records = run.iter_delimited_records(stream)
+    assert next(records) == b"abc"
+    with pytest.raises(ValueError):
+        next(records)
+
+
+def test_iter_truncated_length():
+    stream = io.BytesIO(delimited(b"abc") + encode_varint(300)[:1])
+    with pytest.raises(ValueError):
+        list(run.iter_delimited_records(stream))
+
+
+def test_split_record_fields():
+    element = b"\x0a\x03foo"
+    assert run.split_record_fields(analysis_record(2, element)) == (2, delimited(element))
+
+
+def test_split_record_with_wrong_wire_type():
+    with pytest.raises(ValueError):
+        run.split_record_fields(b"\x08\x01")
+
+
+def test_split_record_with_wrong_length():
+    with pytest.raises(ValueError):
+        run.split_record_fields(analysis_record(1, b"abc") + b"d")
+
+
+def test_split_analysis_results(project):
+    callsites = [b"\x0a\x01a", b"\x0a\x02bc"]
+    declarations = [b"\x0a\x01d"]
+    write_report(project, "results.proto", b"".join(
+        delimited(analysis_record(field, element))
+        for field, element in [(1, callsites[0]), (2, declarations[0]), (1, callsites[1])]))
+
+    result = run.run_phase_function("split_analysis_results", project, {})
+
+    assert result.success
+    assert read_report(project, "results-callsites.proto") == b"".join(delimited(c) for c in callsites)
+    assert read_report(project, "results-declarations.proto") == delimited(declarations[0])
+
+
+def test_split_truncated_results(project):
+    write_report(project, "results.proto", delimited(analysis_record(1, b"\x0a\x01a"))[:-1])
+    result = run.run_phase_function("split_analysis_results", project, {})
+    assert not result.success
+    assert result.payload.startswith("Corrupt results.proto")
+
+
+def test_split_json_results(project):
+    write_report(project, "results.json",
+                 b'{"callSites": [{"name": "a"}], "other": {"x": [1]}, "declarations": []}')
+    result = run.run_phase_function("split_analysis_results", project, {"ndjson": False})
+    assert result.success
+    assert read_report(project, "results-callsites.json") == b'[{"name": "a"}]'
+    assert read_report(project, "results-declarations.json") == b'[]'
+
+
+def test_merge_results(project):
+    other = os.path.join("projects", "other")
+    os.makedirs(os.path.join(other, run.BASE_CONFIG["reports_folder"]))
+    write_report(project, "results-callsites.proto", delimited(b"\x0a\x01a"))
+    write_report(project, "results-declarations.proto", delimited(b"\x0a\x01d"))
+    write_report(other, "results-callsites.proto", delimited(b"\x0a\x01b") + delimited(b"\x0a\x01c"))
+
+    run.merge_results(projects_path="projects", exclude_unfinished=False)
+
+    with open(run.BASE_CONFIG["callsites_merged"], 'rb') as merged:
+        # The projects are in the order of the folder listing
+        assert sorted(run.iter_delimited_records(merged)) == [b"\x0a\x01a", b"\x0a\x01b", b"\x0a\x01c"]
+    with open(run.BASE_CONFIG["results_merged_index"]) as index_file:
+        rows = [[value.strip() for value in line.split(",")] for line in index_file][1:]
+    for name, path, offset, length in rows:
+        with open(path, 'rb') as merged:
+            merged.seek(int(offset))
+            content = merged.read(int(length))
+        assert content == read_report(os.path.join("projects", name), os.path.basename(path).replace(".all", ""))
@@ -0,0 +1,106 @@
+import csv
+import os
+import stat
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("fabric")
+import run
+
+# Counts every line of the .scala files as code, and leaves out the others
+FAKE_CLOC = """#!%s
+import csv, os, sys
+out = [a[len("--out="):] for a in sys.argv if a.startswith("--out=")][0]
+with open(out, "w") as f:
+    writer = csv.writer(f)
+    writer.writerow(["language", "filename", "blank", "comment", "code"])
+    for root, _, files in os.walk("."):
+        for name in files:
+            if name.endswith(".scala"):
+                path = os.path.join(root, name)
+                writer.writerow(["Scala", path, 0, 0, len(open(path).read().splitlines())])
+    writer.writerow(["SUM", "", 0, 0, 0])
+"""
+
+
+@pytest.fixture
+def repo(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(run.BASE_CONFIG, "trace_file", None)
+    monkeypatch.setitem(run.BASE_CONFIG, "sloc_processes", 1)
+    os.mkdir("bin")
+    with open(os.path.join("bin", "cloc"), 'w') as cloc:
+        cloc.write(FAKE_CLOC % sys.executable)
+    os.chmod(os.path.join("bin", "cloc"), stat.S_IRWXU)
+    monkeypatch.setenv("PATH", os.path.abspath("bin") + os.pathsep + os.environ["PATH"])
+
+    os.mkdir("repo")
+    git("init", "-q")
+    write("repo/A.scala", "object A\n")
+    write("repo/src/B.scala", "object B {\n}\n")
+    write("repo/src/Copy.scala", "object A\n")
+    write("repo/target/C.scala", "object C\n")
+    write("repo/README.md", "# readme\n")
+    return commit("first")
+
+
+def git(*arguments):
+    return subprocess.check_output(["git", "-c", "user.name=t", "-c", "user.email=t@t"] + list(arguments),
+                                   cwd="repo").decode("utf-8").strip()
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def commit(message):
+    git("add", "-A")
+    git("commit", "-q", "-m", message)
+    return git("rev-parse", "HEAD")
+
+
+def read_report(path):
+    with open(path) as report:
+        return list(csv.reader(report))
+
+
+def test_commit_report(repo):
+    run.write_commit_locs("repo", repo, "sloc.csv")
+    # The copy of A.scala is counted once, target/ not at all
+    assert read_report("sloc.csv") == [["files", "language", "blank", "comment", "code", "commit %s" % repo],
+                                       ["2", "Scala", "0", "0", "3"],
+                                       ["2", "SUM", "0", "0", "3"]]
+    assert run.get_sloc_report_commit("sloc.csv") == repo
+
+
+def test_blobs_are_counted_once(repo, monkeypatch):
+    run.write_commit_locs("repo", repo, "first.csv")
+    write("repo/src/D.scala", "object D\n\n")
+    second = commit("second")
+
+    counted = []
+    count_blob_locs = run.count_blob_locs
+    monkeypatch.setattr(run, "count_blob_locs",
+                        lambda repo_path, files: counted.extend(files) or count_blob_locs(repo_path, files))
+    run.write_commit_locs("repo", second, "second.csv")
+    assert [path for path, _ in counted] == ["src/D.scala"]
+    assert read_report("second.csv")[1] == ["3", "Scala", "0", "0", "5"]
+
+    del counted[:]
+    run.write_commit_locs("repo", second, "again.csv")
+    assert counted == []
+    assert read_report("again.csv")[1:] == read_report("second.csv")[1:]
+
+
+def test_missing_blobs_are_skipped(repo):
+    files = list(run.list_commit_files("repo", repo))
+    missing = ("Missing.scala", "0123456789abcdef0123456789abcdef01234567")
+    counts = run.count_blob_locs("repo", files[:1] + [missing] + files[1:])
+
+    blobs = dict(files)
+    assert counts == {blobs["A.scala"]: ("Scala", 0, 0, 1), blobs["src/B.scala"]: ("Scala", 0, 0, 2),
+                      blobs["README.md"]: (None, 0, 0, 0)}
@@ -0,0 +1,103 @@
+import json
+import os
+import subprocess
+import threading
+
+import pytest
+
+pytest.importorskip("fabric")
+import run
+
+
+@pytest.fixture
+def trace(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(run.BASE_CONFIG, "trace_file", "trace.jsonl")
+    return "trace.jsonl"
+
+
+def read_trace(trace):
+    with open(trace) as trace_file:
+        return [json.loads(line) for line in trace_file]
+
+
+def test_phases_are_traced_with_their_commands(trace, monkeypatch):
+    os.makedirs(os.path.join("project", "reports"))
+
+    def write_output(project_path):
+        run.Pipeline().local("head -c 2048 /dev/zero > reports/out && echo done", project_path)
+        run.Pipeline().local("true", project_path)
+
+    monkeypatch.setitem(run.PHASES, "write_output",
+                        run.PhaseSpec(write_output, "write_output_report", [], False, outputs=["reports/out"]))
+    assert run.call_phase("write_output", "project", {}).success
+
+    commands = [record for record in read_trace(trace) if record["kind"] == "command"]
+    phase, = [record for record in read_trace(trace) if record["kind"] == "phase"]
+    assert [command["phase"] for command in commands] == ["write_output", "write_output"]
+    assert commands[0]["stdout_bytes"] == len("done\n")
+    assert commands[0]["return_code"] == 0
+    assert phase["project"] == os.path.abspath("project")
+    assert phase["commands"] == 2
+    assert phase["success"]
+    assert phase["output_bytes"] == 2048
+    assert phase["max_rss_kb"] == max(command["max_rss_kb"] for command in commands)
+
+
+def test_commands_outside_of_phases(trace):
+    run.Pipeline().local("exit 3", ".", warn_only=True)
+    record, = read_trace(trace)
+    assert record["phase"] is None
+    assert record["return_code"] == 3
+
+
+def test_no_trace_file(trace, monkeypatch):
+    monkeypatch.setitem(run.BASE_CONFIG, "trace_file", None)
+    run.append_trace({"kind": "command"})
+    assert not os.path.exists(trace)
+
+
+def test_concurrent_records_do_not_interleave(trace):
+    # Lines longer than the buffer of a file object, from several threads
+    def append(i):
+        for j in range(20):
+            run.append_trace({"kind": "command", "writer": i, "padding": str(i) * 100000})
+
+    threads = [threading.Thread(target=append, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    records = read_trace(trace)
+    assert len(records) == 160
+    assert all(record["padding"] == str(record["writer"]) * 100000 for record in records)
+
+
+def test_process_usage():
+    process = subprocess.Popen(["python3", "-c", "sum(range(10 ** 6)); input()"],
+                               stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    try:
+        usage = run.get_process_usage(process.pid)
+        assert usage.ru_maxrss > 0
+        assert usage.ru_utime >= 0 and usage.ru_stime >= 0
+    finally:
+        process.communicate(b"\n")
+    assert run.get_process_usage(process.pid) == (0.0, 0.0, 0)
+
+
+def test_profile_skips_broken_lines(trace, capsys):
+    records = [{"kind": "phase", "project": "/p/%d" % i, "phase": "analyze", "wall": 10.0 * (i + 1),
+                "user_cpu": 1.0, "system_cpu": 0.5, "max_rss_kb": 2048, "output_bytes": 1 << 20,
+                "success": i != 1} for i in range(3)]
+    with open(trace, 'w') as trace_file:
+        trace_file.write(json.dumps({"kind": "command", "wall": 1.0}) + "\n")
+        for record in records:
+            trace_file.write(json.dumps(record) + "\n")
+        # Cut by a killed job
+        trace_file.write(json.dumps(records[0])[:40])
+
+    run.profile_corpus(trace, top=1)
+    output = capsys.readouterr().out
+    assert "3 phases of 3 projects, 60s in total" in output
+    assert "/p/2 (analyze: 30s)" in output
+    assert "/p/1 (" not in output